@@ -1,10 +1,11 @@
 from src._count import kmer_count
 from src._count import kmer_count_m_k
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
 import time
 import os
 import method
+import sparse
+import tree
 import argparse
 
 Suffix = ['.fasta', '.fsa', '.fna', '.fa']
@@ -33,6 +34,19 @@ def get_sequence_from_file(filename):
     with open(filename) as f:
         for line in f.readlines():
             line = line.strip()
+            if '\t' in line:
+                # sample name followed by its files, separated by tabs
+                fields = line.split('\t')
+                files = [x.strip() for x in fields[1:] if x.strip()]
+                for seqfile in files:
+                    if not os.path.exists(seqfile):
+                        raise Exception('File %s do no exsits!'%seqfile)
+                    if not seqfile.endswith(tuple(Suffix)):
+                        raise Exception('File %s of sample %s is not a fasta file!'%(seqfile, fields[0]))
+                if not files:
+                    raise Exception('Sample %s has no files!'%fields[0])
+                sequence_list.append(method.Sample(fields[0].strip(), files))
+                continue
             if not os.path.exists(line):
                 e = 'File %s do no exsits!'%line
                 raise Exception(e)
@@ -41,9 +55,29 @@ def get_sequence_from_file(filename):
                     sequence_list.append(line)
     return sequence_list 
    
-def check_arguments(K, M, filename, filename1, filename2, seqfile, seqfile1, seqfile2, P_dir, output, threads):
+def parse_K(value):
+    # A kmer length, a range like 6-12 or a list like 6,8,10, as an ascending list
+    K_list = set()
+    try:
+        for part in value.split(','):
+            if '-' in part:
+                first, last = part.split('-')
+                K_list.update(range(int(first), int(last) + 1))
+            else:
+                K_list.add(int(part))
+    except ValueError:
+        K_list = set()
+    if not K_list or min(K_list) <= 0:
+        raise argparse.ArgumentTypeError('Kmer length must be a positive integer, a range like 6-12 or a list like 6,8,10!')
+    return sorted(K_list)
+
+def check_arguments(K, M, filename, filename1, filename2, seqfile, seqfile1, seqfile2, P_dir, output, threads, prefetch=0, Sparse=False):
     if K <= 0:
         raise ValueError('Kmer length must be a positive integer!')
+    if K > sparse.Max_K:
+        raise ValueError('Kmer length cannot be greater than %d!'%sparse.Max_K)
+    if K > 15 and not Sparse:
+        raise ValueError('Kmer length greater than 15 requires --sparse!')
     if M <= 0:
         raise ValueError('Markovian order must be a non-negative integer!')
     '''
@@ -63,6 +97,12 @@ def check_arguments(K, M, filename, filename1, filename2, seqfile, seqfile1, seq
     else:
         e = 'Use either -f OR -f1, -f2 OR -s OR -s1, -s2 to indicate input sequences!'
         raise Exception(e)
+    if prefetch < 0:
+        raise ValueError('Number of prefetched files must be a non-negative integer!')
+    if prefetch and Sparse:
+        raise Exception('--prefetch cannot be used together with --sparse!')
+    if prefetch and P_dir == 'None':
+        raise Exception('--prefetch saves kmer counts, use -d to indicate a directory!')
     if P_dir == 'None':
         print('Warning: Using -d option to save kmer counts in a directory can save you a lot of counting time.')
     else:
@@ -74,24 +114,94 @@ def check_arguments(K, M, filename, filename1, filename2, seqfile, seqfile1, seq
         if d:
             os.system('mkdir -p %s'%d)
 
-def get_matrix(a_method):
+def prefetch_counts(methods, seqname_list, M, K, Num_Threads, Reverse, P_dir, prefetch):
+    if set(methods) & set(['d2star', 'd2shepp']):
+        method.count_files(seqname_list, M, K, Num_Threads, Reverse, P_dir, prefetch)
+    if 'cvtree' in methods:
+        method.count_files(seqname_list, K-1, K, Num_Threads, Reverse, P_dir, prefetch)
+    if set(methods) & set(['ma', 'eu', 'd2']):
+        method.count_files(seqname_list, None, K, Num_Threads, Reverse, P_dir, prefetch)
+
+def prefetch_sequences(methods, seqname_list, sequence_list, M, K, Num_Threads, Reverse, P_dir, Sparse=False):
+    # Counts all -s records with one batch call per kmer length before the methods run
+    if Sparse:
+        if set(methods) & set(['d2star', 'd2shepp']):
+            method.count_sequences(seqname_list, sequence_list, None, M, Num_Threads, Reverse, P_dir)
+        if 'cvtree' in methods:
+            sparse.count_hash_sequences(seqname_list, sequence_list, K-1, Num_Threads, Reverse, P_dir)
+        sparse.count_hash_sequences(seqname_list, sequence_list, K, Num_Threads, Reverse, P_dir)
+        return
+    if set(methods) & set(['d2star', 'd2shepp']):
+        method.count_sequences(seqname_list, sequence_list, M, K, Num_Threads, Reverse, P_dir)
+    if 'cvtree' in methods:
+        method.count_sequences(seqname_list, sequence_list, K-1, K, Num_Threads, Reverse, P_dir)
+    if set(methods) & set(['ma', 'eu', 'd2']):
+        method.count_sequences(seqname_list, sequence_list, None, K, Num_Threads, Reverse, P_dir)
+
+def prefetch_sweep(methods, seqname_list, sequence_list, M, K_list, Num_Threads, Reverse, P_dir, prefetch, from_seq, Sparse=False):
+    # Counts all kmer lengths a sweep over K reads with one scan of each input, so the runs of every
+    # K find their counts in P_dir or method.Sequence_counts
+    if len(K_list) == 1 or Sparse or (method.Sampling is not None and not from_seq):
+        return
+    sizes = method.sweep_sizes(methods, M, K_list)
+    if from_seq:
+        method.sweep_sequences(seqname_list, sequence_list, sizes, Num_Threads, Reverse, P_dir)
+    else:
+        method.sweep_files(seqname_list, sizes, Num_Threads, Reverse, P_dir, prefetch if prefetch else 2)
+
+def sweep_output(output, K, K_list):
+    # Every K of a sweep writes its results with its own prefix
+    if len(K_list) == 1:
+        return output
+    if output.endswith('/'):
+        return output + 'K%d'%K
+    return '%s.K%d'%(output, K)
+
+def set_approximate(tolerance, N, K):
+    # Projects the d2star, CVTree and d2 features when that makes them shorter than 4^K
+    method.Approximate = None
+    if not tolerance:
+        return
+    dim = method.projection_size(N, tolerance)
+    if dim >= 4**K:
+        print('Warning: %d projected dimensions are not fewer than 4^%d, calculating exactly.'%(dim, K))
+        return
+    print('Projecting d2star, CVTree and d2 features to %d dimensions.'%dim)
+    method.Approximate = method.Projection(dim, 0)
+
+def get_checkpoint(output, name, interval, resume):
+    if not (interval or resume):
+        return None
+    if output.endswith('/'):
+        filename = output + name + '.ckpt.npz'
+    else:
+        filename = '.'.join([output, name, 'ckpt', 'npz'])
+    return method.Checkpoint(filename, interval if interval else 600, resume)
+
+def remove_checkpoints(checkpoints):
+    for checkpoint in checkpoints:
+        if checkpoint is not None and os.path.exists(checkpoint.filename):
+            os.remove(checkpoint.filename)
+
+def get_matrix(a_method, Sparse=False):
+    module = sparse if Sparse else method
     if a_method not in ['d2star', 'd2shepp', 'cvtree', 'ma', 'eu', 'd2']:
         print('Invalid method %s'%a_method)
         print('Only d2star,d2shepp,CVtree,Ma,Eu,d2 are supported') 
         raise NameError
     else:
         if a_method == 'd2star':
-            return method.d2star_matrix_pairwise
+            return module.d2star_matrix_pairwise
         elif a_method == 'd2shepp':
-            return method.d2shepp_matrix_pairwise
+            return module.d2shepp_matrix_pairwise
         elif a_method == 'cvtree':
-            return method.CVTree_matrix_pairwise
+            return module.CVTree_matrix_pairwise
         elif a_method == 'ma':
-            return method.Ma_matrix_pairwise
+            return module.Ma_matrix_pairwise
         elif a_method == 'eu':
-            return method.Eu_matrix_pairwise
+            return module.Eu_matrix_pairwise
         else:
-            return method.d2_matrix_pairwise
+            return module.d2_matrix_pairwise
  
 def get_bias(a_method):
     if a_method == 'd2star':
@@ -101,37 +211,39 @@ def get_bias(a_method):
     else:
         return None
 
-def get_matrix_group(a_method):
+def get_matrix_group(a_method, Sparse=False):
+    module = sparse if Sparse else method
     if a_method not in ['d2star', 'd2shepp', 'cvtree', 'ma', 'eu', 'd2']:
         print('Invalid method %s'%a_method)
         print('Only d2star,d2shepp,CVtree,Ma,Eu,d2 are supported')
         raise NameError
     else:
         if a_method == 'd2star':
-            return method.d2star_matrix_groupwise
+            return module.d2star_matrix_groupwise
         elif a_method == 'd2shepp':
-            return method.d2shepp_matrix_groupwise
+            return module.d2shepp_matrix_groupwise
         elif a_method == 'cvtree':
-            return method.CVTree_matrix_groupwise
+            return module.CVTree_matrix_groupwise
         elif a_method == 'ma':
-            return method.Ma_matrix_groupwise
+            return module.Ma_matrix_groupwise
         elif a_method == 'eu':
-            return method.Eu_matrix_groupwise
+            return module.Eu_matrix_groupwise
         else:
-            return method.d2_matrix_groupwise
+            return module.d2_matrix_groupwise
 
 def write_phy(output, a_method, seqname_list, matrix, from_seq):
     if output.endswith('/'):
         filename = output + a_method + '.' + 'phy'
     else:
         filename = '.'.join([output, a_method, 'phy'])
+    # matrix is condensed, each row of the square matrix is expanded when written
     num = len(seqname_list)
     with open(filename, 'wt') as f:
         f.write('%d\n'%num)
         for i in range(num):
             seqname = seqname_strip(seqname_list[i], from_seq)
             f.write(seqname)
-            for value in matrix[i]:
+            for value in method.condensed_row(matrix, num, i):
                 f.write('\t%.4f'%value)
             f.write('\n')
 
@@ -144,10 +256,23 @@ def write_tsv(output, a_method, seqname_list, matrix, from_seq):
     with open(filename, 'wt') as f:
         for i in range(num):
             seq_1 = seqname_strip(seqname_list[i], from_seq)
-            for j in np.argsort(matrix[i]):
+            row = method.condensed_row(matrix, num, i)
+            for j in np.argsort(row):
                 seq_2 = seqname_strip(seqname_list[j], from_seq)
                 if i != j:
-                    f.write('%s\t%s\t%.4f\n'%(seq_1, seq_2, matrix[i][j]))
+                    f.write('%s\t%s\t%.4f\n'%(seq_1, seq_2, row[j]))
+
+def write_tree(output, a_method, seqname_list, matrix, from_seq):
+    # neighbour joining tree of a condensed pairwise result in Newick format
+    if output.endswith('/'):
+        filename = output + a_method + '.' + 'nwk'
+    else:
+        filename = '.'.join([output, a_method, 'nwk'])
+    names = [seqname_strip(seqname, from_seq) for seqname in seqname_list]
+    with method.stage('tree'):
+        newick = tree.neighbor_joining(matrix, names)
+    with open(filename, 'wt') as f:
+        f.write(newick + '\n')
 
 def write_phy_group(output, a_method, seqname_list_1, seqname_list_2, matrix, from_seq):
     if output.endswith('/'):
@@ -207,7 +332,7 @@ def write_BIC(output, seqname_list, BIC_list, from_seq):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Example: python alignmentfree.py -r -a d2star,d2shepp,CVtree -k 12 -m 10 -f filename -d dir -o output') 
     parser.add_argument('-a', dest='method', help='A list of alignment-free method, separated by comma: d2star,d2shepp,CVtree,Ma,Eu,d2')
-    parser.add_argument('-k', dest='K', required = True, type = int, help='Kmer length')
+    parser.add_argument('-k', dest='K', required = True, type = parse_K, help='Kmer length, or a range like 6-12 or a list like 6,8,10 of kmer lengths that are all counted with one scan of each input and whose results are written with the prefix OUTPUT.K<k>')
     parser.add_argument('-m', dest='M', type = int, default=0, help='Markovian Order, required for d2star, d2shepp and CVtree')
     parser.add_argument('-f', dest='filename', help='A file that lists the paths of all samples, cannot be used together with -f1, -f2, -s, -s1, -s2')
     parser.add_argument('-s', dest='sequence_file', help='A fasta file that lists the sequences of all samples, cannot be used together with -f, -f1, -f2, -s1, -s2')
@@ -217,13 +342,23 @@ if __name__ == "__main__":
     parser.add_argument('-s2', dest='sequence_file_2', help='A fasta file that lists the sequences of the second group of samples, must be used together with -s1, cannot be used together with -f, -f1, -f2, -s')
     parser.add_argument('-d', dest='Dir', default='None', help='A directory that saves kmer count')
     parser.add_argument('-o', dest='output', help='Prefix of output (defualt: Current directory)', default='./')
-    parser.add_argument('-t', dest='threads', type = int, default=1, help='Number of threads')
+    parser.add_argument('-t', dest='threads', type = int, default=1, help='Number of threads of every stage, shared by the kmer counter, numexpr and the BLAS and OpenMP pools of numpy, scipy and sklearn')
     parser.add_argument('-r', dest='reverse_complement', action='store_true', default=False, help='Count the reverse complement of kmers (default: False)')
     parser.add_argument('--adjust', dest='adjust', action='store_true', default=False, help='Adjust d2star and/or d2shepp distances for NGS samples, -r will be set automatically')
     parser.add_argument('--BIC', dest='BIC', action='store_true', default=False, help='Use BIC to estimate the Markovian orders of sequences')
     parser.add_argument('--slow', dest='slow', action='store_true', default=False, help='Use slow mode for calculation with less memory usage (default: False)')
+    parser.add_argument('--grid', dest='grid', type = int, default=0, help='Adjust with a GRID^3 lookup grid of the neural network, which is built once and cached in model/, e.g. 65 or 129 (default: 0, use the exact neural network)')
+    parser.add_argument('--checkpoint', dest='checkpoint', type = int, default=0, help='Save the finished rows of slow mode and d2shepp matrices, bias arrays and adjusted matrices every CHECKPOINT seconds (default: 0, disabled)')
+    parser.add_argument('--resume', dest='resume', action='store_true', default=False, help='Resume from the checkpoints saved under the output prefix, checkpoints every 600 seconds unless --checkpoint is given (default: False)')
+    parser.add_argument('--sparse', dest='sparse', action='store_true', default=False, help='Count kmers into a hash table and compare the observed kmers only, required for kmer length 16 to 31, cannot be used together with --adjust, --prefetch (default: False)')
+    parser.add_argument('--subsample', dest='subsample', type = float, default=0, help='Count sample files from random blocks of reads until the L1 change of the normalised kmer frequencies falls below SUBSAMPLE, counts are saved under a subdirectory of -d named after the settings with the number of reads used (default: 0, count all reads)')
+    parser.add_argument('--max-reads', dest='max_reads', type = int, default=0, help='Count at most about MAX_READS reads of each sample file in random blocks, can be used together with --subsample (default: 0, no limit)')
+    parser.add_argument('--approximate', dest='approximate', type = float, default=0, help='Compare d2star, CVTree and d2 features after a seeded sparse random projection whose size keeps the relative error of the distances below APPROXIMATE with high probability, e.g. 0.1, only the projections are saved in -d, cannot be used together with --slow, --sparse (default: 0, exact)')
+    parser.add_argument('--prefetch', dest='prefetch', type = int, default=0, help='Count the samples listed by -f, -f1, -f2 with one pipelined counter that reads this many files ahead, requires -d (default: 0, disabled)')
+    parser.add_argument('--tree', dest='tree', action='store_true', default=False, help='Write the neighbour joining tree of each pairwise distance matrix in Newick format, cannot be used together with -f1, -f2, -s1, -s2 (default: False)')
     args = parser.parse_args()
-    K = args.K 
+    K_list = args.K
+    K = K_list[-1]
     M = args.M + 1
     filename = args.filename
     filename1 = args.filename1
@@ -241,6 +376,31 @@ if __name__ == "__main__":
         Reverse = True
     BIC = args.BIC
     slow = args.slow
+    prefetch = args.prefetch
+    grid = args.grid
+    interval = args.checkpoint
+    resume = args.resume
+    Sparse = args.sparse
+    if Sparse and adjust:
+        raise Exception('--adjust cannot be used together with --sparse!')
+    if args.subsample < 0 or args.max_reads < 0:
+        raise ValueError('Subsampling tolerance and read budget must be non-negative!')
+    if args.subsample or args.max_reads:
+        if Sparse or prefetch:
+            raise Exception('--subsample and --max-reads cannot be used together with --sparse, --prefetch!')
+        method.Sampling = method.Subsample(args.subsample, args.max_reads, 0)
+    if not 0 <= args.approximate < 1:
+        raise ValueError('Approximation tolerance must be between 0 and 1!')
+    if len(K_list) > 1 and BIC:
+        raise Exception('--BIC takes a single kmer length!')
+    if args.tree and not (filename or seqfile):
+        raise Exception('--tree needs pairwise distances, use -f or -s!')
+    if args.approximate and (slow or Sparse):
+        raise Exception('--approximate cannot be used together with --slow, --sparse!')
+    if grid < 0 or grid == 1:
+        raise ValueError('Lookup grid needs at least 2 points per axis!')
+    if interval < 0:
+        raise ValueError('Checkpoint interval must be a non-negative integer!')
     P_dir = args.Dir
     seqname_list = []
     sequence_list = []
@@ -248,57 +408,95 @@ if __name__ == "__main__":
     sequence_list_2 = []
     Num_Threads = args.threads
     output = args.output
-    check_arguments(K, M, filename, filename1, filename2, seqfile, seqfile1, seqfile2, P_dir, output, Num_Threads)
+    method.set_thread_budget(Num_Threads)
+    if method.Sampling is not None and P_dir != 'None':
+        P_dir = os.path.join(P_dir, 'subsample_tol%g_reads%d_seed%d'%method.Sampling)
+    check_arguments(K, M, filename, filename1, filename2, seqfile, seqfile1, seqfile2, P_dir, output, Num_Threads, prefetch, Sparse)
+    if len(K_list) > 1 and not from_seq and P_dir == 'None':
+        raise Exception('A range of kmer lengths saves kmer counts, use -d to indicate a directory!')
     if BIC:
         if from_seq:
             seqname_old_list, seqname_list, sequence_list = method.get_sequences(seqfile) 
+            method.count_sequences(seqname_list, sequence_list, None, K-1, Num_Threads, Reverse, P_dir)
         else:
             seqname_list = get_sequence_from_file(filename)
+            if prefetch:
+                method.count_files(seqname_list, None, K-1, Num_Threads, Reverse, P_dir, prefetch)
         print('Calculating Markovian order.')
-        BIC_list = method.all_BIC(seqname_list, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
+        with method.stage('features'):
+            BIC_list = method.all_BIC(seqname_list, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
         if from_seq:
             write_BIC(output, seqname_old_list, BIC_list, from_seq)
         else:
             write_BIC(output, seqname_list, BIC_list, from_seq)
     else:
         methods = [x.strip().lower() for x in args.method.split(',')]
+        # every kmer length of a sweep needs M < K, not only the largest one
+        if set(methods) & set(['d2star', 'd2shepp']) and M >= K_list[0]:
+            raise ValueError('Markovian order cannot be greater than K-2, K=%d is too short!'%K_list[0])
         if filename or seqfile:
             if from_seq:
                 seqname_old_list, seqname_list, sequence_list = method.get_sequences(seqfile)
             else:
-                seqname_list = get_sequence_from_file(filename)
-            for a_method in methods:
-                print('Calculating %s.'%a_method)
-                matrix = get_matrix(a_method)(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, slow)
+                seqname_list = seqname_old_list = get_sequence_from_file(filename)
+            prefetch_sweep(methods, seqname_list, sequence_list, M, K_list, Num_Threads, Reverse, P_dir, prefetch, from_seq, Sparse)
+            for K in K_list:
+                K_output = sweep_output(output, K, K_list)
                 if from_seq:
-                    seqname_list = seqname_old_list
-                write_tsv(output, a_method, seqname_list, matrix, from_seq)
-                write_phy(output, a_method, seqname_list, matrix, from_seq)
-                if a_method in ['d2star', 'd2shepp'] and Reverse and adjust:
-                    bias_array = get_bias(a_method)(seqname_list, M, K, Num_Threads, Reverse, P_dir,  sequence_list, from_seq, slow)
-                    write_bias(output, a_method, seqname_list, [], bias_array, [], from_seq)
-                    new_matrix = method.matrix_adjusted_pairwise(matrix, bias_array, a_method)
-                    write_tsv(output, a_method + '_adjusted', seqname_list, new_matrix, from_seq)
-                    write_phy(output, a_method + '_adjusted', seqname_list, new_matrix, from_seq)
+                    prefetch_sequences(methods, seqname_list, sequence_list, M, K, Num_Threads, Reverse, P_dir, Sparse)
+                elif prefetch:
+                    prefetch_counts(methods, seqname_list, M, K, Num_Threads, Reverse, P_dir, prefetch)
+                set_approximate(args.approximate, len(seqname_list), K)
+                for a_method in methods:
+                    print('Calculating %s.'%(a_method if len(K_list) == 1 else '%s with K=%d'%(a_method, K)))
+                    checkpoints = [get_checkpoint(K_output, a_method + suffix, interval, resume) for suffix in ['', '.bias', '_adjusted']]
+                    with method.stage('distances'):
+                        matrix = get_matrix(a_method, Sparse)(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, slow, checkpoints[0])
+                    write_tsv(K_output, a_method, seqname_old_list, matrix, from_seq)
+                    write_phy(K_output, a_method, seqname_old_list, matrix, from_seq)
+                    if args.tree:
+                        write_tree(K_output, a_method, seqname_old_list, matrix, from_seq)
+                    if a_method in ['d2star', 'd2shepp'] and Reverse and adjust:
+                        with method.stage('bias'):
+                            bias_array = get_bias(a_method)(seqname_list, M, K, Num_Threads, Reverse, P_dir,  sequence_list, from_seq, slow, checkpoint=checkpoints[1])
+                        write_bias(K_output, a_method, seqname_old_list, [], bias_array, [], from_seq)
+                        with method.stage('adjusting'):
+                            new_matrix = method.matrix_adjusted_pairwise(matrix, bias_array, a_method, checkpoints[2], grid)
+                        write_tsv(K_output, a_method + '_adjusted', seqname_old_list, new_matrix, from_seq)
+                        write_phy(K_output, a_method + '_adjusted', seqname_old_list, new_matrix, from_seq)
+                        if args.tree:
+                            write_tree(K_output, a_method + '_adjusted', seqname_old_list, new_matrix, from_seq)
+                    remove_checkpoints(checkpoints)
         else: 
             if from_seq:
                 seqname_old_list_1, seqname_list_1, sequence_list_1 = method.get_sequences(seqfile1)
                 seqname_old_list_2, seqname_list_2, sequence_list_2 = method.get_sequences(seqfile2)
             else:
-                seqname_list_1 = get_sequence_from_file(filename1)
-                seqname_list_2 = get_sequence_from_file(filename2)
-            for a_method in methods:
-                print('Calculating %s.'%a_method)
-                matrix = get_matrix_group(a_method)(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, slow)
+                seqname_list_1 = seqname_old_list_1 = get_sequence_from_file(filename1)
+                seqname_list_2 = seqname_old_list_2 = get_sequence_from_file(filename2)
+            prefetch_sweep(methods, seqname_list_1 + seqname_list_2, sequence_list_1 + sequence_list_2, M, K_list, Num_Threads, Reverse, P_dir, prefetch, from_seq, Sparse)
+            for K in K_list:
+                K_output = sweep_output(output, K, K_list)
                 if from_seq:
-                    seqname_list_1 = seqname_old_list_1
-                    seqname_list_2 = seqname_old_list_2
-                write_phy_group(output, a_method, seqname_list_1, seqname_list_2, matrix, from_seq)
-                write_tsv_group(output, a_method, seqname_list_1, seqname_list_2, matrix, from_seq)
-                if a_method in ['d2star', 'd2shepp'] and Reverse and adjust:
-                    bias_array_1 = get_bias(a_method)(seqname_list_1, M, K, Num_Threads, Reverse, P_dir,  sequence_list_1, from_seq, slow)
-                    bias_array_2 = get_bias(a_method)(seqname_list_2, M, K, Num_Threads, Reverse, P_dir,  sequence_list_2, from_seq, slow)
-                    write_bias(output, a_method, seqname_list_1, seqname_list_2, bias_array_1, bias_array_2, from_seq)
-                    new_matrix = method.matrix_adjusted_groupwise(matrix, bias_array_1, bias_array_2, a_method)
-                    write_phy_group(output, a_method + '_adjusted', seqname_list_1, seqname_list_2, new_matrix, from_seq)
-                    write_tsv_group(output, a_method + '_adjusted', seqname_list_1, seqname_list_2, new_matrix, from_seq)
+                    prefetch_sequences(methods, seqname_list_1 + seqname_list_2, sequence_list_1 + sequence_list_2, M, K, Num_Threads, Reverse, P_dir, Sparse)
+                elif prefetch:
+                    prefetch_counts(methods, seqname_list_1 + seqname_list_2, M, K, Num_Threads, Reverse, P_dir, prefetch)
+                set_approximate(args.approximate, len(seqname_list_1) + len(seqname_list_2), K)
+                for a_method in methods:
+                    print('Calculating %s.'%(a_method if len(K_list) == 1 else '%s with K=%d'%(a_method, K)))
+                    checkpoints = [get_checkpoint(K_output, a_method + suffix, interval, resume) for suffix in ['', '.bias1', '.bias2', '_adjusted']]
+                    with method.stage('distances'):
+                        matrix = get_matrix_group(a_method, Sparse)(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, slow, checkpoints[0])
+                    write_phy_group(K_output, a_method, seqname_old_list_1, seqname_old_list_2, matrix, from_seq)
+                    write_tsv_group(K_output, a_method, seqname_old_list_1, seqname_old_list_2, matrix, from_seq)
+                    if a_method in ['d2star', 'd2shepp'] and Reverse and adjust:
+                        with method.stage('bias'):
+                            bias_array_1 = get_bias(a_method)(seqname_list_1, M, K, Num_Threads, Reverse, P_dir,  sequence_list_1, from_seq, slow, checkpoint=checkpoints[1])
+                            bias_array_2 = get_bias(a_method)(seqname_list_2, M, K, Num_Threads, Reverse, P_dir,  sequence_list_2, from_seq, slow, checkpoint=checkpoints[2])
+                        write_bias(K_output, a_method, seqname_old_list_1, seqname_old_list_2, bias_array_1, bias_array_2, from_seq)
+                        with method.stage('adjusting'):
+                            new_matrix = method.matrix_adjusted_groupwise(matrix, bias_array_1, bias_array_2, a_method, checkpoints[3], grid)
+                        write_phy_group(K_output, a_method + '_adjusted', seqname_old_list_1, seqname_old_list_2, new_matrix, from_seq)
+                        write_tsv_group(K_output, a_method + '_adjusted', seqname_old_list_1, seqname_old_list_2, new_matrix, from_seq)
+                    remove_checkpoints(checkpoints)
+    method.stage_report()
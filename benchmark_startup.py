@@ -0,0 +1,41 @@
+import subprocess
+import argparse
+import time
+import sys
+import os
+
+# Cold start of the command line tools: the wall time of SCRIPT -h and the heavy modules that importing
+# the script loads, which should wait for the stage that needs them.
+
+Heavy = ['sklearn', 'scipy', 'numexpr', 'threadpoolctl', 'model']
+Scripts = ['afann.py', 'shard.py', 'scan.py']
+
+def heavy_modules(script, directory):
+    # A lazily imported module is in sys.modules before it is loaded, only a plain module is loaded
+    code = 'import sys, types, {}; print(" ".join(m for m in {!r} if type(sys.modules.get(m)) is types.ModuleType))'.format(script[:-3], Heavy)
+    return subprocess.run([sys.executable, '-c', code], cwd=directory, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout.split()
+
+def startup_time(script, directory, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.run([sys.executable, script, '-h'], cwd=directory, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Example: python benchmark_startup.py --repeat 10 --max 0.5')
+    parser.add_argument('--repeat', dest='repeat', type = int, default=5, help='Number of runs of each script, the median is reported (default: 5)')
+    parser.add_argument('--max', dest='max', type = float, default=0, help='Fail if the median start of a script takes more than MAX seconds (default: 0, no limit)')
+    args = parser.parse_args()
+    if args.repeat <= 0:
+        raise ValueError('Number of runs must be a positive integer!')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    failed = False
+    for script in Scripts:
+        seconds = startup_time(script, directory, args.repeat)
+        modules = heavy_modules(script, directory)
+        print('%s: %.3fs median of %d, heavy modules at import: %s'%(script, seconds, args.repeat, ', '.join(modules) if modules else 'none'))
+        if modules or (args.max and seconds > args.max):
+            failed = True
+    sys.exit(1 if failed else 0)
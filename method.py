@@ -2,21 +2,172 @@ from src._count import kmer_count
 from src._count import kmer_count_seq
 from src._count import kmer_count_m_k
 from src._count import kmer_count_m_k_seq
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.metrics.pairwise import manhattan_distances
-from sklearn.metrics.pairwise import euclidean_distances
-from sklearn.utils.extmath import safe_sparse_dot
-from model import padding_MLPR 
+from src._count import kmer_count_files
+from src._count import kmer_count_m_k_files
+from src._count import kmer_count_group
+from src._count import kmer_count_m_k_group
+from src._count import kmer_count_batch
+from src._count import kmer_count_m_k_batch
+from src._count import kmer_count_sizes_files
+from src._count import kmer_count_sizes_batch
 from functools import partial
+from functools import wraps
+from contextlib import contextmanager
+from collections import namedtuple
+import importlib.util
 import numpy as np
-import numexpr as ne
+import hashlib
+import types
+import mmap
+import time
+import sys
+import re
 import os
 from numpy import linalg as LA
 
+# sklearn, scipy, threadpoolctl and the adjustment networks of model.py are imported by the functions
+# that use them and numexpr by its first use, so runs that never reach a stage skip its imports.
+
+def lazy_import(name):
+    # The module is loaded by the first access to one of its attributes
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+ne = lazy_import('numexpr')
+
 Suffix = ['fna', 'fa', 'fasta']
 Alphabeta = ['A', 'C', 'G', 'T']
 Alpha_dict = dict(zip(Alphabeta, range(4)))
 
+# filename: where the state is saved, interval: seconds between saves, resume: start from the saved state
+Checkpoint = namedtuple('Checkpoint', ['filename', 'interval', 'resume'])
+# tolerance: L1 change of the kmer frequencies to stop at, max_reads: read budget (0 for none), seed: block order
+Subsample = namedtuple('Subsample', ['tolerance', 'max_reads', 'seed'])
+# Counts sample files from random blocks of reads when set, see count_subsample
+Sampling = None
+# Counts of -s records by (seqname, K, Reverse), filled by count_sequences with one batch call
+Sequence_counts = {}
+# Number of distances computed at once when filling a condensed pairwise result
+Chunk_Size = 1 << 25
+# Entries of one chunk of the expected counts, small enough to stay in cache while a feature is built
+Expect_Chunk = 1 << 16
+# dim: size of the projected d2star, CVTree and d2 features, seed: projection matrix
+Projection = namedtuple('Projection', ['dim', 'seed'])
+# Compares projected features in the fast mode when set, see projection_size
+Approximate = None
+Projectors = {}
+# Threads of a run given by -t, see set_thread_budget
+Thread_Budget = 1
+Controller = None
+# Modules loaded when Controller was made, it only sees the thread pools of the libraries loaded by then
+Controller_Modules = 0
+Stage_Names = ['counting', 'features', 'distances', 'bias', 'adjusting', 'tree']
+# Wall and CPU seconds of every stage, without the stages nested in it
+Stage_Times = {}
+Stage_Stack = []
+Stage_Clock = None
+
+def limit_threads(threads):
+    global Controller, Controller_Modules
+    if Controller is None or len(sys.modules) != Controller_Modules:
+        from threadpoolctl import ThreadpoolController
+        Controller = ThreadpoolController()
+        Controller_Modules = len(sys.modules)
+    Controller.limit(limits=threads)
+    # numexpr and the pools of libraries imported later in the stage read their threads from the
+    # environment when they are loaded
+    for variable in ['NUMEXPR_NUM_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[variable] = str(threads)
+    if type(ne) is types.ModuleType:
+        ne.set_num_threads(min(threads, ne.MAX_THREADS))
+
+def set_thread_budget(Num_Threads):
+    # -t drives every pool of a run: the counter of src/_count, numexpr and the BLAS and OpenMP pools
+    # of numpy, scipy and sklearn, which would otherwise start a thread per core each. Stages run one
+    # after another and each hands the whole budget to the pools it uses, see stage_threads.
+    global Thread_Budget
+    Thread_Budget = max(1, Num_Threads)
+    limit_threads(Thread_Budget)
+
+def stage_threads(name):
+    # Threads of numexpr and BLAS in a stage, counting leaves the budget to the counter and the
+    # neighbour joining of tree.py runs on one thread
+    return 1 if name in ['counting', 'tree'] else Thread_Budget
+
+def charge_stage():
+    # Adds the time since the last stage switch to the running stage
+    global Stage_Clock
+    now = (time.time(), time.process_time())
+    if Stage_Stack:
+        times = Stage_Times.setdefault(Stage_Stack[-1], [0.0, 0.0])
+        times[0] += now[0] - Stage_Clock[0]
+        times[1] += now[1] - Stage_Clock[1]
+    Stage_Clock = now
+
+@contextmanager
+def stage(name):
+    charge_stage()
+    Stage_Stack.append(name)
+    limit_threads(stage_threads(name))
+    try:
+        yield
+    finally:
+        charge_stage()
+        Stage_Stack.pop()
+        limit_threads(stage_threads(Stage_Stack[-1]) if Stage_Stack else Thread_Budget)
+
+def staged(name):
+    # Runs a function as a stage
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def stage_report():
+    # Effective parallelism of a stage: its CPU time over its wall time, of all threads of the process
+    for name in Stage_Names:
+        if name in Stage_Times:
+            wall, cpu = Stage_Times[name]
+            threads = Thread_Budget if name != 'tree' else 1
+            print('Stage %s: %.2fs on %d thread%s, effective parallelism %.2f.'%(name, wall, threads, 's' if threads > 1 else '', cpu / wall if wall else 0))
+
+class Sample(str):
+    # A sample made of several fasta files (e.g. paired reads or lanes), the string is its name
+    def __new__(cls, name, files):
+        sample = str.__new__(cls, name)
+        sample.files = files
+        return sample
+
+def sample_files(seqfile):
+    return seqfile.files if isinstance(seqfile, Sample) else [seqfile]
+
+def check_members(seqfile):
+    # Every file of a sample has to hold sequences
+    for filename in sample_files(seqfile):
+        if os.path.getsize(filename) == 0:
+            raise Exception('Sequence file %s is empty!'%filename)
+
+def count_file(seqfile, K, Num_Threads, Reverse):
+    if isinstance(seqfile, Sample):
+        check_members(seqfile)
+        return kmer_count_group(seqfile.files, K, Num_Threads, Reverse)
+    return kmer_count(seqfile, K, Num_Threads, Reverse)
+
+def count_file_m_k(seqfile, M, K, Num_Threads, Reverse):
+    if isinstance(seqfile, Sample):
+        check_members(seqfile)
+        return kmer_count_m_k_group(seqfile.files, M, K, Num_Threads, Reverse)
+    return kmer_count_m_k(seqfile, M, K, Num_Threads, Reverse)
+
 def rev_comp(num, K):
     nuc_rc = 0
     for i in range(K):
@@ -25,11 +176,12 @@ def rev_comp(num, K):
     return nuc_rc
 
 def rev_count(count, K):
-    new_count = np.zeros_like(count)
-    for i in range(4**K):
-        rev = rev_comp(i, K)
-        new_count[i] = count[i] + count[rev]
-    return new_count
+    # Adds the counts of the reverse complement of every K-mer
+    codes = np.arange(4**K)
+    rev = np.zeros_like(codes)
+    for i in range(K):
+        rev |= (3 - ((codes >> (2*i)) & 3)) << (2*(K-i-1))
+    return count + count[rev]
 
 def check_count(seqfile, K_count):
     if K_count[0] == -1:
@@ -64,70 +216,273 @@ def get_sequences(seqfile):
     sequence_list.append(sequence)
     return seq_old_name_list, seq_new_name_list, sequence_list
 
+@staged('counting')
 def get_K(seqfile, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
     seq_count_K_p = count_pickle(seqfile, K, Reverse, P_dir)
-    if os.path.exists(seq_count_K_p):
+    if from_seq and (seqfile, K, Reverse) in Sequence_counts:
+        K_count = Sequence_counts[(seqfile, K, Reverse)]
+    elif os.path.exists(seq_count_K_p):
         K_count = np.load(seq_count_K_p)
+    elif Sampling is not None and not from_seq:
+        K_count, reads = count_subsample(seqfile, None, K, Num_Threads, Reverse)
+        if P_dir != 'None':
+            np.save(seq_count_K_p, K_count)
+            save_reads(seq_count_K_p, reads)
     else:
         #print('Counting kmers of %s.'%seqfile)
         if not Reverse or K>= 6:
             if from_seq:
-                K_count = np.copy(kmer_count_seq(sequence, K, Num_Threads, Reverse))
+                K_count = kmer_count_seq(sequence, K, Num_Threads, Reverse)
             else:
-                K_count = np.copy(kmer_count(seqfile, K, Num_Threads, Reverse))
+                K_count = count_file(seqfile, K, Num_Threads, Reverse)
             check_count(seqfile, K_count)
         else:
             if from_seq:
-                K_count = np.copy(kmer_count_seq(sequence, K, Num_Threads, False))
+                K_count = kmer_count_seq(sequence, K, Num_Threads, False)
             else:
-                K_count = np.copy(kmer_count(seqfile, K, Num_Threads, False))
+                K_count = count_file(seqfile, K, Num_Threads, False)
             check_count(seqfile, K_count)
             K_count = rev_count(K_count, K)   
         if P_dir != 'None':
             np.save(seq_count_K_p, K_count)
     return K_count
 
+@staged('counting')
 def get_M_K(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
     if M >= K:
         raise ValueError('Markovian order cannot be greater than K-2!') 
     seq_count_M_p = count_pickle(seqfile, M, Reverse, P_dir)
     seq_count_K_p = count_pickle(seqfile, K, Reverse, P_dir)
-    if os.path.exists(seq_count_M_p) and os.path.exists(seq_count_K_p):
+    if from_seq and (seqfile, M, Reverse) in Sequence_counts and (seqfile, K, Reverse) in Sequence_counts:
+        M_count = Sequence_counts[(seqfile, M, Reverse)]
+        K_count = Sequence_counts[(seqfile, K, Reverse)]
+    elif os.path.exists(seq_count_M_p) and os.path.exists(seq_count_K_p):
         M_count = np.load(seq_count_M_p)
         K_count = np.load(seq_count_K_p)
+    elif Sampling is not None and not from_seq:
+        count, reads = count_subsample(seqfile, M, K, Num_Threads, Reverse)
+        M_count = count[:4**M]
+        K_count = count[4**M:]
+        if P_dir != 'None':
+            np.save(seq_count_M_p, M_count)
+            np.save(seq_count_K_p, K_count)
+            save_reads(seq_count_M_p, reads)
+            save_reads(seq_count_K_p, reads)
     else:
         print('Counting kmers of %s.'%seqfile)
         if not Reverse or M>=6:
             if from_seq:
-                count = np.copy(kmer_count_m_k_seq(sequence, M, K, Num_Threads, Reverse))
+                count = kmer_count_m_k_seq(sequence, M, K, Num_Threads, Reverse)
             else:
-                count = np.copy(kmer_count_m_k(seqfile, M, K, Num_Threads, Reverse))
+                count = count_file_m_k(seqfile, M, K, Num_Threads, Reverse)
             check_count(seqfile, count) 
             M_count = count[:4**M]
             K_count = count[4**M:]
         else:
             if from_seq:
-                M_count = np.copy(kmer_count_seq(sequence, M, Num_Threads, False))
+                M_count = kmer_count_seq(sequence, M, Num_Threads, False)
             else:
-                M_count = np.copy(kmer_count(seqfile, M, Num_Threads, False))
+                M_count = count_file(seqfile, M, Num_Threads, False)
             check_count(seqfile, M_count)
             M_count = rev_count(M_count, M)
             if K>= 6:
                 if from_seq:
-                    K_count = np.copy(kmer_count_seq(sequence, K, Num_Threads, Reverse))
+                    K_count = kmer_count_seq(sequence, K, Num_Threads, Reverse)
                 else:
-                    K_count = np.copy(kmer_count(seqfile, K, Num_Threads, Reverse))
+                    K_count = count_file(seqfile, K, Num_Threads, Reverse)
             else:
                 if from_seq:
-                    K_count = np.copy(kmer_count_seq(sequence, K, Num_Threads, False)) 
+                    K_count = kmer_count_seq(sequence, K, Num_Threads, False) 
                 else:
-                    K_count = np.copy(kmer_count(seqfile, K, Num_Threads, False))
+                    K_count = count_file(seqfile, K, Num_Threads, False)
                 K_count = rev_count(K_count, K)
         if P_dir != 'None':
             np.save(seq_count_M_p, M_count)
             np.save(seq_count_K_p, K_count)
     return M_count, K_count
 
+@staged('counting')
+def count_files(seqname_list, M, K, Num_Threads, Reverse, P_dir, Prefetch=2):
+    # Count every file whose counts are not saved in P_dir yet with one pipelined counter,
+    # which reads up to Prefetch files ahead. M=None counts K-mers only. Samples of several
+    # files are left to get_K and get_M_K.
+    seqname_list = [seqfile for seqfile in seqname_list if not isinstance(seqfile, Sample)]
+    if M is None:
+        todo = [seqfile for seqfile in seqname_list if not os.path.exists(count_pickle(seqfile, K, Reverse, P_dir))]
+    else:
+        if M >= K:
+            raise ValueError('Markovian order cannot be greater than K-2!')
+        todo = [seqfile for seqfile in seqname_list if not (os.path.exists(count_pickle(seqfile, M, Reverse, P_dir)) and os.path.exists(count_pickle(seqfile, K, Reverse, P_dir)))]
+    def save(i, count):
+        seqfile = todo[i]
+        print('Counting kmers of %s.'%seqfile)
+        check_count(seqfile, count)
+        if M is None:
+            np.save(count_pickle(seqfile, K, Reverse, P_dir), count)
+        else:
+            np.save(count_pickle(seqfile, M, Reverse, P_dir), count[:4**M])
+            np.save(count_pickle(seqfile, K, Reverse, P_dir), count[4**M:])
+    if M is None:
+        kmer_count_files(todo, K, Num_Threads, Reverse, Prefetch, save)
+    else:
+        kmer_count_m_k_files(todo, M, K, Num_Threads, Reverse, Prefetch, save)
+
+@staged('counting')
+def count_sequences(seqname_list, sequence_list, M, K, Num_Threads, Reverse, P_dir):
+    # Counts all -s records whose counts are not saved in P_dir yet with one batch call and keeps
+    # them in Sequence_counts for get_K and get_M_K. M=None counts K-mers only.
+    if M is not None and M >= K:
+        raise ValueError('Markovian order cannot be greater than K-2!')
+    sizes = [K] if M is None else [M, K]
+    todo = [i for i, seqname in enumerate(seqname_list) if not all((seqname, k, Reverse) in Sequence_counts or os.path.exists(count_pickle(seqname, k, Reverse, P_dir)) for k in sizes)]
+    if not todo:
+        return
+    sequence = ''.join(sequence_list[i] for i in todo).encode()
+    offsets = np.cumsum([0] + [len(sequence_list[i]) for i in todo])
+    if M is None:
+        batch = kmer_count_batch(sequence, offsets, K, Num_Threads, Reverse)
+    else:
+        batch = kmer_count_m_k_batch(sequence, offsets, M, K, Num_Threads, Reverse)
+    for i, count in zip(todo, batch):
+        seqname = seqname_list[i]
+        check_count(seqname, count)
+        counts = [count] if M is None else [count[:4**M], count[4**M:]]
+        for k, k_count in zip(sizes, counts):
+            Sequence_counts[(seqname, k, Reverse)] = k_count
+            if P_dir != 'None':
+                np.save(count_pickle(seqname, k, Reverse, P_dir), k_count)
+
+def split_sizes(count, sizes):
+    # The tables of sizes laid out one after another by kmer_count_sizes_files and kmer_count_sizes_batch
+    ends = np.cumsum([4**k for k in sizes])
+    return np.split(count, ends[:-1])
+
+def sweep_sizes(methods, M, K_list):
+    # Kmer lengths of the counts the methods read for every K of a sweep
+    sizes = set()
+    for K in K_list:
+        if set(methods) & set(['d2star', 'd2shepp']):
+            sizes.update([M, K])
+        if 'cvtree' in methods:
+            sizes.update([K-1, K])
+        if set(methods) & set(['ma', 'eu', 'd2']):
+            sizes.add(K)
+    return sorted(k for k in sizes if k > 0)
+
+@staged('counting')
+def sweep_files(seqname_list, sizes, Num_Threads, Reverse, P_dir, Prefetch=2):
+    # Counts all kmer lengths of sizes of every file with one scan, for the files whose counts are
+    # not all saved in P_dir yet. Counts already saved are kept. Samples of several files are left
+    # to get_K and get_M_K.
+    seqname_list = [seqfile for seqfile in seqname_list if not isinstance(seqfile, Sample)]
+    todo = [seqfile for seqfile in seqname_list if not all(os.path.exists(count_pickle(seqfile, k, Reverse, P_dir)) for k in sizes)]
+    def save(i, count):
+        seqfile = todo[i]
+        print('Counting kmers of %s.'%seqfile)
+        check_count(seqfile, count)
+        for k, k_count in zip(sizes, split_sizes(count, sizes)):
+            seq_count_p = count_pickle(seqfile, k, Reverse, P_dir)
+            if not os.path.exists(seq_count_p):
+                np.save(seq_count_p, k_count)
+    kmer_count_sizes_files(todo, sizes, Num_Threads, Reverse, Prefetch, save)
+
+@staged('counting')
+def sweep_sequences(seqname_list, sequence_list, sizes, Num_Threads, Reverse, P_dir):
+    # Same as sweep_files for -s records, the counts are kept in Sequence_counts like count_sequences
+    todo = [i for i, seqname in enumerate(seqname_list) if not all((seqname, k, Reverse) in Sequence_counts or os.path.exists(count_pickle(seqname, k, Reverse, P_dir)) for k in sizes)]
+    if not todo:
+        return
+    sequence = ''.join(sequence_list[i] for i in todo).encode()
+    offsets = np.cumsum([0] + [len(sequence_list[i]) for i in todo])
+    batch = kmer_count_sizes_batch(sequence, offsets, sizes, Num_Threads, Reverse)
+    for i, count in zip(todo, batch):
+        seqname = seqname_list[i]
+        check_count(seqname, count)
+        for k, k_count in zip(sizes, split_sizes(count, sizes)):
+            seq_count_p = count_pickle(seqname, k, Reverse, P_dir)
+            if (seqname, k, Reverse) in Sequence_counts or os.path.exists(seq_count_p):
+                continue
+            Sequence_counts[(seqname, k, Reverse)] = k_count
+            if P_dir != 'None':
+                np.save(seq_count_p, k_count)
+
+def read_blocks(mm_list, seed):
+    # Blocks (file, start, end) of whole fasta records of all files in a random order,
+    # each record belongs to the block its '>' falls in
+    blocks = []
+    for i, mm in enumerate(mm_list):
+        size = len(mm)
+        block_size = min(1 << 20, max(1 << 12, size // 64))
+        starts = [0]
+        for offset in range(block_size, size, block_size):
+            start = mm.find(b'>', offset)
+            if start == -1:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+        blocks += zip([i] * len(starts), starts, starts[1:] + [size])
+    order = np.random.RandomState(seed).permutation(len(blocks))
+    return [blocks[j] for j in order]
+
+def count_subsample(seqfile, M, K, Num_Threads, Reverse):
+    # Counts random blocks of reads until the normalised K-mer frequencies change by less than
+    # Sampling.tolerance (L1) after the reads grew by another 10%, or Sampling.max_reads is reached.
+    # M=None counts K-mers only. Returns the counts and the number of reads counted. The blocks are
+    # counted on the forward strand only and the stop is decided on those counts, so the forward and
+    # the both-strand counts of a file come from the same reads, as d2shepp_bias and d2star_bias need.
+    check_members(seqfile)
+    mm_list = []
+    for filename in sample_files(seqfile):
+        with open(filename, 'rb') as f:
+            mm_list.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    count = None
+    reads = 0
+    checked_reads = 0
+    checked_freq = None
+    try:
+        blocks = read_blocks(mm_list, Sampling.seed)
+        for i, start, end in blocks:
+            block = mm_list[i][start:end]
+            sequence = re.sub(b'>[^\n]*', b'N', block).replace(b'\n', b'').replace(b'\r', b'')
+            if M is None:
+                block_count = kmer_count_seq(sequence, K, Num_Threads, False)
+            else:
+                block_count = kmer_count_m_k_seq(sequence, M, K, Num_Threads, False)
+            if block_count[0] == -1:
+                raise Exception('Sequence file %s is not in the correct fasta format!'%seqfile)
+            if count is None:
+                count = block_count.astype(np.int64)
+            else:
+                count += block_count
+            reads += max(block.count(b'>'), 1)
+            if Sampling.max_reads and reads >= Sampling.max_reads:
+                break
+            if Sampling.tolerance and reads >= 1.1 * checked_reads:
+                K_count = count if M is None else count[4**M:]
+                total = np.sum(K_count)
+                if total:
+                    freq = K_count / total
+                    if checked_freq is not None and np.abs(freq - checked_freq).sum() < Sampling.tolerance:
+                        break
+                    checked_reads = reads
+                    checked_freq = freq
+    finally:
+        for mm in mm_list:
+            mm.close()
+    print('Counted %d reads in %d of %d blocks of %s.'%(reads, blocks.index((i, start, end)) + 1, len(blocks), seqfile))
+    check_count(seqfile, count)
+    if Reverse:
+        if M is None:
+            count = rev_count(count, K)
+        else:
+            count = np.concatenate([rev_count(count[:4**M], M), rev_count(count[4**M:], K)])
+    return count.astype(np.int32), reads
+
+def save_reads(seq_count_p, reads):
+    # The number of reads behind subsampled counts, next to the counts
+    with open(seq_count_p[:-len('_cnt.npy')] + '_reads.txt', 'wt') as f:
+        f.write('%d\n'%reads)
+
 def get_transition(count_array):
     shape = len(count_array)
     transition_array = count_array.reshape(shape//4, 4)
@@ -136,19 +491,54 @@ def get_transition(count_array):
         transition_array[np.isnan(transition_array)] = 0
     return transition_array
 
+def transition_steps(trans, steps):
+    # The products of the transition probabilities of steps more nucleotides after every (M-1)-mer,
+    # one row per (M-1)-mer and one column per appended steps-mer
+    product = np.ones(trans.shape[0])
+    for _ in range(steps):
+        product = product.reshape(-1, trans.shape[0], 1) * trans[np.newaxis, :, :]
+    return product.reshape(trans.shape[0], -1)
+
+def expect_chunks(M_count, M, K, out):
+    # Fills out with the expected K-mer counts of the Markov chain of order M-1 chunk by chunk and
+    # yields the (start, stop) of each chunk as soon as it is written. The expectation of the first
+    # K-steps nucleotides is built once, each chunk multiplies a block of it by transition_steps.
+    trans = get_transition(M_count)
+    C = trans.shape[0]
+    steps = 1
+    while steps < K-M and C * 4**(steps+1) <= Expect_Chunk:
+        steps += 1
+    tail = transition_steps(trans, steps)
+    head = M_count
+    for _ in range(K-M-steps):
+        head = head.reshape(-1, C, 1) * trans[np.newaxis, :, :]
+    head = head.ravel()
+    block = C * max(1, Expect_Chunk // tail.size)
+    for start in range(0, len(head), block):
+        stop = min(start + block, len(head))
+        np.multiply(head[start:stop].reshape(-1, C, 1), tail[np.newaxis, :, :], out=out[start*tail.shape[1]:stop*tail.shape[1]].reshape(-1, C, tail.shape[1]))
+        yield start*tail.shape[1], stop*tail.shape[1]
+
+def expect_feature(M_count, K_count, M, K, expression, out):
+    # Writes expression of the counts k and the expected counts e into out chunk by chunk, NaNs
+    # become 0, and returns the sum of squares of out
+    norm = 0.0
+    for start, stop in expect_chunks(M_count, M, K, out):
+        f = out[start:stop]
+        ne.evaluate(expression, local_dict={'k': K_count[start:stop], 'e': f}, out=f)
+        f[np.isnan(f)] = 0
+        norm += ne.evaluate('sum(f * f)')
+    return norm
+
 def get_expect(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
     M_count, K_count = get_M_K(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
     seqfile_e_p = os.path.join(P_dir, os.path.basename(seqfile) + '.%s_M%d_K%d_e.npy'%('R' if Reverse else 'NR', M-1, K))
     if os.path.exists(seqfile_e_p):
         expect = np.load(seqfile_e_p)
     else:
-        trans = get_transition(M_count)
-        expect = M_count
-        for _ in range(K-M):
-            #trans = np.tile(trans, (4, 1))
-            #expect = (expect[:,np.newaxis] * trans).flatten()
-            expect = expect.reshape(-1, trans.shape[0], 1) * trans[np.newaxis, :, :]
-        expect = expect.ravel()
+        expect = np.empty(4**K)
+        for _ in expect_chunks(M_count, M, K, expect):
+            pass
         if P_dir != 'None':
             np.save(seqfile_e_p, expect)
     return K_count, expect
@@ -175,13 +565,11 @@ def get_expect_reverse(seqfile, M, K, Num_Threads, P_dir, sequence = '', from_se
     M_count = b_M_count - a_M_count
     del a_M_count
     del b_M_count
-    ne.evaluate('b_K_count - a_K_count', out=b_K_count)
+    b_K_count = ne.evaluate('b_K_count - a_K_count')
     del a_K_count
-    trans = get_transition(M_count)
-    expect = M_count
-    for _ in range(K-M):
-        expect = expect.reshape(-1, trans.shape[0], 1) * trans[np.newaxis, :, :]
-    expect = expect.ravel()
+    expect = np.empty(4**K)
+    for _ in expect_chunks(M_count, M, K, expect):
+        pass
     return b_K_count, expect
 
 def BIC(seqfile, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
@@ -223,39 +611,81 @@ def get_d2star_f_deprecated(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence
             np.save(seqfile_f_p, d2star_f)
     return d2star_f
 '''
-def get_d2star_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
+def projection_size(N, tolerance):
+    # Johnson-Lindenstrauss bound: the squared distances of N unit vectors, and so the d2star and
+    # CVTree distances, keep a relative error below tolerance with high probability
+    from sklearn.random_projection import johnson_lindenstrauss_min_dim
+    return max(1, int(johnson_lindenstrauss_min_dim(max(N, 2), eps=tolerance)))
+
+def get_projector(K):
+    # Sparse random projection of Li et al.: each of the 4**K x dim entries is +-sqrt(s/dim) with
+    # probability 1/s and 0 otherwise, s = 2**K. Rare repeated positions are dropped.
+    from scipy.sparse import csr_matrix
+    key = (K,) + tuple(Approximate)
+    if key not in Projectors:
+        D = 4**K
+        dim = Approximate.dim
+        s = 2.0**K
+        random_state = np.random.RandomState(Approximate.seed)
+        flat = np.unique(random_state.randint(0, D*dim, random_state.binomial(D*dim, 1/s), dtype=np.int64))
+        data = np.where(random_state.rand(len(flat)) < 0.5, -1.0, 1.0) * np.sqrt(s/dim)
+        Projectors[key] = csr_matrix((data, (flat // dim, flat % dim)), shape=(D, dim)).T.tocsr()
+    return Projectors[key]
+
+def feature_size(K, project):
+    return Approximate.dim if project and Approximate is not None else 4**K
+
+def unit_vector(f):
+    return f / np.sqrt(np.sum(f**2))
+
+def get_projected_f(seqfile, name, M, K, Reverse, P_dir, get_f):
+    # Only the projection is saved, get_f computes the full feature when it is not
+    seqfile_p_p = os.path.join(P_dir, os.path.basename(seqfile) + '.%s_M%d_K%d_%s_proj%d_seed%d.npy'%(('R' if Reverse else 'NR', M-1, K, name) + tuple(Approximate)))
+    if os.path.exists(seqfile_p_p):
+        return np.load(seqfile_p_p)
+    projected_f = get_projector(K) @ get_f()
+    if P_dir != 'None':
+        np.save(seqfile_p_p, projected_f)
+    return projected_f
+
+def get_d2star_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False, save=True, out=None):
+    # out: the feature is written into it, e.g. a row of the feature matrix
     seqfile_f_p = os.path.join(P_dir, os.path.basename(seqfile) + '.%s_M%d_K%d_d2star_f.npy'%('R' if Reverse else 'NR', M-1, K))
+    d2star_f = np.empty(4**K) if out is None else out
     if os.path.exists(seqfile_f_p):
-        d2star_f = np.load(seqfile_f_p)
+        d2star_f[:] = np.load(seqfile_f_p)
     else:
-        K_count, expect = get_expect(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
-        d2star_f = ne.evaluate("(K_count-expect)/sqrt(expect)")
-        d2star_f[np.isnan(d2star_f)]=0
-        denom = np.sqrt(ne.evaluate("sum(d2star_f * d2star_f)"))
-        d2star_f = ne.evaluate("d2star_f / denom")
-        if P_dir != 'None':
+        M_count, K_count = get_M_K(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+        denom = np.sqrt(expect_feature(M_count, K_count, M, K, '(k-e)/sqrt(e)', d2star_f))
+        ne.evaluate("d2star_f / denom", out=d2star_f)
+        if P_dir != 'None' and save:
             np.save(seqfile_f_p, d2star_f)
     return d2star_f
 
+@staged('features')
 def get_d2star_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False):
     N = len(seqname_list)
-    f_matrix = np.ones((N, 4**K))
+    f_matrix = np.ones((N, feature_size(K, True)))
     for i in range(N):
         if from_seq:
             sequence = sequence_list[i]
         else:
             sequence = ''
         seqfile = seqname_list[i]
-        f_matrix[i] = get_d2star_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+        if Approximate is None:
+            get_d2star_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq, out=f_matrix[i])
+        else:
+            f_matrix[i] = get_projected_f(seqfile, 'd2star', M, K, Reverse, P_dir, lambda: get_d2star_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq, save=False))
     return f_matrix
 
-def get_d2shepp_diff(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
+def get_d2shepp_diff(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False, out=None):
     seqfile_f_p = os.path.join(P_dir, os.path.basename(seqfile) + '.%s_M%d_K%d_d2shepp_diff.npy'%('R' if Reverse else 'NR', M-1, K))
+    d2shepp_diff = np.empty(4**K) if out is None else out
     if os.path.exists(seqfile_f_p):
-        d2shepp_diff = np.load(seqfile_f_p)
+        d2shepp_diff[:] = np.load(seqfile_f_p)
     else:
-        K_count, d2shepp_diff = get_expect(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
-        ne.evaluate('K_count-d2shepp_diff', out=d2shepp_diff)
+        M_count, K_count = get_M_K(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+        expect_feature(M_count, K_count, M, K, 'k-e', d2shepp_diff)
         if P_dir != 'None':
             np.save(seqfile_f_p, d2shepp_diff)
     return d2shepp_diff
@@ -274,47 +704,60 @@ def get_CVTree_f_deprecated(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence
             np.save(seqfile_f_p, CVTree_f)
     return CVTree_f   
 '''
-def get_CVTree_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
+def get_CVTree_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False, save=True, out=None):
     M = K - 1
     seqfile_f_p = os.path.join(P_dir, os.path.basename(seqfile) + '.%s_M%d_K%d_CVTree_f.npy'%('R' if Reverse else 'NR', M-1, K))
+    CVTree_f = np.empty(4**K) if out is None else out
     if os.path.exists(seqfile_f_p):
-        CVTree_f = np.load(seqfile_f_p)
+        CVTree_f[:] = np.load(seqfile_f_p)
     else:
-        K_count, expect = get_expect(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
-        CVTree_f = ne.evaluate("(K_count-expect)/expect")
-        CVTree_f[np.isnan(CVTree_f)]=0
-        denom = np.sqrt(ne.evaluate("sum(CVTree_f * CVTree_f)"))
-        CVTree_f = ne.evaluate("CVTree_f / denom")
-        if P_dir != 'None':
+        M_count, K_count = get_M_K(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+        denom = np.sqrt(expect_feature(M_count, K_count, M, K, '(k-e)/e', CVTree_f))
+        ne.evaluate("CVTree_f / denom", out=CVTree_f)
+        if P_dir != 'None' and save:
             np.save(seqfile_f_p, CVTree_f)
     return CVTree_f
 
+@staged('features')
 def get_CVTree_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False):
     N = len(seqname_list)
-    f_matrix = np.ones((N, 4**K))
+    f_matrix = np.ones((N, feature_size(K, True)))
     for i in range(N):
         if from_seq:
             sequence = sequence_list[i]
         else:
             sequence = ''
         seqfile = seqname_list[i]
-        f_matrix[i] = get_CVTree_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+        if Approximate is None:
+            get_CVTree_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq, out=f_matrix[i])
+        else:
+            f_matrix[i] = get_projected_f(seqfile, 'CVTree', K-1, K, Reverse, P_dir, lambda: get_CVTree_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq, save=False))
     return f_matrix
 
-def get_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False):
+def get_frequency(seqfile, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
+    a_K = get_K(seqfile, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+    return a_K/np.sum(a_K)
+
+@staged('features')
+def get_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, project=False):
+    # project: the d2 features may be projected, the Ma and Eu ones may not
     N = len(seqname_list)
-    f_matrix = np.ones((N, 4**K))
+    f_matrix = np.ones((N, feature_size(K, project)))
     for i in range(N):
         if from_seq:
             sequence = sequence_list[i]
         else:
             sequence = ''
         seqfile = seqname_list[i]
+        if project and Approximate is not None:
+            f_matrix[i] = get_projected_f(seqfile, 'd2unit', 1, K, Reverse, P_dir, lambda: unit_vector(get_frequency(seqfile, K, Num_Threads, Reverse, P_dir, sequence, from_seq)))
+            continue
         a_K = get_K(seqfile, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
         #f_matrix[i] = a_K/np.sum(a_K)
         np.divide(a_K, np.sum(a_K), out=f_matrix[i])
     return f_matrix
 
+@staged('features')
 def get_all_diff(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False):
     N = len(seqname_list)
     diff_matrix = np.ones((N, 4**K))
@@ -324,7 +767,7 @@ def get_all_diff(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list
         else:
             sequence = ''
         seqfile = seqname_list[i]
-        diff_matrix[i] = get_d2shepp_diff(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+        get_d2shepp_diff(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq, out=diff_matrix[i])
         #a_K_count, a_expect = get_expect(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
         #a_diff = a_K_count - a_expect
         #diff_matrix[i] = a_diff
@@ -339,6 +782,73 @@ def get_all_K(sequence_list, M, K, Num_Threads, Reverse, P_dir):
         K_matrix[i] = K_count/np.sum(K_count)
     return K_matrix
 '''
+def checkpoint_key(*args):
+    digest = hashlib.sha1()
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            digest.update(np.ascontiguousarray(arg).tobytes())
+        else:
+            digest.update(repr(arg).encode())
+    return digest.hexdigest()
+
+def checkpoint_load(checkpoint, key, shape):
+    # Returns the saved result and the number of finished rows, or a fresh result.
+    if checkpoint is not None and checkpoint.resume and os.path.exists(checkpoint.filename):
+        with np.load(checkpoint.filename) as state:
+            if str(state['key']) == key and state['result'].shape == shape:
+                print('Resuming from row %d of %s.'%(state['done'], checkpoint.filename))
+                return state['result'], int(state['done'])
+    return np.zeros(shape), 0
+
+def checkpoint_save(checkpoint, key, result, done, last_save, rows=None):
+    # Saves at most once per interval unless the result is finished, returns the time of the last save.
+    # rows is the number of rows of a condensed result.
+    if rows is None:
+        rows = len(result)
+    if checkpoint is None or (done < rows and time.time() - last_save < checkpoint.interval):
+        return last_save
+    temp = checkpoint.filename + '.tmp'
+    with open(temp, 'wb') as f:
+        np.savez(f, key=key, result=result, done=done)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, checkpoint.filename)
+    return time.time()
+
+# Pairwise results keep only the upper triangle of the symmetric N x N matrix, row by row like
+# scipy's pdist: pair (i, j), i < j, is at condensed_start(N, i) + j - i - 1.
+def condensed_size(N):
+    return N * (N - 1) // 2
+
+def condensed_start(N, i):
+    return i * N - i * (i + 1) // 2
+
+def condensed_row(condensed, N, i):
+    # Row i of the square matrix, with 0 on the diagonal
+    row = np.zeros(N)
+    j = np.arange(i)
+    row[:i] = condensed[condensed_start(N, j) + i - j - 1]
+    row[i+1:] = condensed[condensed_start(N, i):condensed_start(N, i+1)]
+    return row
+
+def condensed_pairs(N, start, stop):
+    # Rows and columns of the condensed positions start..stop-1
+    k = np.arange(start, stop)
+    i = np.searchsorted(condensed_start(N, np.arange(N)), k, side='right') - 1
+    return i, k - condensed_start(N, i) + i + 1
+
+def condensed_matrix(f_matrix, metric):
+    # metric(f1_matrix, f2_matrix) of a few rows against the rows after them at a time
+    N = f_matrix.shape[0] if hasattr(f_matrix, 'shape') else len(f_matrix)
+    condensed = np.zeros(condensed_size(N))
+    step = max(1, Chunk_Size // max(N, 1))
+    for start in range(0, N, step):
+        stop = min(start + step, N)
+        block = metric(f_matrix[start:stop], f_matrix[start:])
+        for i in range(start, stop):
+            condensed[condensed_start(N, i):condensed_start(N, i+1)] = block[i-start, i-start+1:]
+    return condensed
+
 def cosine(a, b):
     num = ne.evaluate("sum(a * b)") 
     denom = np.sqrt(ne.evaluate("sum(a ** 2)") * ne.evaluate("sum(b ** 2)"))
@@ -459,28 +969,17 @@ def d2shepp_bias(seqfile, M, K, Num_Threads, P_dir, sequence = '', from_seq=Fals
 
 def d2shepp_bias(seqfile, M, K, Num_Threads, P_dir, sequence = '', from_seq=False):
     a_M_count, a_K_count = get_M_K(seqfile, M, K, Num_Threads, False, 'None', sequence, from_seq)
-    seqfile_e_p = os.path.join(P_dir, os.path.basename(seqfile) + '.%s_M%d_K%d_e.npy'%('NR', M-1, K))
-    if os.path.exists(seqfile_e_p):
-        a_diff = np.load(seqfile_e_p)
-    else:
-        trans = get_transition(a_M_count)
-        a_diff = a_M_count
-        for _ in range(K-M):
-            a_diff = a_diff.reshape(-1, trans.shape[0], 1) * trans[np.newaxis, :, :]
-        a_diff = a_diff.ravel()
-        ne.evaluate("a_K_count - a_diff", out=a_diff)
+    a_diff = np.empty(4**K)
+    expect_feature(a_M_count, a_K_count, M, K, 'k-e', a_diff)
          
     b_M_count, b_K_count = get_M_K(seqfile, M, K, Num_Threads, True, P_dir, sequence, from_seq)
-    ne.evaluate('b_K_count-a_K_count', out=b_K_count)
+    # a new array, b_K_count may be the one kept in Sequence_counts
+    b_K_count = ne.evaluate('b_K_count-a_K_count')
     del a_K_count
-    ne.evaluate('b_M_count-a_M_count', out=b_M_count)
+    b_M_count = ne.evaluate('b_M_count-a_M_count')
     del a_M_count
-    trans = get_transition(b_M_count)
-    b_diff = b_M_count
-    for _ in range(K-M):
-        b_diff = b_diff.reshape(-1, trans.shape[0], 1) * trans[np.newaxis, :, :]
-    b_diff = b_diff.ravel()
-    ne.evaluate("b_K_count - b_diff", out=b_diff)
+    b_diff = np.empty(4**K)
+    expect_feature(b_M_count, b_K_count, M, K, 'k-e', b_diff)
 
     del b_K_count
     del b_M_count
@@ -511,36 +1010,24 @@ def d2star_bias(seqfile, M, K, Num_Threads, P_dir, sequence = '', from_seq=False
 
 def d2star_bias(seqfile, M, K, Num_Threads, P_dir, sequence = '', from_seq=False):
     a_M_count, a_K_count = get_M_K(seqfile, M, K, Num_Threads, False, 'None', sequence, from_seq)
-    seqfile_e_p = os.path.join(P_dir, os.path.basename(seqfile) + '.%s_M%d_K%d_e.npy'%('NR', M-1, K))
-    if os.path.exists(seqfile_e_p):
-        a_diff = np.load(seqfile_e_p)
-    else:
-        trans = get_transition(a_M_count)
-        a_diff = a_M_count
-        for _ in range(K-M):
-            a_diff = a_diff.reshape(-1, trans.shape[0], 1) * trans[np.newaxis, :, :]
-        a_diff = a_diff.ravel()
-        ne.evaluate("(a_K_count-a_diff)/sqrt(a_diff)", out=a_diff)
+    a_diff = np.empty(4**K)
+    expect_feature(a_M_count, a_K_count, M, K, '(k-e)/sqrt(e)', a_diff)
 
     b_M_count, b_K_count = get_M_K(seqfile, M, K, Num_Threads, True, P_dir, sequence, from_seq)
-    ne.evaluate('b_K_count-a_K_count', out=b_K_count)
+    # a new array, b_K_count may be the one kept in Sequence_counts
+    b_K_count = ne.evaluate('b_K_count-a_K_count')
     del a_K_count
-    ne.evaluate('b_M_count-a_M_count', out=b_M_count)
+    b_M_count = ne.evaluate('b_M_count-a_M_count')
     del a_M_count
-    trans = get_transition(b_M_count)
-    b_diff = b_M_count
-    for _ in range(K-M):
-        b_diff = b_diff.reshape(-1, trans.shape[0], 1) * trans[np.newaxis, :, :]
-    b_diff = b_diff.ravel()
-    ne.evaluate("(b_K_count-b_diff)/sqrt(b_diff)", out=b_diff)
+    b_diff = np.empty(4**K)
+    expect_feature(b_M_count, b_K_count, M, K, '(k-e)/sqrt(e)', b_diff)
 
     del b_K_count
     del b_M_count
-    a_diff[np.isnan(a_diff)]=0
-    b_diff[np.isnan(b_diff)]=0
     return 0.5 * cosine(a_diff, b_diff)
 
 def cosine_matrix(f1_matrix, f2_matrix=None):
+    from sklearn.metrics.pairwise import cosine_similarity
     if f2_matrix is not None:
         matrix = 0.5 * (1 - cosine_similarity(f1_matrix, f2_matrix))
     else:
@@ -550,6 +1037,7 @@ def cosine_matrix(f1_matrix, f2_matrix=None):
     return matrix
 
 def dot_matrix(f1_matrix, f2_matrix=None):
+    from sklearn.utils.extmath import safe_sparse_dot
     if f2_matrix is not None:
         matrix = 0.5 * (1 - safe_sparse_dot(f1_matrix, f2_matrix.T))
     else:
@@ -558,7 +1046,21 @@ def dot_matrix(f1_matrix, f2_matrix=None):
         np.fill_diagonal(matrix, 0)
     return matrix
 
+def projected_matrix(f1_matrix, f2_matrix=None):
+    # 0.25*|Pu-Pv|**2 of the projected unit features, the 0.5*(1-<u,v>) of dot_matrix before the
+    # projection. The Johnson-Lindenstrauss bound holds for squared distances, not for <Pu,Pv>.
+    from sklearn.metrics.pairwise import euclidean_distances
+    matrix = 0.25 * euclidean_distances(f1_matrix, f2_matrix, squared=True)
+    if f2_matrix is None:
+        np.fill_diagonal(matrix, 0)
+    return matrix
+
+def projected_metric(metric):
+    # The d2star, CVTree and d2 metric of features that may be projected, the d2 ones are unit vectors then
+    return metric if Approximate is None else projected_matrix
+
 def Ma_matrix(f1_matrix, f2_matrix=None):
+    from sklearn.metrics.pairwise import manhattan_distances
     if f2_matrix is not None:
         matrix = manhattan_distances(f1_matrix, f2_matrix)
     else:
@@ -568,6 +1070,7 @@ def Ma_matrix(f1_matrix, f2_matrix=None):
     return matrix
 
 def Eu_matrix(f1_matrix, f2_matrix=None):
+    from sklearn.metrics.pairwise import euclidean_distances
     if f2_matrix is not None:
         matrix = euclidean_distances(f1_matrix, f2_matrix)
     else:
@@ -576,66 +1079,75 @@ def Eu_matrix(f1_matrix, f2_matrix=None):
         np.fill_diagonal(matrix, 0)
     return matrix
  
-def dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, method = None):
+def dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, method = None, checkpoint=None):
     #print('Slow mode')
     N = len(seqname_list)
-    matrix = np.zeros((N, N))
+    key = checkpoint_key('pairwise', method.__name__, seqname_list, M, K, Reverse, from_seq)
+    matrix, start = checkpoint_load(checkpoint, key, (condensed_size(N),))
+    last_save = time.time()
     sequence_1 = ''
     sequence_2 = ''
-    for i in range(N):
+    for i in range(start, N):
         if from_seq:
             sequence_1 = sequence_list[i]
         seqfile_1 = seqname_list[i]
+        k = condensed_start(N, i)
         for j in range(i+1, N):
             if from_seq:
                 sequence_2 = sequence_list[j]
             seqfile_2 = seqname_list[j]
-            matrix[i][j] = method(seqfile_1, seqfile_2, M, K, Num_Threads, Reverse, P_dir, sequence_1, sequence_2, from_seq)
-            matrix[j][i] = matrix[i][j]
+            matrix[k] = method(seqfile_1, seqfile_2, M, K, Num_Threads, Reverse, P_dir, sequence_1, sequence_2, from_seq)
+            k += 1
+        last_save = checkpoint_save(checkpoint, key, matrix, i+1, last_save, N)
     return matrix
 
-def d2star_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False):
+def d2star_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
         f_matrix = get_d2star_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
-        return dot_matrix(f_matrix)
+        return condensed_matrix(f_matrix, projected_metric(dot_matrix))
     else:
-        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = d2star)
+        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = d2star, checkpoint = checkpoint)
 
-def CVTree_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False):
+def CVTree_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
         f_matrix = get_CVTree_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
-        return dot_matrix(f_matrix)
+        return condensed_matrix(f_matrix, projected_metric(dot_matrix))
     else:
-        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = CVTree)
+        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = CVTree, checkpoint = checkpoint)
 
-def d2_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False):
+def d2_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
-        f_matrix = get_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
-        return cosine_matrix(f_matrix)
+        f_matrix = get_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, project=True)
+        return condensed_matrix(f_matrix, projected_metric(cosine_matrix))
     else:
-        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = d2)
+        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = d2, checkpoint = checkpoint)
 
-def Ma_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False):
+def Ma_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
         f_matrix = get_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
-        return Ma_matrix(f_matrix)
+        return condensed_matrix(f_matrix, Ma_matrix)
     else:
-        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = Ma)
+        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = Ma, checkpoint = checkpoint)
 
-def Eu_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False):
+def Eu_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
         f_matrix = get_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
-        return Eu_matrix(f_matrix)
+        return condensed_matrix(f_matrix, Eu_matrix)
     else:
-        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = Eu)
+        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = Eu, checkpoint = checkpoint)
 
-def d2shepp_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False):
+def d2shepp_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
-        diff_matrix = get_all_diff(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq) 
         N = len(seqname_list)
-        matrix = np.zeros((N, N))  
-        for i in range(N):
+        key = checkpoint_key('pairwise', 'd2shepp', seqname_list, M, K, Reverse, from_seq)
+        matrix, start = checkpoint_load(checkpoint, key, (condensed_size(N),))
+        if start == N:
+            return matrix
+        last_save = time.time()
+        diff_matrix = get_all_diff(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq) 
+        for i in range(start, N):
             a_diff = diff_matrix[i]
+            k = condensed_start(N, i)
             for j in range(i+1, N):
                 b_diff = diff_matrix[j]
                 denom = ne.evaluate("(a_diff**2 + b_diff**2)**0.25")
@@ -643,20 +1155,23 @@ def d2shepp_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, seq
                 a_f[np.isnan(a_f)]=0
                 b_f = ne.evaluate("b_diff/denom")
                 b_f[np.isnan(b_f)]=0 
-                matrix[i][j] = 0.5 * cosine(a_f, b_f)
-                matrix[j][i] = matrix[i][j]
+                matrix[k] = 0.5 * cosine(a_f, b_f)
+                k += 1
+            last_save = checkpoint_save(checkpoint, key, matrix, i+1, last_save, N)
         return matrix 
     else:
-        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = d2shepp)
+        return dist_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq, method = d2shepp, checkpoint = checkpoint)
  
-def dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, method=None):
+def dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, method=None, checkpoint=None):
     #print('Slow mode')
     N1 = len(seqname_list_1)
     N2 = len(seqname_list_2)
-    matrix = np.zeros((N1, N2))
+    key = checkpoint_key('groupwise', method.__name__, seqname_list_1, seqname_list_2, M, K, Reverse, from_seq)
+    matrix, start = checkpoint_load(checkpoint, key, (N1, N2))
+    last_save = time.time()
     sequence_1 = ''
     sequence_2 = ''
-    for i in range(N1):
+    for i in range(start, N1):
         if from_seq:
             sequence_1 = sequence_list_1[i]
         seqfile_1 = seqname_list_1[i]
@@ -665,56 +1180,61 @@ def dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Rev
                 sequence_2 = sequence_list_2[j]
             seqfile_2 = seqname_list_2[j]
             matrix[i][j] = method(seqfile_1, seqfile_2, M, K, Num_Threads, Reverse, P_dir, sequence_1, sequence_2, from_seq)
+        last_save = checkpoint_save(checkpoint, key, matrix, i+1, last_save)
     return matrix
 
-def d2star_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False):
+def d2star_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
         f1_matrix = get_d2star_all_f(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq)
         f2_matrix = get_d2star_all_f(seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_2, from_seq)
-        return dot_matrix(f1_matrix, f2_matrix)
+        return projected_metric(dot_matrix)(f1_matrix, f2_matrix)
     else:
-        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = d2star)
+        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = d2star, checkpoint = checkpoint)
 
-def CVTree_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False):
+def CVTree_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
         f1_matrix = get_CVTree_all_f(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq)
         f2_matrix = get_CVTree_all_f(seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_2, from_seq)
-        return dot_matrix(f1_matrix, f2_matrix)
+        return projected_metric(dot_matrix)(f1_matrix, f2_matrix)
     else:
-        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = CVTree)
+        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = CVTree, checkpoint = checkpoint)
 
-def d2_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False):
+def d2_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
-        f1_matrix = get_all_f(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq)
-        f2_matrix = get_all_f(seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_2, from_seq)
-        return cosine_matrix(f1_matrix, f2_matrix)
+        f1_matrix = get_all_f(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq, project=True)
+        f2_matrix = get_all_f(seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_2, from_seq, project=True)
+        return projected_metric(cosine_matrix)(f1_matrix, f2_matrix)
     else:
-        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = d2)
+        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = d2, checkpoint = checkpoint)
 
-def Ma_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False):
+def Ma_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
         f1_matrix = get_all_f(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq)
         f2_matrix = get_all_f(seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_2, from_seq)
         return Ma_matrix(f1_matrix, f2_matrix)
     else:
-        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = Ma)
+        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = Ma, checkpoint = checkpoint)
 
-def Eu_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False):
+def Eu_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
         f1_matrix = get_all_f(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq)
         f2_matrix = get_all_f(seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_2, from_seq)
         return Eu_matrix(f1_matrix, f2_matrix)
     else:
-        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = Eu)
+        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = Eu, checkpoint = checkpoint)
 
-def d2shepp_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False):
+def d2shepp_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
     if not slow:
-        a_diff_matrix = get_all_diff(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq)
-        b_diff_matrix = get_all_diff(seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_2, from_seq) 
         N1 = len(seqname_list_1)
         N2 = len(seqname_list_2)
-        matrix = np.zeros((N1, N2))
-        for i in range(N1):
+        key = checkpoint_key('groupwise', 'd2shepp', seqname_list_1, seqname_list_2, M, K, Reverse, from_seq)
+        matrix, start = checkpoint_load(checkpoint, key, (N1, N2))
+        if start == N1:
+            return matrix
+        last_save = time.time()
+        a_diff_matrix = get_all_diff(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq)
+        b_diff_matrix = get_all_diff(seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_2, from_seq) 
+        for i in range(start, N1):
             a_diff = a_diff_matrix[i]
             for j in range(N2):
                 b_diff = b_diff_matrix[j]
@@ -724,45 +1244,85 @@ def d2shepp_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads,
                 b_f = ne.evaluate("b_diff/denom")
                 b_f[np.isnan(b_f)]=0 
                 matrix[i][j] = 0.5 * cosine(a_f, b_f)
+            last_save = checkpoint_save(checkpoint, key, matrix, i+1, last_save)
         return matrix
     else:
-        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = d2shepp)
+        return dist_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, method = d2shepp, checkpoint = checkpoint)
 
-def bias_array(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, method = None):
+def bias_array(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, method = None, checkpoint=None):
     N = len(seqname_list)
-    array = np.zeros(N)
+    key = checkpoint_key('bias', method.__name__, seqname_list, M, K, from_seq)
+    array, start = checkpoint_load(checkpoint, key, (N,))
+    last_save = time.time()
     sequence = ''
-    for i in range(N):
+    for i in range(start, N):
         if from_seq:
             sequence = sequence_list[i]
         seqfile = seqname_list[i]
         array[i] = method(seqfile, M, K, Num_Threads, P_dir, sequence, from_seq)
+        last_save = checkpoint_save(checkpoint, key, array, i+1, last_save)
     return array
 
 d2shepp_bias_array = partial(bias_array, method = d2shepp_bias)
 d2star_bias_array = partial(bias_array, method = d2star_bias)
 
 def bias_adjust(dist, bias_1, bias_2, model):
-    sim_1 = (0.5-bias_1)*2
-    sim_2 = (0.5-bias_2)*2
-    sim = (0.5-dist)*2
-    return (1-model.predict([[sim, sim_1, sim_2]])[0])/2
-
-def matrix_adjusted_pairwise(matrix, bias_array, method):
-    new_matrix = np.zeros_like(matrix)
-    row = matrix.shape[0]
+    # dist, bias_1 and bias_2 are broadcast against each other
+    sim_1 = (0.5-np.asarray(bias_1))*2
+    sim_2 = (0.5-np.asarray(bias_2))*2
+    sim = (0.5-np.asarray(dist))*2
+    X = np.stack(np.broadcast_arrays(sim, sim_1, sim_2), -1).reshape(-1, 3)
+    return (1-model.predict(X))/2
+
+def matrix_adjusted_grid(matrix, bias_array_1, bias_array_2, method, grid, chunk=1024):
+    from model import grid_MLPR
+    model = grid_MLPR(method, grid)
+    print('Adjusting %s with a %d^3 lookup grid, max error %.2e against the exact model.'%(method, grid, model.max_error))
+    new_matrix = np.empty_like(matrix)
+    sim_1 = (0.5-np.asarray(bias_array_1))*2
+    sim_2 = (0.5-np.asarray(bias_array_2))*2
+    if matrix.ndim == 1:
+        # condensed pairwise result
+        N = len(sim_1)
+        for start in range(0, len(matrix), chunk * N):
+            stop = min(start + chunk * N, len(matrix))
+            i, j = condensed_pairs(N, start, stop)
+            new_matrix[start:stop] = (1-model.interpolate((0.5-matrix[start:stop])*2, sim_1[i], sim_2[j]))/2
+        return new_matrix
+    for start in range(0, matrix.shape[0], chunk):
+        stop = start + chunk
+        sim = (0.5-matrix[start:stop])*2
+        new_matrix[start:stop] = (1-model.interpolate(sim, sim_1[start:stop, np.newaxis], sim_2[np.newaxis, :]))/2
+    return new_matrix
+
+def matrix_adjusted_pairwise(matrix, bias_array, method, checkpoint=None, grid=0):
+    # matrix is a condensed pairwise result, so is the adjusted one
+    if grid:
+        return matrix_adjusted_grid(matrix, bias_array, bias_array, method, grid)
+    key = checkpoint_key('adjusted', method, matrix, bias_array)
+    new_matrix, start = checkpoint_load(checkpoint, key, matrix.shape)
+    last_save = time.time()
+    from model import padding_MLPR
+    row = len(bias_array)
+    bias_array = np.asarray(bias_array)
     model = padding_MLPR(method)
-    for i in range(row):
-        for j in range(i+1, row):
-            new_matrix[i][j] = bias_adjust(matrix[i][j], bias_array[i], bias_array[j], model)
-            new_matrix[j][i] = new_matrix[i][j]
+    for i in range(start, row):
+        k = condensed_start(row, i)
+        new_matrix[k:k+row-i-1] = bias_adjust(matrix[k:k+row-i-1], bias_array[i], bias_array[i+1:], model)
+        last_save = checkpoint_save(checkpoint, key, new_matrix, i+1, last_save, row)
     return new_matrix
 
-def matrix_adjusted_groupwise(matrix, bias_array_1, bias_array_2, method):
-    new_matrix = np.zeros_like(matrix)
+def matrix_adjusted_groupwise(matrix, bias_array_1, bias_array_2, method, checkpoint=None, grid=0):
+    if grid:
+        return matrix_adjusted_grid(matrix, bias_array_1, bias_array_2, method, grid)
+    key = checkpoint_key('adjusted', method, matrix, bias_array_1, bias_array_2)
+    new_matrix, start = checkpoint_load(checkpoint, key, matrix.shape)
+    last_save = time.time()
+    from model import padding_MLPR
     row, col = matrix.shape
+    bias_array_2 = np.asarray(bias_array_2)
     model = padding_MLPR(method)
-    for i in range(row):
-        for j in range(col):
-            new_matrix[i][j] = bias_adjust(matrix[i][j], bias_array_1[i], bias_array_2[j], model)
+    for i in range(start, row):
+        new_matrix[i] = bias_adjust(matrix[i], bias_array_1[i], bias_array_2, model)
+        last_save = checkpoint_save(checkpoint, key, new_matrix, i+1, last_save)
     return new_matrix
@@ -1,21 +1,40 @@
 import numpy as np
-from sklearn.neural_network import MLPRegressor
-from sklearn.base import BaseEstimator, TransformerMixin
+import hashlib
+import zipfile
+import os
 
-class padding_MLPR(BaseEstimator, TransformerMixin):
+# The adjustment networks are shipped as one float64 array per method, model/<method>_mlp.npy, which
+# is memory-mapped and evaluated with numpy. For H hidden units it has shape (5, H+1): rows 0-2 hold
+# the input weights and row 3 the intercepts of the hidden units, row 4 the output weights followed
+# by the output intercept.
+Model_Dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model')
+
+def pack(coefs, intercepts):
+    # The coefs_ and intercepts_ of a fitted MLPRegressor with one hidden layer as one array
+    hidden = coefs[0].shape[1]
+    packed = np.zeros((coefs[0].shape[0] + 2, hidden + 1))
+    packed[:-2, :hidden] = coefs[0]
+    packed[-2, :hidden] = intercepts[0]
+    packed[-1, :hidden] = coefs[1][:, 0]
+    packed[-1, hidden] = intercepts[1][0]
+    return packed
+
+def unpack(packed):
+    hidden = packed.shape[1] - 1
+    coefs = [packed[:-2, :hidden], packed[-1, :hidden].reshape(hidden, 1)]
+    intercepts = [packed[-2, :hidden], packed[-1, hidden:]]
+    return coefs, intercepts
+
+class padding_MLPR(object):
     def __init__(self, method, padding_ratio = 2, hidden_layer_sizes = 2000, seed = 42):
         self.padding_ratio = padding_ratio
         self.hidden_layer_sizes = hidden_layer_sizes
         self.rng = np.random.RandomState(seed)
         self.seed = seed
-        self.model = MLPRegressor(hidden_layer_sizes=self.hidden_layer_sizes, random_state=self.seed)
-        self.model.n_layers_ = 3
-        self.model.n_outputs_ = 1
-        self.model.out_activation_ = 'identity'
-        self.model.coefs_ = np.load('model/{}_coefs.npy'.format(method))
-        self.model.intercepts_ = np.load('model/{}_intercepts.npy'.format(method))
+        self.packed = np.load(os.path.join(Model_Dir, '{}_mlp.npy'.format(method)), mmap_mode='r')
  
     def fit(self, X, y=None):
+        from sklearn.neural_network import MLPRegressor
         
         padding = int(X.shape[0] * self.padding_ratio / 2)
         
@@ -28,16 +47,97 @@ class padding_MLPR(BaseEstimator, TransformerMixin):
         final_X = np.vstack([X, X_A1, X_A2])
         final_y = np.hstack([y, y_A1, y_A2])
         
-        self.model.fit(final_X, final_y)
+        model = MLPRegressor(hidden_layer_sizes=self.hidden_layer_sizes, random_state=self.seed)
+        model.fit(final_X, final_y)
+        self.packed = pack(model.coefs_, model.intercepts_)
         return self
 
+    def forward(self, X):
+        # MLPRegressor.predict: a relu hidden layer and an identity output, a few rows at a time so
+        # the hidden activations stay small
+        hidden = self.packed.shape[1] - 1
+        y = np.empty(len(X))
+        for i in range(0, len(X), 8192):
+            h = X[i:i+8192] @ self.packed[:-2, :hidden]
+            h += self.packed[-2, :hidden]
+            np.maximum(h, 0, out=h)
+            y[i:i+8192] = h @ self.packed[-1, :hidden] + self.packed[-1, hidden]
+        return y
+
     def predict(self, X):
-        X = np.array(X)
-        return (self.model.predict(X) + self.model.predict(X[:,[0,2,1]])) / 2
+        X = np.array(X, dtype=np.float64)
+        return (self.forward(X) + self.forward(X[:,[0,2,1]])) / 2
 
     def score(self, X, y=None):
         X = np.array(X)
-        return spearman_r(self.model.predict(X), y)
+        return spearman_r(self.forward(X), y)
+
+class grid_MLPR(object):
+    # Trilinear interpolation of padding_MLPR on a grid_size**3 grid over [-1,1]**3.
+    # The grid is built once from the shipped weights and cached next to them.
+    def __init__(self, method, grid_size = 65, seed = 42):
+        if grid_size < 2:
+            raise ValueError('Lookup grid needs at least 2 points per axis!')
+        self.method = method
+        self.grid_size = grid_size
+        exact = padding_MLPR(method)
+        coefs, intercepts = unpack(exact.packed)
+        digest = hashlib.sha1()
+        for weights in coefs + intercepts:
+            digest.update(np.ascontiguousarray(weights).tobytes())
+        key = digest.hexdigest()
+        cache = os.path.join(Model_Dir, '{}_grid{}.npz'.format(method, grid_size))
+        # a cache that cannot be read, e.g. from a job killed while writing it, is rebuilt
+        try:
+            with np.load(cache) as state:
+                if str(state['key']) == key:
+                    self.grid = state['grid']
+                    self.max_error = float(state['max_error'])
+                    return
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            pass
+        axis = np.linspace(-1, 1, grid_size)
+        X = np.stack(np.meshgrid(axis, axis, axis, indexing='ij'), -1).reshape(-1, 3)
+        grid = exact.forward(X)
+        grid = grid.reshape(grid_size, grid_size, grid_size)
+        # predict averages the model over swapped sim_1 and sim_2, which swaps the last two grid axes.
+        self.grid = (grid + grid.transpose(0, 2, 1)) / 2
+        # Interpolation errors peak between grid points, so check cell centres plus random points.
+        rng = np.random.RandomState(seed)
+        cells = rng.randint(0, grid_size - 1, (100000, 3))
+        X = np.vstack([(axis[cells] + axis[cells + 1]) / 2, rng.uniform(-1, 1, (20000, 3))])
+        self.max_error = float(np.max(np.abs(self.predict(X) - exact.predict(X))))
+        # concurrent jobs each write their own file and replace the cache in one step, like checkpoint_save
+        temp = '{}.{}.tmp'.format(cache, os.getpid())
+        try:
+            with open(temp, 'wb') as f:
+                np.savez(f, key=key, grid=self.grid, max_error=self.max_error)
+            os.replace(temp, cache)
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def interpolate(self, sim, sim_1, sim_2):
+        # sim, sim_1 and sim_2 are broadcast against each other.
+        size = self.grid_size
+        index = []
+        weight = []
+        for x in np.broadcast_arrays(sim, sim_1, sim_2):
+            position = (np.clip(x, -1, 1) + 1) * ((size - 1) / 2)
+            i = np.minimum(position.astype(np.intp), size - 2)
+            index.append(i)
+            weight.append(position - i)
+        (i, j, k), (a, b, c) = index, weight
+        result = 0
+        for di, wi in ((0, 1 - a), (1, a)):
+            for dj, wj in ((0, 1 - b), (1, b)):
+                for dk, wk in ((0, 1 - c), (1, c)):
+                    result = result + wi * wj * wk * self.grid[i + di, j + dj, k + dk]
+        return result
+
+    def predict(self, X):
+        X = np.array(X)
+        return self.interpolate(X[:,0], X[:,1], X[:,2])
 
 if __name__ == '__main__':
     d2shepp_model = padding_MLPR(method='d2shepp')
@@ -0,0 +1,236 @@
+import numpy as np
+from method import ne
+import method
+import afann
+import argparse
+import os
+
+# Distances between query sequences and the windows of long genomes. The kmer counts of a window
+# are those of the window before it plus the kmers that enter and minus the kmers that leave, so
+# counting costs the length of the genome whatever the window length.
+
+Methods = ['d2star', 'd2shepp', 'cvtree', 'ma', 'eu', 'd2']
+# Entries of the count tables of a batch of windows
+Scan_Chunk = 1 << 21
+
+Nuc_codes = np.full(256, -2, dtype=np.int8)
+for i, nuc in enumerate('ACGT'):
+    Nuc_codes[ord(nuc)] = Nuc_codes[ord(nuc.lower())] = i
+for nuc in 'BHDVKWSMYRN':
+    Nuc_codes[ord(nuc)] = Nuc_codes[ord(nuc.lower())] = -1
+
+def get_nucs(seqfile, sequence):
+    # 0-3 for ACGT and -1 for the bases the counter skips, like nuc2num of src/_count
+    nucs = Nuc_codes[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+    if np.any(nucs == -2):
+        raise Exception('Sequence file %s is not in the correct fasta format!'%seqfile)
+    return nucs
+
+def kmer_codes(nucs, k, Reverse):
+    # The codes of the kmers starting at each position and of their reverse complements, -1 for the
+    # kmers with an N
+    n = max(len(nucs) - k + 1, 0)
+    codes = np.zeros(n, dtype=np.int64)
+    rev = np.zeros(n, dtype=np.int64)
+    for j in range(k):
+        nuc = nucs[j:j+n].astype(np.int64) & 3
+        codes = (codes << 2) | nuc
+        if Reverse:
+            rev |= (3 - nuc) << (2*j)
+    skipped = np.concatenate([[0], np.cumsum(nucs < 0)])
+    invalid = skipped[k:k+n] - skipped[:n] > 0
+    codes[invalid] = -1
+    rev[invalid] = -1
+    return [codes, rev] if Reverse else [codes]
+
+def table_counts(code_rows, D):
+    # Counts of the codes of every row of a B x L matrix, in a B x D table
+    B = code_rows.shape[0]
+    flat = (code_rows + np.arange(B)[:, np.newaxis] * D)[code_rows >= 0]
+    return np.bincount(flat, minlength=B*D).reshape(B, D)
+
+def window_counts(nucs, k, Reverse, starts, length, step, previous):
+    # Counts of the kmers of the windows [start, start+length) of nucs, which are step apart. previous
+    # holds the counts of the window before the first one, or None if starts[0] is the first window.
+    D = 4**k
+    n = max(length - k + 1, 0)
+    B = len(starts)
+    counts = np.zeros((B, D), dtype=np.int64)
+    if previous is None:
+        for codes in kmer_codes(nucs[starts[0]:starts[0]+length], k, Reverse):
+            counts[0] += table_counts(codes[np.newaxis, :], D)[0]
+        if B == 1:
+            return counts
+        first = 1
+    else:
+        first = 0
+    # each window gains the last L kmers of its span and loses the first L kmers of the one before it
+    L = min(step, n)
+    lo = starts[first] - step
+    offsets = np.arange(B - first)[:, np.newaxis] * step
+    delta = counts[first:]
+    for codes in kmer_codes(nucs[lo:starts[-1]+length], k, Reverse):
+        delta += table_counts(codes[offsets + step + n - L + np.arange(L)], D)
+        delta -= table_counts(codes[offsets + np.arange(L)], D)
+    np.cumsum(counts, axis=0, out=counts)
+    if previous is not None:
+        counts += previous
+    return counts
+
+def window_expect(M_count, M, K):
+    # get_expect of every row of a B x 4**M table
+    B = M_count.shape[0]
+    rows = M_count.reshape(B, -1, 4)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trans = rows / np.sum(rows, axis=2)[:, :, np.newaxis]
+        trans[np.isnan(trans)] = 0
+    expect = M_count.astype(np.float64)
+    for _ in range(K-M):
+        expect = expect.reshape(B, -1, trans.shape[1], 1) * trans[:, np.newaxis, :, :]
+    return expect.reshape(B, -1)
+
+def window_features(a_method, counts, M, K):
+    # The features of afann for the windows of a batch, one row each
+    K_count = counts[K]
+    if a_method in ['ma', 'eu', 'd2']:
+        return K_count / np.sum(K_count, axis=1)[:, np.newaxis]
+    if a_method == 'cvtree':
+        M = K - 1
+    expect = window_expect(counts[M], M, K)
+    if a_method == 'd2shepp':
+        return ne.evaluate('K_count - expect')
+    f = ne.evaluate('(K_count - expect)/sqrt(expect)' if a_method == 'd2star' else '(K_count - expect)/expect')
+    f[np.isnan(f)] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f /= np.sqrt(ne.evaluate('sum(f * f, axis=1)'))[:, np.newaxis]
+    return f
+
+def query_features(a_method, seqname_list, sequence_list, M, K, Num_Threads, Reverse):
+    if a_method == 'd2star':
+        return method.get_d2star_all_f(seqname_list, M, K, Num_Threads, Reverse, 'None', sequence_list, True)
+    if a_method == 'cvtree':
+        return method.get_CVTree_all_f(seqname_list, M, K, Num_Threads, Reverse, 'None', sequence_list, True)
+    if a_method == 'd2shepp':
+        return method.get_all_diff(seqname_list, M, K, Num_Threads, Reverse, 'None', sequence_list, True)
+    return method.get_all_f(seqname_list, M, K, Num_Threads, Reverse, 'None', sequence_list, True)
+
+def d2shepp_windows(window_diff, query_diff):
+    # d2shepp_matrix_groupwise of the windows against the queries. With w = 1/sqrt(a**2 + b**2), or 0
+    # where both are 0, the sums of a_f*b_f, a_f**2 and b_f**2 are those of a*b*w, a**2*w and b**2*w.
+    matrix = np.zeros((window_diff.shape[0], query_diff.shape[0]))
+    for j, a_diff in enumerate(query_diff):
+        a = a_diff[np.newaxis, :]
+        weight = ne.evaluate('where(a**2 + window_diff**2 > 0, 1/sqrt(a**2 + window_diff**2), 0)')
+        num = (window_diff * weight) @ a_diff
+        a_norm = weight @ (a_diff**2)
+        b_norm = ne.evaluate('sum(window_diff**2 * weight, axis=1)')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            matrix[:, j] = 0.5 * (1 - num / np.sqrt(a_norm * b_norm))
+    return matrix
+
+def window_distances(a_method, window_f, query_f):
+    # The matrices of the groupwise methods of afann, windows against queries
+    if a_method == 'd2shepp':
+        return d2shepp_windows(window_f, query_f)
+    if a_method in ['d2star', 'cvtree']:
+        return method.dot_matrix(window_f, query_f)
+    if a_method == 'd2':
+        return method.cosine_matrix(window_f, query_f)
+    if a_method == 'ma':
+        return method.Ma_matrix(window_f, query_f)
+    return method.Eu_matrix(window_f, query_f)
+
+def scan_record(seqfile, name, sequence, methods, query_f, M, K, Reverse, window, step, outputs):
+    nucs = get_nucs(seqfile, sequence)
+    length = min(window, len(nucs))
+    if length == 0:
+        return 0
+    starts = np.arange(0, len(nucs) - length + 1, step)
+    sizes = [K]
+    if set(methods) & set(['d2star', 'd2shepp']):
+        sizes.append(M)
+    if 'cvtree' in methods:
+        sizes.append(K-1)
+    sizes = sorted(set(sizes))
+    batch = max(1, Scan_Chunk // 4**K)
+    previous = dict((k, None) for k in sizes)
+    for b in range(0, len(starts), batch):
+        batch_starts = starts[b:b+batch]
+        counts = {}
+        for k in sizes:
+            counts[k] = window_counts(nucs, k, Reverse, batch_starts, length, step, previous[k])
+            previous[k] = counts[k][-1]
+        # windows without a kmer, e.g. of Ns only, get nan
+        valid = np.sum(counts[K], axis=1) > 0
+        counts = dict((k, counts[k][valid]) for k in sizes)
+        for a_method in methods:
+            matrix = np.full((len(batch_starts), query_f[a_method].shape[0]), np.nan)
+            if np.any(valid):
+                matrix[valid] = window_distances(a_method, window_features(a_method, counts, M, K), query_f[a_method])
+            for start, row in zip(batch_starts, matrix):
+                outputs[a_method].write('%s\t%d\t%d\t%s\n'%(name, start, start + length, '\t'.join('%.4f'%x for x in row)))
+    return len(starts)
+
+def scan_output(output, a_method):
+    if output.endswith('/'):
+        return output + a_method + '.scan.tsv'
+    return output + '.' + a_method + '.scan.tsv'
+
+def check_scan(K, M, methods, window, step):
+    if K <= 0:
+        raise ValueError('Kmer length must be a positive integer!')
+    if K > 15:
+        raise ValueError('Kmer length cannot be greater than 15!')
+    if M <= 0:
+        raise ValueError('Markovian order must be a non-negative integer!')
+    if set(methods) & set(['d2star', 'd2shepp']) and M >= K:
+        raise ValueError('Markovian order cannot be greater than K-2!')
+    for a_method in methods:
+        if a_method not in Methods:
+            raise Exception('Unknown method %s!'%a_method)
+    if window < K:
+        raise ValueError('Window length cannot be less than kmer length!')
+    if step <= 0:
+        raise ValueError('Step must be a positive integer!')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Example: python scan.py -a d2star,d2shepp -k 6 -m 1 -q query.fa -g genome.fa -w 500 --step 50 -o output')
+    parser.add_argument('-a', dest='method', required = True, help='A list of alignment-free method, separated by comma: d2star,d2shepp,CVtree,Ma,Eu,d2')
+    parser.add_argument('-k', dest='K', required = True, type = int, help='Kmer length')
+    parser.add_argument('-m', dest='M', type = int, default=0, help='Markovian Order, required for d2star, d2shepp and CVtree')
+    parser.add_argument('-q', dest='query', required = True, help='A fasta file that lists the query sequences')
+    parser.add_argument('-g', dest='genome', required = True, help='A fasta file of the sequences to scan')
+    parser.add_argument('-w', dest='window', required = True, type = int, help='Window length, sequences shorter than it are compared as one window')
+    parser.add_argument('--step', dest='step', type = int, default=0, help='Distance between the starts of two windows (default: 0, a tenth of the window length)')
+    parser.add_argument('-o', dest='output', help='Prefix of output (defualt: Current directory)', default='./')
+    parser.add_argument('-t', dest='threads', type = int, default=1, help='Number of threads of every stage, shared by the kmer counter, numexpr and the BLAS and OpenMP pools of numpy, scipy and sklearn')
+    parser.add_argument('-r', dest='reverse_complement', action='store_true', default=False, help='Count the reverse complement of kmers (default: False)')
+    args = parser.parse_args()
+    K = args.K
+    M = args.M + 1
+    Reverse = args.reverse_complement
+    Num_Threads = args.threads
+    methods = [x.strip().lower() for x in args.method.split(',')]
+    window = args.window
+    step = args.step if args.step else max(1, window // 10)
+    check_scan(K, M, methods, window, step)
+    if Num_Threads <= 0:
+        raise ValueError('Number of threads must be a positive integer!')
+    method.set_thread_budget(Num_Threads)
+    d = os.path.dirname(args.output)
+    if d:
+        os.system('mkdir -p %s'%d)
+    seqname_old_list, seqname_list, sequence_list = method.get_sequences(args.query)
+    afann.prefetch_sequences(methods, seqname_list, sequence_list, M, K, Num_Threads, Reverse, 'None')
+    query_f = dict((a_method, query_features(a_method, seqname_list, sequence_list, M, K, Num_Threads, Reverse)) for a_method in methods)
+    outputs = dict((a_method, open(scan_output(args.output, a_method), 'wt')) for a_method in methods)
+    for a_method in methods:
+        outputs[a_method].write('record\tstart\tend\t%s\n'%'\t'.join(seqname_old_list))
+    genome_old_list, genome_list, genome_sequence_list = method.get_sequences(args.genome)
+    with method.stage('distances'):
+        for name, sequence in zip(genome_old_list, genome_sequence_list):
+            windows = scan_record(args.genome, name, sequence, methods, query_f, M, K, Reverse, window, step, outputs)
+            print('Scanned %d windows of %s.'%(windows, name))
+    for a_method in methods:
+        outputs[a_method].close()
+    method.stage_report()
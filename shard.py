@@ -0,0 +1,242 @@
+import numpy as np
+import hashlib
+import json
+import os
+import method
+import afann
+import argparse
+
+def output_name(output, *parts):
+    if output.endswith('/'):
+        return output + '.'.join(parts)
+    else:
+        return '.'.join([output] + list(parts))
+
+def tile_name(manifest, tile_id):
+    return output_name(manifest['output'], 'tile%06d'%tile_id, 'npz')
+
+def get_tiles(N1, N2, tile_size, pairwise):
+    tiles = []
+    for r0 in range(0, N1, tile_size):
+        # Pairwise runs only need the upper triangle, the merge step mirrors it.
+        for c0 in range(r0 if pairwise else 0, N2, tile_size):
+            tiles.append([r0, min(r0+tile_size, N1), c0, min(c0+tile_size, N2)])
+    return tiles
+
+def load_groups(manifest):
+    groups = []
+    for group in manifest['groups']:
+        if manifest['from_seq']:
+            seqname_old_list, seqname_list, sequence_list = method.get_sequences(group['seqfile'])
+        else:
+            # samples made of several files get their member files back
+            files = group.get('files') or [None] * len(group['names'])
+            seqname_list = [method.Sample(name, members) if members else name for name, members in zip(group['names'], files)]
+            seqname_old_list, sequence_list = seqname_list, []
+        if seqname_list != group['names']:
+            raise Exception('Samples in %s changed since the manifest was written!'%group['seqfile'])
+        groups.append((seqname_old_list, seqname_list, sequence_list))
+    return groups
+
+def prepare_store(methods, seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq):
+    # Build every count and feature a tile can ask for, so workers only read P_dir.
+    if not from_seq:
+        afann.prefetch_counts(methods, seqname_list, M, K, Num_Threads, Reverse, P_dir, 2)
+    sequence = ''
+    for i, seqfile in enumerate(seqname_list):
+        if from_seq:
+            sequence = sequence_list[i]
+        if 'd2star' in methods:
+            method.get_d2star_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+        if 'd2shepp' in methods:
+            method.get_d2shepp_diff(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+        if 'cvtree' in methods:
+            method.get_CVTree_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+        if set(methods) & set(['ma', 'eu', 'd2']):
+            method.get_K(seqfile, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+
+def plan(args):
+    K = args.K
+    M = args.M + 1
+    Reverse = args.reverse_complement or args.adjust
+    method.set_thread_budget(args.threads)
+    afann.check_arguments(K, M, args.filename, args.filename1, args.filename2, args.sequence_file, args.sequence_file_1, args.sequence_file_2, args.Dir, args.output, args.threads)
+    if args.Dir == 'None':
+        raise Exception('Tiles share kmer counts and features through -d, use -d to indicate a directory!')
+    if args.grid < 0 or args.grid == 1:
+        raise ValueError('Lookup grid needs at least 2 points per axis!')
+    if args.tile_size <= 0:
+        raise ValueError('Tile size must be a positive integer!')
+    methods = [x.strip().lower() for x in args.method.split(',')]
+    for a_method in methods:
+        afann.get_matrix(a_method)
+    from_seq = bool(args.sequence_file or args.sequence_file_1)
+    if from_seq:
+        inputs = [args.sequence_file] if args.sequence_file else [args.sequence_file_1, args.sequence_file_2]
+    else:
+        inputs = [args.filename] if args.filename else [args.filename1, args.filename2]
+    manifest = {'methods': methods, 'M': M, 'K': K, 'threads': args.threads, 'reverse': Reverse,
+                'adjust': args.adjust, 'grid': args.grid, 'slow': args.slow, 'from_seq': from_seq, 'P_dir': os.path.abspath(args.Dir),
+                'output': args.output, 'pairwise': len(inputs) == 1, 'groups': [], 'bias': {}}
+    for i, name in enumerate(inputs):
+        if from_seq:
+            seqname_old_list, seqname_list, sequence_list = method.get_sequences(name)
+            group = {'seqfile': os.path.abspath(name), 'names': seqname_list}
+        else:
+            seqname_list, sequence_list = afann.get_sequence_from_file(name), []
+            group = {'seqfile': None, 'names': seqname_list, 'files': [[os.path.abspath(x) for x in seqfile.files] if isinstance(seqfile, method.Sample) else None for seqfile in seqname_list]}
+        print('Preparing features of %s.'%name)
+        prepare_store(methods, seqname_list, M, K, args.threads, Reverse, manifest['P_dir'], sequence_list, from_seq)
+        for a_method in methods:
+            if a_method in ['d2star', 'd2shepp'] and Reverse and args.adjust:
+                with method.stage('bias'):
+                    bias_array = afann.get_bias(a_method)(seqname_list, M, K, args.threads, Reverse, manifest['P_dir'], sequence_list, from_seq, args.slow)
+                manifest['bias'].setdefault(a_method, []).append(bias_array.tolist())
+        manifest['groups'].append(group)
+    N1 = len(manifest['groups'][0]['names'])
+    N2 = len(manifest['groups'][-1]['names'])
+    manifest['tiles'] = get_tiles(N1, N2, args.tile_size, manifest['pairwise'])
+    manifest['run_id'] = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    manifest_file = output_name(args.output, 'manifest', 'json')
+    with open(manifest_file, 'wt') as f:
+        json.dump(manifest, f, indent=1)
+    print('%d tiles written to %s.'%(len(manifest['tiles']), manifest_file))
+
+def run_tile(manifest, groups, tile_id, Num_Threads):
+    r0, r1, c0, c1 = manifest['tiles'][tile_id]
+    M, K, Reverse, P_dir = manifest['M'], manifest['K'], manifest['reverse'], manifest['P_dir']
+    from_seq, slow = manifest['from_seq'], manifest['slow']
+    seqname_list_1, sequence_list_1 = groups[0][1][r0:r1], groups[0][2][r0:r1]
+    seqname_list_2, sequence_list_2 = groups[-1][1][c0:c1], groups[-1][2][c0:c1]
+    results = {}
+    for a_method in manifest['methods']:
+        with method.stage('distances'):
+            if manifest['pairwise'] and r0 == c0:
+                results[a_method] = afann.get_matrix(a_method)(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq, slow)
+            else:
+                results[a_method] = afann.get_matrix_group(a_method)(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq, slow)
+    filename = tile_name(manifest, tile_id)
+    # Write then rename, so an interrupted worker never leaves a partial tile behind.
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, run_id=manifest['run_id'], tile=tile_id, bounds=[r0, r1, c0, c1], **results)
+    os.replace(filename + '.tmp', filename)
+
+def run(args):
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    Num_Threads = args.threads if args.threads else manifest['threads']
+    method.set_thread_budget(Num_Threads)
+    if args.tiles:
+        tiles = args.tiles
+    else:
+        tiles = [i for i in range(len(manifest['tiles'])) if not os.path.exists(tile_name(manifest, i))]
+    if not 0 <= args.worker < args.workers:
+        raise ValueError('Worker index must be between 0 and the number of workers!')
+    tiles = [i for i in tiles if i % args.workers == args.worker]
+    groups = load_groups(manifest)
+    for tile_id in tiles:
+        if not 0 <= tile_id < len(manifest['tiles']):
+            raise ValueError('Tile %d is not in %s!'%(tile_id, args.manifest))
+        print('Calculating tile %d.'%tile_id)
+        run_tile(manifest, groups, tile_id, Num_Threads)
+
+def merge(args):
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    tiles = manifest['tiles']
+    method.set_thread_budget(manifest['threads'])
+    missing = [i for i in range(len(tiles)) if not os.path.exists(tile_name(manifest, i))]
+    if missing:
+        raise Exception('%d of %d tiles are missing: %s'%(len(missing), len(tiles), ','.join(map(str, missing))))
+    N1 = len(manifest['groups'][0]['names'])
+    N2 = len(manifest['groups'][-1]['names'])
+    shape = (method.condensed_size(N1),) if manifest['pairwise'] else (N1, N2)
+    matrices = dict((a_method, np.zeros(shape)) for a_method in manifest['methods'])
+    for tile_id, bounds in enumerate(tiles):
+        with np.load(tile_name(manifest, tile_id)) as part:
+            if str(part['run_id']) != manifest['run_id'] or part['bounds'].tolist() != bounds:
+                raise Exception('Tile %d does not belong to %s!'%(tile_id, args.manifest))
+            r0, r1, c0, c1 = bounds
+            for a_method in manifest['methods']:
+                if not manifest['pairwise']:
+                    matrices[a_method][r0:r1, c0:c1] = part[a_method]
+                    continue
+                # pairwise results are condensed, a diagonal tile is condensed itself
+                for i in range(r0, r1):
+                    start = method.condensed_start(N1, i)
+                    if r0 == c0:
+                        tile = part[a_method][method.condensed_start(r1-r0, i-r0):method.condensed_start(r1-r0, i-r0+1)]
+                        matrices[a_method][start:start+r1-i-1] = tile
+                    else:
+                        matrices[a_method][start+c0-i-1:start+c1-i-1] = part[a_method][i-r0]
+    groups = load_groups(manifest)
+    output, from_seq = manifest['output'], manifest['from_seq']
+    seqname_list_1, seqname_list_2 = groups[0][0], groups[-1][0]
+    for a_method in manifest['methods']:
+        matrix = matrices[a_method]
+        bias = manifest['bias'].get(a_method)
+        if manifest['pairwise']:
+            afann.write_tsv(output, a_method, seqname_list_1, matrix, from_seq)
+            afann.write_phy(output, a_method, seqname_list_1, matrix, from_seq)
+            if args.tree:
+                afann.write_tree(output, a_method, seqname_list_1, matrix, from_seq)
+            if bias:
+                bias_array = np.array(bias[0])
+                afann.write_bias(output, a_method, seqname_list_1, [], bias_array, [], from_seq)
+                with method.stage('adjusting'):
+                    new_matrix = method.matrix_adjusted_pairwise(matrix, bias_array, a_method, grid=manifest['grid'])
+                afann.write_tsv(output, a_method + '_adjusted', seqname_list_1, new_matrix, from_seq)
+                afann.write_phy(output, a_method + '_adjusted', seqname_list_1, new_matrix, from_seq)
+                if args.tree:
+                    afann.write_tree(output, a_method + '_adjusted', seqname_list_1, new_matrix, from_seq)
+        else:
+            afann.write_phy_group(output, a_method, seqname_list_1, seqname_list_2, matrix, from_seq)
+            afann.write_tsv_group(output, a_method, seqname_list_1, seqname_list_2, matrix, from_seq)
+            if bias:
+                bias_array_1, bias_array_2 = np.array(bias[0]), np.array(bias[1])
+                afann.write_bias(output, a_method, seqname_list_1, seqname_list_2, bias_array_1, bias_array_2, from_seq)
+                with method.stage('adjusting'):
+                    new_matrix = method.matrix_adjusted_groupwise(matrix, bias_array_1, bias_array_2, a_method, grid=manifest['grid'])
+                afann.write_phy_group(output, a_method + '_adjusted', seqname_list_1, seqname_list_2, new_matrix, from_seq)
+                afann.write_tsv_group(output, a_method + '_adjusted', seqname_list_1, seqname_list_2, new_matrix, from_seq)
+    print('Merged %d tiles.'%len(tiles))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Example: python shard.py plan -a d2star -k 12 -m 10 -f filename -d dir -o output --tile-size 500; python shard.py run output.manifest.json --worker 0 --workers 4; python shard.py merge output.manifest.json')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    plan_parser = subparsers.add_parser('plan', help='Prepare the shared features in -d and write a manifest of independent tiles')
+    plan_parser.add_argument('-a', dest='method', required = True, help='A list of alignment-free method, separated by comma: d2star,d2shepp,CVtree,Ma,Eu,d2')
+    plan_parser.add_argument('-k', dest='K', required = True, type = int, help='Kmer length')
+    plan_parser.add_argument('-m', dest='M', type = int, default=0, help='Markovian Order, required for d2star, d2shepp and CVtree')
+    plan_parser.add_argument('-f', dest='filename', help='A file that lists the paths of all samples')
+    plan_parser.add_argument('-s', dest='sequence_file', help='A fasta file that lists the sequences of all samples')
+    plan_parser.add_argument('-f1', dest='filename1', help='A file that lists the paths of the first group of samples')
+    plan_parser.add_argument('-f2', dest='filename2', help='A file that lists the paths of the second group of samples')
+    plan_parser.add_argument('-s1', dest='sequence_file_1', help='A fasta file that lists the sequences of the first group of samples')
+    plan_parser.add_argument('-s2', dest='sequence_file_2', help='A fasta file that lists the sequences of the second group of samples')
+    plan_parser.add_argument('-d', dest='Dir', default='None', help='A directory shared by all workers that saves kmer counts and features')
+    plan_parser.add_argument('-o', dest='output', help='Prefix of manifest, tiles and output (defualt: Current directory)', default='./')
+    plan_parser.add_argument('-t', dest='threads', type = int, default=1, help='Number of threads of every stage, shared by the kmer counter, numexpr and the BLAS and OpenMP pools of numpy, scipy and sklearn')
+    plan_parser.add_argument('-r', dest='reverse_complement', action='store_true', default=False, help='Count the reverse complement of kmers (default: False)')
+    plan_parser.add_argument('--adjust', dest='adjust', action='store_true', default=False, help='Adjust d2star and/or d2shepp distances for NGS samples, -r will be set automatically')
+    plan_parser.add_argument('--grid', dest='grid', type = int, default=0, help='Adjust with a GRID^3 lookup grid of the neural network (default: 0, use the exact neural network)')
+    plan_parser.add_argument('--slow', dest='slow', action='store_true', default=False, help='Use slow mode for calculation with less memory usage (default: False)')
+    plan_parser.add_argument('--tile-size', dest='tile_size', type = int, default=500, help='Number of rows and columns of a tile (default: 500)')
+    run_parser = subparsers.add_parser('run', help='Calculate tiles of a manifest')
+    run_parser.add_argument('manifest', help='Manifest written by plan')
+    run_parser.add_argument('tiles', nargs='*', type = int, help='Tiles to calculate (default: all unfinished tiles)')
+    run_parser.add_argument('--worker', dest='worker', type = int, default=0, help='Index of this worker, it calculates the tiles whose index modulo --workers equals it (default: 0)')
+    run_parser.add_argument('--workers', dest='workers', type = int, default=1, help='Number of workers sharing the tiles (default: 1)')
+    run_parser.add_argument('-t', dest='threads', type = int, default=0, help='Number of threads (default: value given to plan)')
+    merge_parser = subparsers.add_parser('merge', help='Check that every tile is finished and write the final outputs')
+    merge_parser.add_argument('manifest', help='Manifest written by plan')
+    merge_parser.add_argument('--tree', dest='tree', action='store_true', default=False, help='Also write the neighbour joining tree of each pairwise distance matrix in Newick format (default: False)')
+    args = parser.parse_args()
+    if args.command == 'plan':
+        plan(args)
+    elif args.command == 'run':
+        run(args)
+    else:
+        merge(args)
+    method.stage_report()
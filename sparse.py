@@ -0,0 +1,354 @@
+from src._count import kmer_count_hash
+from src._count import kmer_count_hash_seq
+from src._count import kmer_count_hash_batch
+from method import get_K
+from method import sample_files
+from method import get_transition
+from method import cosine_matrix
+from method import Ma_matrix
+from method import Eu_matrix
+from method import checkpoint_key
+from method import checkpoint_load
+from method import checkpoint_save
+from method import condensed_size
+from method import condensed_start
+from method import condensed_matrix
+from method import staged
+import numpy as np
+import time
+import os
+
+# Kmers up to K=31 are counted into sorted (kmer, count) arrays and every feature is computed on the
+# observed kmers only, so nothing of size 4**K is allocated. The Markovian M-mer counts stay dense.
+Max_K = 31
+Pool_Size = 1 << 14
+# Hash counts of -s records by (seqname, K, Reverse), filled by count_hash_sequences with one batch call
+Sequence_hash = {}
+
+def hash_pickle(seqfile, K, Reverse, P_dir):
+    seq_hash_p = os.path.join(P_dir, os.path.basename(seqfile) + '.%s_K%d_hash.npz'%('R' if Reverse else 'NR', K))
+    return seq_hash_p
+
+def check_hash(seqfile, counts):
+    if len(counts) == 0:
+        raise Exception('Sequence file %s is empty!'%seqfile)
+    if counts[0] == -1:
+        raise Exception('Sequence file %s is not in the correct fasta format!'%seqfile)
+
+def merge_hash(hash_list):
+    # Sums the sorted (kmers, counts) pairs of several files
+    if len(hash_list) == 1:
+        return hash_list[0]
+    kmers, idx = np.unique(np.concatenate([kmers for kmers, counts in hash_list]), return_inverse=True)
+    counts = np.zeros(len(kmers), dtype=np.int32)
+    np.add.at(counts, idx, np.concatenate([counts for kmers, counts in hash_list]))
+    return kmers, counts
+
+@staged('counting')
+def get_hash(seqfile, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
+    if K > Max_K:
+        raise ValueError('Kmer length cannot be greater than %d!'%Max_K)
+    seq_hash_p = hash_pickle(seqfile, K, Reverse, P_dir)
+    if from_seq and (seqfile, K, Reverse) in Sequence_hash:
+        kmers, counts = Sequence_hash[(seqfile, K, Reverse)]
+    elif os.path.exists(seq_hash_p):
+        with np.load(seq_hash_p) as f:
+            kmers = f['kmers']
+            counts = f['counts']
+    else:
+        if from_seq:
+            kmers, counts = kmer_count_hash_seq(sequence, K, Num_Threads, Reverse)
+        else:
+            hash_list = []
+            for filename in sample_files(seqfile):
+                kmers, counts = kmer_count_hash(filename, K, Num_Threads, Reverse)
+                check_hash(filename, counts)
+                hash_list.append((kmers, counts))
+            kmers, counts = merge_hash(hash_list)
+        check_hash(seqfile, counts)
+        if P_dir != 'None':
+            np.savez(seq_hash_p, kmers=kmers, counts=counts)
+    return kmers, counts
+
+@staged('counting')
+def count_hash_sequences(seqname_list, sequence_list, K, Num_Threads, Reverse, P_dir):
+    # Counts all -s records whose counts are not saved in P_dir yet with one batch call
+    # and keeps them in Sequence_hash for get_hash
+    todo = [i for i, seqname in enumerate(seqname_list) if (seqname, K, Reverse) not in Sequence_hash and not os.path.exists(hash_pickle(seqname, K, Reverse, P_dir))]
+    if not todo:
+        return
+    sequence = ''.join(sequence_list[i] for i in todo).encode()
+    offsets = np.cumsum([0] + [len(sequence_list[i]) for i in todo])
+    indptr, kmers, counts = kmer_count_hash_batch(sequence, offsets, K, Num_Threads, Reverse)
+    for j, i in enumerate(todo):
+        seqname = seqname_list[i]
+        check_hash(seqname, counts[indptr[j]:indptr[j+1]])
+        Sequence_hash[(seqname, K, Reverse)] = (kmers[indptr[j]:indptr[j+1]], counts[indptr[j]:indptr[j+1]])
+        if P_dir != 'None':
+            np.savez(hash_pickle(seqname, K, Reverse, P_dir), kmers=kmers[indptr[j]:indptr[j+1]], counts=counts[indptr[j]:indptr[j+1]])
+
+def get_all_hash(seqname_list, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False):
+    hash_list = []
+    for i in range(len(seqname_list)):
+        sequence = sequence_list[i] if from_seq else ''
+        hash_list.append(get_hash(seqname_list[i], K, Num_Threads, Reverse, P_dir, sequence, from_seq))
+    return hash_list
+
+def union_matrix(value_list, kmer_list, union):
+    # One row per sample over the union of the observed kmers
+    from scipy.sparse import csr_matrix
+    indptr = np.cumsum([0] + [len(kmers) for kmers in kmer_list])
+    indices = np.concatenate([np.searchsorted(union, kmers) for kmers in kmer_list])
+    return csr_matrix((np.concatenate(value_list), indices, indptr), shape=(len(kmer_list), len(union)))
+
+def lookup(kmers, values, query):
+    # values of the sorted kmers at query, 0 where a query kmer is not observed
+    idx = np.minimum(np.searchsorted(kmers, query), len(kmers) - 1)
+    found = kmers[idx] == query
+    return np.where(found, values[idx], 0), found
+
+@staged('features')
+def get_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False):
+    hash_list = get_all_hash(seqname_list, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
+    kmer_list = [kmers for kmers, counts in hash_list]
+    freq_list = [counts / np.sum(counts, dtype=np.float64) for kmers, counts in hash_list]
+    union = np.unique(np.concatenate(kmer_list))
+    return union_matrix(freq_list, kmer_list, union)
+
+@staged('features')
+def get_all_f_group(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False):
+    N1 = len(seqname_list_1)
+    f_matrix = get_all_f(seqname_list_1 + seqname_list_2, M, K, Num_Threads, Reverse, P_dir, list(sequence_list_1) + list(sequence_list_2), from_seq)
+    return f_matrix[:N1], f_matrix[N1:]
+
+# Markov model of order M-1 of one sample, E(w) = M_count[w_1..w_M] * prod trans[w_t-M+1..w_t]
+class Markov(object):
+    def __init__(self, seqfile, M, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
+        self.M = M
+        self.K = K
+        self.M_count = get_K(seqfile, M, Num_Threads, Reverse, P_dir, sequence, from_seq).astype(np.float64)
+        self.trans = get_transition(self.M_count).ravel()
+        self.kmers, self.counts = get_hash(seqfile, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+        # beta[j][y]: expected mass of the j nucleotides that follow the M-mer y
+        beta = [np.ones_like(self.trans)]
+        for _ in range(K-M):
+            b = (self.trans * beta[-1]).reshape(-1, 4).sum(1)
+            beta.append(np.tile(b, 4))
+        self.beta = beta
+        self.total = np.sum(self.M_count * beta[-1])
+
+    def expect(self, kmers):
+        M, K = self.M, self.K
+        mask = np.uint64(4**M - 1)
+        expect = self.M_count[(kmers >> np.uint64(2*(K-M))).astype(np.int64)]
+        for t in range(M+1, K+1):
+            expect = expect * self.trans[((kmers >> np.uint64(2*(K-t))) & mask).astype(np.int64)]
+        return expect
+
+    def sample(self, n, random_state):
+        # Draws n kmers with probability E(w) / sum(E)
+        M, K = self.M, self.K
+        start = self.M_count * self.beta[K-M]
+        state = random_state.choice(len(start), n, p=start/np.sum(start))
+        kmers = state.astype(np.uint64)
+        context = 4**(M-1)
+        for j in range(K-M-1, -1, -1):
+            nxt = (state % context)[:, np.newaxis] * 4 + np.arange(4)
+            p = self.trans[nxt] * self.beta[j][nxt]
+            cum = np.cumsum(p, 1)
+            x = np.minimum((random_state.random_sample(n)[:, np.newaxis] * cum[:, -1:] >= cum).sum(1), 3)
+            state = nxt[np.arange(n), x]
+            kmers = (kmers << np.uint64(2)) | x.astype(np.uint64)
+        return kmers
+
+def markov_cross(a, b):
+    # sum over all 4**K kmers of sqrt(E_a(w) * E_b(w))
+    alpha = np.sqrt(a.M_count * b.M_count)
+    q = np.sqrt(a.trans * b.trans).reshape(-1, 4)
+    for _ in range(a.K - a.M):
+        s = alpha.reshape(4, -1).sum(0)
+        alpha = (s[:, np.newaxis] * q).ravel()
+    return np.sum(alpha)
+
+@staged('features')
+def get_all_markov(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False):
+    markov_list = []
+    for i in range(len(seqname_list)):
+        sequence = sequence_list[i] if from_seq else ''
+        markov_list.append(Markov(seqname_list[i], M, K, Num_Threads, Reverse, P_dir, sequence, from_seq))
+    return markov_list
+
+def d2star_dot(markov_1, markov_2=None):
+    # f = (X-E)/sqrt(E) = g - h with g = X/sqrt(E) on the observed kmers and h = sqrt(E) everywhere,
+    # so f_a.f_b = g_a.g_b - g_a.h_b - h_a.g_b + h_a.h_b where only h_a.h_b runs over all kmers
+    markov_list = markov_1 + (markov_2 if markov_2 is not None else [])
+    kmer_list = [a.kmers for a in markov_list]
+    union = np.unique(np.concatenate(kmer_list))
+    g_list = []
+    for a in markov_list:
+        expect = a.expect(a.kmers)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            g_list.append(np.where(expect > 0, a.counts / np.sqrt(expect), 0))
+    G = union_matrix(g_list, kmer_list, union)
+    # g.h of a sample with itself is the sum of its counts
+    norm = [np.sum(g * g) - 2 * np.sum(a.counts) + a.total for a, g in zip(markov_list, g_list)]
+    norm = np.sqrt(np.array(norm))
+    N1 = len(markov_1)
+    if markov_2 is None:
+        markov_2 = markov_1
+        G1, G2 = G, G
+        norm_1, norm_2 = norm, norm
+    else:
+        G1, G2 = G[:N1], G[N1:]
+        norm_1, norm_2 = norm[:N1], norm[N1:]
+    dot = (G1 @ G2.T).toarray()
+    # one column of sqrt(E) over the union at a time
+    for j, b in enumerate(markov_2):
+        dot[:, j] -= G1 @ np.sqrt(b.expect(union))
+    for i, a in enumerate(markov_1):
+        dot[i, :] -= G2 @ np.sqrt(a.expect(union))
+    dot += np.array([[markov_cross(a, b) for b in markov_2] for a in markov_1])
+    return dot / norm_1[:, np.newaxis] / norm_2[np.newaxis, :]
+
+def d2star_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
+    markov_list = get_all_markov(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
+    return condensed_matrix(markov_list, lambda markov_1, markov_2: 0.5 * (1 - d2star_dot(markov_1, markov_2)))
+
+def d2star_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
+    markov_1 = get_all_markov(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq)
+    markov_2 = get_all_markov(seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_2, from_seq)
+    return 0.5 * (1 - d2star_dot(markov_1, markov_2))
+
+def get_all_pool(markov_list, seed=0):
+    # Kmers drawn from each Markov model, shared by all pairs the sample takes part in
+    random_state = np.random.RandomState(seed)
+    pool_list = []
+    for a in markov_list:
+        pool = a.sample(Pool_Size, random_state)
+        pool_list.append((pool, a.expect(pool)))
+    return pool_list
+
+def d2shepp_pair(a, b, a_pool, b_pool):
+    # Exact on the kmers observed in either sample. On the unobserved rest X-E = -E, and each sum is
+    # estimated from the pool as a ratio to sqrt(E_a*E_b), E_a or E_b whose unobserved totals are
+    # known exactly, sampling from the mixture (E_a/sum(E_a) + E_b/sum(E_b))/2 of both models
+    union = np.union1d(a.kmers, b.kmers)
+    a_union = a.expect(union)
+    b_union = b.expect(union)
+    a_diff = lookup(a.kmers, a.counts, union)[0] - a_union
+    b_diff = lookup(b.kmers, b.counts, union)[0] - b_union
+    pool = np.concatenate([a_pool[0], b_pool[0]])
+    a_expect = np.concatenate([a_pool[1], a.expect(b_pool[0])])
+    b_expect = np.concatenate([b.expect(a_pool[0]), b_pool[1]])
+    found = lookup(a.kmers, a.counts, pool)[1] | lookup(b.kmers, b.counts, pool)[1]
+    q = a_expect / a.total + b_expect / b.total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denom = np.sqrt(a_diff**2 + b_diff**2)
+        weight = np.where(denom > 0, 1 / denom, 0)
+        pool_weight = np.where((q > 0) & ~found, 1 / q, 0)
+        pool_denom = np.sqrt(a_expect**2 + b_expect**2)
+        pool_denom = np.where(pool_denom > 0, 1 / pool_denom, 0)
+        cross = np.sqrt(a_expect * b_expect)
+        nom_rest = (markov_cross(a, b) - np.sum(np.sqrt(a_union * b_union))) * np.sum(pool_weight * a_expect * b_expect * pool_denom) / np.sum(pool_weight * cross)
+        a_rest = (a.total - np.sum(a_union)) * np.sum(pool_weight * a_expect * a_expect * pool_denom) / np.sum(pool_weight * a_expect)
+        b_rest = (b.total - np.sum(b_union)) * np.sum(pool_weight * b_expect * b_expect * pool_denom) / np.sum(pool_weight * b_expect)
+    nom = np.sum(a_diff * b_diff * weight) + np.nan_to_num(nom_rest)
+    a_norm = np.sum(a_diff * a_diff * weight) + np.nan_to_num(a_rest)
+    b_norm = np.sum(b_diff * b_diff * weight) + np.nan_to_num(b_rest)
+    return 0.5 * (1 - nom / np.sqrt(a_norm * b_norm))
+
+def d2shepp_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
+    N = len(seqname_list)
+    key = checkpoint_key('pairwise', 'd2shepp_sparse', seqname_list, M, K, Reverse, from_seq)
+    matrix, start = checkpoint_load(checkpoint, key, (condensed_size(N),))
+    if start == N:
+        return matrix
+    last_save = time.time()
+    markov_list = get_all_markov(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
+    pool_list = get_all_pool(markov_list)
+    for i in range(start, N):
+        k = condensed_start(N, i)
+        for j in range(i+1, N):
+            matrix[k] = d2shepp_pair(markov_list[i], markov_list[j], pool_list[i], pool_list[j])
+            k += 1
+        last_save = checkpoint_save(checkpoint, key, matrix, i+1, last_save, N)
+    return matrix
+
+def d2shepp_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
+    N1 = len(seqname_list_1)
+    N2 = len(seqname_list_2)
+    key = checkpoint_key('groupwise', 'd2shepp_sparse', seqname_list_1, seqname_list_2, M, K, Reverse, from_seq)
+    matrix, start = checkpoint_load(checkpoint, key, (N1, N2))
+    if start == N1:
+        return matrix
+    last_save = time.time()
+    markov_1 = get_all_markov(seqname_list_1, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, from_seq)
+    markov_2 = get_all_markov(seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_2, from_seq)
+    pool_list = get_all_pool(markov_1 + markov_2)
+    for i in range(start, N1):
+        for j in range(N2):
+            matrix[i][j] = d2shepp_pair(markov_1[i], markov_2[j], pool_list[i], pool_list[N1+j])
+        last_save = checkpoint_save(checkpoint, key, matrix, i+1, last_save)
+    return matrix
+
+def get_CVTree_f(seqfile, M, K, Num_Threads, Reverse, P_dir, sequence = '', from_seq=False):
+    # E(w) = X(w_1..w_K-1) * X(w_2..w_K) / sum_x X(w_2..w_K-1 x) is only non-zero when both (K-1)-mers are observed
+    K_kmers, K_counts = get_hash(seqfile, K, Num_Threads, Reverse, P_dir, sequence, from_seq)
+    M_kmers, M_counts = get_hash(seqfile, K-1, Num_Threads, Reverse, P_dir, sequence, from_seq)
+    M_counts = M_counts.astype(np.float64)
+    context, start = np.unique(M_kmers >> np.uint64(2), return_index=True)
+    context_counts = np.add.reduceat(M_counts, start)
+    kmers = ((M_kmers[:, np.newaxis] << np.uint64(2)) | np.arange(4, dtype=np.uint64)).ravel()
+    suffix_counts, found = lookup(M_kmers, M_counts, kmers & np.uint64(4**(K-1) - 1))
+    kmers = kmers[found]
+    expect = np.repeat(M_counts, 4)[found] * suffix_counts[found]
+    expect /= lookup(context, context_counts, (kmers >> np.uint64(2)) & np.uint64(4**(K-2) - 1))[0]
+    CVTree_f = lookup(K_kmers, K_counts, kmers)[0] / expect - 1
+    denom = np.sqrt(np.sum(CVTree_f * CVTree_f))
+    if denom > 0:
+        CVTree_f /= denom
+    return kmers, CVTree_f
+
+@staged('features')
+def get_CVTree_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False):
+    f_list = []
+    for i in range(len(seqname_list)):
+        sequence = sequence_list[i] if from_seq else ''
+        f_list.append(get_CVTree_f(seqname_list[i], M, K, Num_Threads, Reverse, P_dir, sequence, from_seq))
+    kmer_list = [kmers for kmers, f in f_list]
+    union = np.unique(np.concatenate(kmer_list))
+    return union_matrix([f for kmers, f in f_list], kmer_list, union)
+
+def CVTree_matrix(f1_matrix, f2_matrix):
+    # A sample whose feature has zero norm gets nan, like the 0/0 feature of the dense mode
+    matrix = 0.5 * (1 - (f1_matrix @ f2_matrix.T).toarray())
+    matrix[np.asarray(f1_matrix.multiply(f1_matrix).sum(axis=1)).ravel() == 0, :] = np.nan
+    matrix[:, np.asarray(f2_matrix.multiply(f2_matrix).sum(axis=1)).ravel() == 0] = np.nan
+    return matrix
+
+def CVTree_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
+    f_matrix = get_CVTree_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq)
+    return condensed_matrix(f_matrix, CVTree_matrix)
+
+def CVTree_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
+    N1 = len(seqname_list_1)
+    f_matrix = get_CVTree_all_f(seqname_list_1 + seqname_list_2, M, K, Num_Threads, Reverse, P_dir, list(sequence_list_1) + list(sequence_list_2), from_seq)
+    return CVTree_matrix(f_matrix[:N1], f_matrix[N1:])
+
+def d2_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
+    return condensed_matrix(get_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq), cosine_matrix)
+
+def Ma_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
+    return condensed_matrix(get_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq), Ma_matrix)
+
+def Eu_matrix_pairwise(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list = [], from_seq=False, slow=False, checkpoint=None):
+    return condensed_matrix(get_all_f(seqname_list, M, K, Num_Threads, Reverse, P_dir, sequence_list, from_seq), Eu_matrix)
+
+def d2_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
+    return cosine_matrix(*get_all_f_group(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq))
+
+def Ma_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
+    return Ma_matrix(*get_all_f_group(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq))
+
+def Eu_matrix_groupwise(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1 = [], sequence_list_2 = [], from_seq=False, slow=False, checkpoint=None):
+    return Eu_matrix(*get_all_f_group(seqname_list_1, seqname_list_2, M, K, Num_Threads, Reverse, P_dir, sequence_list_1, sequence_list_2, from_seq))
@@ -1,7 +1,43 @@
 #include "Python.h"
 #include <numpy/arrayobject.h>
 #include "kmer_count_multithreads.h" 
+#include "kmer_count_hash.h"
+#include "neighbor_joining.h"
 #include <atomic>
+#include <new>
+
+
+typedef std::vector<std::atomic<int>> count_vector;
+
+static void free_count_array(PyObject *capsule)
+{
+    delete static_cast<count_vector*>(PyCapsule_GetPointer(capsule, "_count.count_array"));
+}
+
+/* Hand a heap allocated count array over to NumPy without copying it.
+   The capsule becomes the base of the array and frees it with the array. */
+static PyObject *wrap_count_array(count_vector *count_array)
+{
+    if (count_array == NULL)
+        return PyErr_NoMemory();
+    npy_intp SIZE = count_array->size();
+    PyObject *array = PyArray_SimpleNewFromData(1, &SIZE, NPY_INT32, static_cast<void*>(count_array->data()));
+    if (array == NULL) {
+        delete count_array;
+        return NULL;
+    }
+    PyObject *capsule = PyCapsule_New(static_cast<void*>(count_array), "_count.count_array", free_count_array);
+    if (capsule == NULL) {
+        delete count_array;
+        Py_DECREF(array);
+        return NULL;
+    }
+    if (PyArray_SetBaseObject(reinterpret_cast<PyArrayObject*>(array), capsule) < 0) {
+        Py_DECREF(array);
+        return NULL;
+    }
+    return array;
+}
 
 
 
@@ -9,50 +45,57 @@
 static PyObject *kmer_count(PyObject *self, PyObject *args)
 {
     char* filename;
-    int x, K, NumThreads;
-    bool Reverse=false;
-    if (!PyArg_ParseTuple(args, "siip", &filename, &x, &NumThreads, &Reverse))
-        return NULL;
+    int K, NumThreads;
+    int Reverse = 0;
     if (!PyArg_ParseTuple(args, "siip", &filename, &K, &NumThreads, &Reverse))
         return NULL;
-    npy_intp SIZE = pow(4, K);
     /*
     std::cout << "K: " << K << std::endl;
     std::cout << "Threads: " << NumThreads << std::endl;
     std::cout << "Reverse: " << Reverse << std::endl;
     */
-    static std::vector<std::atomic<int>> count_array;
-    count_array = count(filename, K, NumThreads, Reverse);
-    return PyArray_SimpleNewFromData(1, &SIZE, NPY_INT32, static_cast<void*>(count_array.data()));
+    count_vector *count_array = NULL;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        count_array = new count_vector(count(filename, K, NumThreads, Reverse));
+    }
+    catch (std::bad_alloc&) {
+        count_array = NULL;
+    }
+    Py_END_ALLOW_THREADS
+    return wrap_count_array(count_array);
 }
 
 static PyObject *kmer_count_seq(PyObject *self, PyObject *args)
 {
-    char* sequence;
-    int x , K, NumThreads;
-    bool Reverse=false;
-    if (!PyArg_ParseTuple(args, "siip", &sequence, &x, &NumThreads, &Reverse))
-        return NULL;
-    if (!PyArg_ParseTuple(args, "siip", &sequence, &K, &NumThreads, &Reverse))
+    Py_buffer sequence;
+    int K, NumThreads;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "s*iip", &sequence, &K, &NumThreads, &Reverse))
         return NULL;
     /*
     std::cout << "K: " << K << std::endl;
     std::cout << "Threads: " << NumThreads << std::endl;
     std::cout << "Reverse: " << Reverse << std::endl;
     */
-    npy_intp SIZE = pow(4, K);
-    static std::vector<std::atomic<int>> count_array;
-    count_array = count_seq(sequence, K, NumThreads, Reverse);
-    return PyArray_SimpleNewFromData(1, &SIZE, NPY_INT32, static_cast<void*>(count_array.data()));
+    count_vector *count_array = NULL;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        count_array = new count_vector(count_seq(static_cast<const char*>(sequence.buf), sequence.len, K, NumThreads, Reverse));
+    }
+    catch (std::bad_alloc&) {
+        count_array = NULL;
+    }
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&sequence);
+    return wrap_count_array(count_array);
 }
 
 static PyObject *kmer_count_m_k(PyObject *self, PyObject *args)
 {
     char* filename;
-    int x, M, K, NumThreads;
-    bool Reverse;
-    if (!PyArg_ParseTuple(args, "siiip", &filename, &x, &K, &NumThreads, &Reverse))
-        return NULL;
+    int M, K, NumThreads;
+    int Reverse = 0;
     if (!PyArg_ParseTuple(args, "siiip", &filename, &M, &K, &NumThreads, &Reverse))
         return NULL;
     /*
@@ -61,20 +104,24 @@ static PyObject *kmer_count_m_k(PyObject *self, PyObject *args)
     std::cout << "Threads: " << NumThreads << std::endl;
     std::cout << "Reverse: " << Reverse << std::endl;
     */
-    npy_intp SIZE = pow(4, K) + pow(4, M); 
-    static std::vector<std::atomic<int>> count_array;
-    count_array = count_M_K(filename, M, K, NumThreads, Reverse);
-    return PyArray_SimpleNewFromData(1, &SIZE, NPY_INT32, static_cast<void*>(count_array.data()));
+    count_vector *count_array = NULL;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        count_array = new count_vector(count_M_K(filename, M, K, NumThreads, Reverse));
+    }
+    catch (std::bad_alloc&) {
+        count_array = NULL;
+    }
+    Py_END_ALLOW_THREADS
+    return wrap_count_array(count_array);
 }
 
 static PyObject *kmer_count_m_k_seq(PyObject *self, PyObject *args)
 {
-    char* sequence;
-    int x, M, K, NumThreads;
-    bool Reverse;
-    if (!PyArg_ParseTuple(args, "siiip", &sequence, &x, &K, &NumThreads, &Reverse))
-        return NULL;
-    if (!PyArg_ParseTuple(args, "siiip", &sequence, &M, &K, &NumThreads, &Reverse))
+    Py_buffer sequence;
+    int M, K, NumThreads;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "s*iiip", &sequence, &M, &K, &NumThreads, &Reverse))
         return NULL;
     /*
     std::cout << "M: " << M << std::endl;
@@ -82,10 +129,448 @@ static PyObject *kmer_count_m_k_seq(PyObject *self, PyObject *args)
     std::cout << "Threads: " << NumThreads << std::endl;
     std::cout << "Reverse: " << Reverse << std::endl;
     */
-    npy_intp SIZE = pow(4, K) + pow(4, M);
-    static std::vector<std::atomic<int>> count_array;
-    count_array = count_M_K_seq(sequence, M, K, NumThreads, Reverse);
-    return PyArray_SimpleNewFromData(1, &SIZE, NPY_INT32, static_cast<void*>(count_array.data()));
+    count_vector *count_array = NULL;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        count_array = new count_vector(count_M_K_seq(static_cast<const char*>(sequence.buf), sequence.len, M, K, NumThreads, Reverse));
+    }
+    catch (std::bad_alloc&) {
+        count_array = NULL;
+    }
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&sequence);
+    return wrap_count_array(count_array);
+}
+
+/* Hands a vector over to NumPy without copying it, like wrap_count_array. */
+template <typename T>
+static void free_vector(PyObject *capsule)
+{
+    delete static_cast<std::vector<T>*>(PyCapsule_GetPointer(capsule, "_count.vector"));
+}
+
+template <typename T>
+static PyObject *wrap_vector(std::vector<T> *data, int type)
+{
+    npy_intp SIZE = data->size();
+    PyObject *array = PyArray_SimpleNewFromData(1, &SIZE, type, static_cast<void*>(data->data()));
+    if (array == NULL) {
+        delete data;
+        return NULL;
+    }
+    PyObject *capsule = PyCapsule_New(static_cast<void*>(data), "_count.vector", free_vector<T>);
+    if (capsule == NULL) {
+        delete data;
+        Py_DECREF(array);
+        return NULL;
+    }
+    if (PyArray_SetBaseObject(reinterpret_cast<PyArrayObject*>(array), capsule) < 0) {
+        Py_DECREF(array);
+        return NULL;
+    }
+    return array;
+}
+
+/* Returns the (kmers, counts) pair of a hash count as two arrays sorted by kmer code. */
+static PyObject *wrap_hash_count(std::vector<uint64_t> *kmers, std::vector<int> *counts)
+{
+    PyObject *kmer_array = wrap_vector(kmers, NPY_UINT64);
+    PyObject *count_array = wrap_vector(counts, NPY_INT32);
+    if (kmer_array == NULL || count_array == NULL) {
+        Py_XDECREF(kmer_array);
+        Py_XDECREF(count_array);
+        return NULL;
+    }
+    return Py_BuildValue("NN", kmer_array, count_array);
+}
+
+static PyObject *kmer_count_hash(PyObject *self, PyObject *args)
+{
+    char* filename;
+    int K, NumThreads;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "siip", &filename, &K, &NumThreads, &Reverse))
+        return NULL;
+    if (K <= 0 || K > 31) {
+        PyErr_SetString(PyExc_ValueError, "kmer length must be between 1 and 31");
+        return NULL;
+    }
+    std::vector<uint64_t> *kmers = new std::vector<uint64_t>();
+    std::vector<int> *counts = new std::vector<int>();
+    bool failed = false;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        count_hash(filename, K, NumThreads, Reverse, *kmers, *counts);
+    }
+    catch (std::bad_alloc&) {
+        failed = true;
+    }
+    Py_END_ALLOW_THREADS
+    if (failed) {
+        delete kmers;
+        delete counts;
+        return PyErr_NoMemory();
+    }
+    return wrap_hash_count(kmers, counts);
+}
+
+static PyObject *kmer_count_hash_seq(PyObject *self, PyObject *args)
+{
+    Py_buffer sequence;
+    int K, NumThreads;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "s*iip", &sequence, &K, &NumThreads, &Reverse))
+        return NULL;
+    if (K <= 0 || K > 31) {
+        PyBuffer_Release(&sequence);
+        PyErr_SetString(PyExc_ValueError, "kmer length must be between 1 and 31");
+        return NULL;
+    }
+    std::vector<uint64_t> *kmers = new std::vector<uint64_t>();
+    std::vector<int> *counts = new std::vector<int>();
+    bool failed = false;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        count_hash_seq(static_cast<const char*>(sequence.buf), sequence.len, K, NumThreads, Reverse, *kmers, *counts);
+    }
+    catch (std::bad_alloc&) {
+        failed = true;
+    }
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&sequence);
+    if (failed) {
+        delete kmers;
+        delete counts;
+        return PyErr_NoMemory();
+    }
+    return wrap_hash_count(kmers, counts);
+}
+
+/* Reads the kmer lengths of a sweep, which must be ascending and between 1 and 15. */
+static bool parse_sizes(PyObject *size_list, std::vector<int> &sizes)
+{
+    PyObject *sequence = PySequence_Fast(size_list, "sizes must be a sequence");
+    if (sequence == NULL)
+        return false;
+    for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(sequence); i++) {
+        long k = PyLong_AsLong(PySequence_Fast_GET_ITEM(sequence, i));
+        if (k == -1 && PyErr_Occurred()) {
+            Py_DECREF(sequence);
+            return false;
+        }
+        sizes.push_back(static_cast<int>(k));
+    }
+    Py_DECREF(sequence);
+    bool ordered = !sizes.empty();
+    for (size_t i = 0; ordered && i < sizes.size(); i++)
+        ordered = (sizes[i] >= 1 && sizes[i] <= 15 && (i == 0 || sizes[i] > sizes[i-1]));
+    if (!ordered)
+        PyErr_SetString(PyExc_ValueError, "sizes must be a non-empty ascending list of kmer lengths between 1 and 15");
+    return ordered;
+}
+
+/* Shared body of kmer_count_files, kmer_count_m_k_files and kmer_count_sizes_files: callback(i, counts)
+   is called with the GIL held as soon as the i-th file is counted. */
+static PyObject *count_file_list(PyObject *filenames, const std::vector<int> &sizes, int NumThreads, bool Reverse, int Prefetch, PyObject *callback)
+{
+    if (!PyCallable_Check(callback)) {
+        PyErr_SetString(PyExc_TypeError, "callback must be callable");
+        return NULL;
+    }
+    PyObject *sequence = PySequence_Fast(filenames, "filenames must be a sequence");
+    if (sequence == NULL)
+        return NULL;
+    std::vector<std::string> files;
+    for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(sequence); i++) {
+        const char *filename = PyUnicode_AsUTF8(PySequence_Fast_GET_ITEM(sequence, i));
+        if (filename == NULL) {
+            Py_DECREF(sequence);
+            return NULL;
+        }
+        files.push_back(filename);
+    }
+    Py_DECREF(sequence);
+    bool failed = false;
+    auto done = [callback, &failed](size_t i, count_vector *count_array) {
+        PyGILState_STATE state = PyGILState_Ensure();
+        PyObject *array = wrap_count_array(count_array);
+        PyObject *result = NULL;
+        if (array != NULL) {
+            result = PyObject_CallFunction(callback, "nO", static_cast<Py_ssize_t>(i), array);
+            Py_DECREF(array);
+        }
+        failed = (result == NULL);
+        Py_XDECREF(result);
+        PyGILState_Release(state);
+        return !failed;
+    };
+    Py_BEGIN_ALLOW_THREADS
+    count_files(files, sizes, NumThreads, Reverse, Prefetch, done);
+    Py_END_ALLOW_THREADS
+    if (failed)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyObject *kmer_count_files(PyObject *self, PyObject *args)
+{
+    PyObject *filenames, *callback;
+    int K, NumThreads, Prefetch;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "OiipiO", &filenames, &K, &NumThreads, &Reverse, &Prefetch, &callback))
+        return NULL;
+    return count_file_list(filenames, {K}, NumThreads, Reverse, Prefetch, callback);
+}
+
+static PyObject *kmer_count_m_k_files(PyObject *self, PyObject *args)
+{
+    PyObject *filenames, *callback;
+    int M, K, NumThreads, Prefetch;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "OiiipiO", &filenames, &M, &K, &NumThreads, &Reverse, &Prefetch, &callback))
+        return NULL;
+    return count_file_list(filenames, {M, K}, NumThreads, Reverse, Prefetch, callback);
+}
+
+static PyObject *kmer_count_sizes_files(PyObject *self, PyObject *args)
+{
+    PyObject *filenames, *size_list, *callback;
+    int NumThreads, Prefetch;
+    int Reverse = 0;
+    std::vector<int> sizes;
+    if (!PyArg_ParseTuple(args, "OOipiO", &filenames, &size_list, &NumThreads, &Reverse, &Prefetch, &callback))
+        return NULL;
+    if (!parse_sizes(size_list, sizes))
+        return NULL;
+    return count_file_list(filenames, sizes, NumThreads, Reverse, Prefetch, callback);
+}
+
+static PyObject *count_group_list(PyObject *filenames, int M, int K, int NumThreads, bool Reverse)
+{
+    PyObject *sequence = PySequence_Fast(filenames, "filenames must be a sequence");
+    if (sequence == NULL)
+        return NULL;
+    std::vector<std::string> files;
+    for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(sequence); i++) {
+        const char *filename = PyUnicode_AsUTF8(PySequence_Fast_GET_ITEM(sequence, i));
+        if (filename == NULL) {
+            Py_DECREF(sequence);
+            return NULL;
+        }
+        files.push_back(filename);
+    }
+    Py_DECREF(sequence);
+    count_vector *count_array = NULL;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        count_array = new count_vector(count_group(files, M, K, NumThreads, Reverse));
+    }
+    catch (std::bad_alloc&) {
+        count_array = NULL;
+    }
+    Py_END_ALLOW_THREADS
+    return wrap_count_array(count_array);
+}
+
+static PyObject *kmer_count_group(PyObject *self, PyObject *args)
+{
+    PyObject *filenames;
+    int K, NumThreads;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "Oiip", &filenames, &K, &NumThreads, &Reverse))
+        return NULL;
+    return count_group_list(filenames, 0, K, NumThreads, Reverse);
+}
+
+static PyObject *kmer_count_m_k_group(PyObject *self, PyObject *args)
+{
+    PyObject *filenames;
+    int M, K, NumThreads;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "Oiiip", &filenames, &M, &K, &NumThreads, &Reverse))
+        return NULL;
+    return count_group_list(filenames, M, K, NumThreads, Reverse);
+}
+
+/* Same as wrap_count_array for a count array of rows records. */
+static PyObject *wrap_count_matrix(count_vector *count_array, npy_intp rows)
+{
+    PyObject *array = wrap_count_array(count_array);
+    if (array == NULL)
+        return NULL;
+    npy_intp dims[2] = {rows, rows ? static_cast<npy_intp>(PyArray_SIZE(reinterpret_cast<PyArrayObject*>(array)) / rows) : 0};
+    PyArray_Dims shape = {dims, 2};
+    PyObject *matrix = PyArray_Newshape(reinterpret_cast<PyArrayObject*>(array), &shape, NPY_CORDER);
+    Py_DECREF(array);
+    return matrix;
+}
+
+/* Reads the record offsets of a buffer, record i spans [offsets[i], offsets[i+1]). */
+static bool parse_offsets(PyObject *offset_list, Py_ssize_t length, std::vector<size_t> &offsets)
+{
+    PyArrayObject *offset_array = reinterpret_cast<PyArrayObject*>(PyArray_FROM_OTF(offset_list, NPY_INT64, NPY_ARRAY_IN_ARRAY));
+    if (offset_array == NULL)
+        return false;
+    npy_intp size = PyArray_SIZE(offset_array);
+    const npy_int64 *data = static_cast<const npy_int64*>(PyArray_DATA(offset_array));
+    offsets.assign(data, data + size);
+    bool ordered = (PyArray_NDIM(offset_array) == 1 && size >= 1 && data[0] >= 0 && data[size-1] <= length);
+    for (npy_intp i = 1; ordered && i < size; i++)
+        ordered = (data[i] >= data[i-1]);
+    Py_DECREF(offset_array);
+    if (!ordered)
+        PyErr_SetString(PyExc_ValueError, "offsets must be a non-decreasing 1-d array within the buffer, with one more entry than records");
+    return ordered;
+}
+
+static PyObject *count_batch_buffer(Py_buffer *sequence, PyObject *offset_list, const std::vector<int> &sizes, int NumThreads, bool Reverse)
+{
+    std::vector<size_t> offsets;
+    if (!parse_offsets(offset_list, sequence->len, offsets))
+        return NULL;
+    count_vector *count_array = NULL;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        count_array = new count_vector(count_batch(static_cast<const char*>(sequence->buf), offsets, sizes, NumThreads, Reverse));
+    }
+    catch (std::bad_alloc&) {
+        count_array = NULL;
+    }
+    Py_END_ALLOW_THREADS
+    return wrap_count_matrix(count_array, offsets.size() - 1);
+}
+
+static PyObject *kmer_count_batch(PyObject *self, PyObject *args)
+{
+    Py_buffer sequence;
+    PyObject *offsets;
+    int K, NumThreads;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "s*Oiip", &sequence, &offsets, &K, &NumThreads, &Reverse))
+        return NULL;
+    PyObject *result = count_batch_buffer(&sequence, offsets, {K}, NumThreads, Reverse);
+    PyBuffer_Release(&sequence);
+    return result;
+}
+
+static PyObject *kmer_count_m_k_batch(PyObject *self, PyObject *args)
+{
+    Py_buffer sequence;
+    PyObject *offsets;
+    int M, K, NumThreads;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "s*Oiiip", &sequence, &offsets, &M, &K, &NumThreads, &Reverse))
+        return NULL;
+    PyObject *result = count_batch_buffer(&sequence, offsets, {M, K}, NumThreads, Reverse);
+    PyBuffer_Release(&sequence);
+    return result;
+}
+
+static PyObject *kmer_count_sizes_batch(PyObject *self, PyObject *args)
+{
+    Py_buffer sequence;
+    PyObject *offsets, *size_list;
+    int NumThreads;
+    int Reverse = 0;
+    std::vector<int> sizes;
+    if (!PyArg_ParseTuple(args, "s*OOip", &sequence, &offsets, &size_list, &NumThreads, &Reverse))
+        return NULL;
+    PyObject *result = NULL;
+    if (parse_sizes(size_list, sizes))
+        result = count_batch_buffer(&sequence, offsets, sizes, NumThreads, Reverse);
+    PyBuffer_Release(&sequence);
+    return result;
+}
+
+static PyObject *kmer_count_hash_batch(PyObject *self, PyObject *args)
+{
+    Py_buffer sequence;
+    PyObject *offset_list;
+    int K, NumThreads;
+    int Reverse = 0;
+    if (!PyArg_ParseTuple(args, "s*Oiip", &sequence, &offset_list, &K, &NumThreads, &Reverse))
+        return NULL;
+    std::vector<size_t> offsets;
+    if (K <= 0 || K > 31) {
+        PyBuffer_Release(&sequence);
+        PyErr_SetString(PyExc_ValueError, "kmer length must be between 1 and 31");
+        return NULL;
+    }
+    if (!parse_offsets(offset_list, sequence.len, offsets)) {
+        PyBuffer_Release(&sequence);
+        return NULL;
+    }
+    std::vector<int64_t> *indptr = new std::vector<int64_t>();
+    std::vector<uint64_t> *kmers = new std::vector<uint64_t>();
+    std::vector<int> *counts = new std::vector<int>();
+    bool failed = false;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        count_hash_batch(static_cast<const char*>(sequence.buf), offsets, K, NumThreads, Reverse, *indptr, *kmers, *counts);
+    }
+    catch (std::bad_alloc&) {
+        failed = true;
+    }
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&sequence);
+    if (failed) {
+        delete indptr;
+        delete kmers;
+        delete counts;
+        return PyErr_NoMemory();
+    }
+    PyObject *indptr_array = wrap_vector(indptr, NPY_INT64);
+    PyObject *pair = wrap_hash_count(kmers, counts);
+    if (indptr_array == NULL || pair == NULL) {
+        Py_XDECREF(indptr_array);
+        Py_XDECREF(pair);
+        return NULL;
+    }
+    PyObject *result = Py_BuildValue("NOO", indptr_array, PyTuple_GET_ITEM(pair, 0), PyTuple_GET_ITEM(pair, 1));
+    Py_DECREF(pair);
+    return result;
+}
+
+/* Joins of neighbour joining on a condensed distance matrix of N nodes, as (ids, lengths). */
+static PyObject *neighbor_joining_steps(PyObject *self, PyObject *args)
+{
+    PyObject *condensed_list;
+    Py_ssize_t N;
+    if (!PyArg_ParseTuple(args, "On", &condensed_list, &N))
+        return NULL;
+    PyArrayObject *condensed = reinterpret_cast<PyArrayObject*>(PyArray_FROM_OTF(condensed_list, NPY_FLOAT64, NPY_ARRAY_IN_ARRAY));
+    if (condensed == NULL)
+        return NULL;
+    if (N < 2 || N >= (1 << 30) || PyArray_NDIM(condensed) != 1 || PyArray_SIZE(condensed) != N * (N - 1) / 2) {
+        Py_DECREF(condensed);
+        PyErr_SetString(PyExc_ValueError, "condensed must be a 1-d array of N*(N-1)/2 distances of at least 2 nodes");
+        return NULL;
+    }
+    std::vector<int64_t> *ids = new std::vector<int64_t>();
+    std::vector<double> *lengths = new std::vector<double>();
+    bool failed = false;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        neighbor_joining(static_cast<const double*>(PyArray_DATA(condensed)), N, *ids, *lengths);
+    }
+    catch (std::bad_alloc&) {
+        failed = true;
+    }
+    Py_END_ALLOW_THREADS
+    Py_DECREF(condensed);
+    if (failed) {
+        delete ids;
+        delete lengths;
+        return PyErr_NoMemory();
+    }
+    PyObject *id_array = wrap_vector(ids, NPY_INT64);
+    PyObject *length_array = wrap_vector(lengths, NPY_FLOAT64);
+    if (id_array == NULL || length_array == NULL) {
+        Py_XDECREF(id_array);
+        Py_XDECREF(length_array);
+        return NULL;
+    }
+    return Py_BuildValue("NN", id_array, length_array);
 }
 
 static PyMethodDef module_methods[] = {
@@ -93,6 +578,18 @@ static PyMethodDef module_methods[] = {
     {"kmer_count_m_k_seq", kmer_count_m_k_seq, METH_VARARGS, ""},
     {"kmer_count", kmer_count, METH_VARARGS, ""},
     {"kmer_count_seq", kmer_count_seq, METH_VARARGS, ""},
+    {"kmer_count_files", kmer_count_files, METH_VARARGS, ""},
+    {"kmer_count_hash", kmer_count_hash, METH_VARARGS, ""},
+    {"kmer_count_hash_seq", kmer_count_hash_seq, METH_VARARGS, ""},
+    {"kmer_count_m_k_files", kmer_count_m_k_files, METH_VARARGS, ""},
+    {"kmer_count_group", kmer_count_group, METH_VARARGS, ""},
+    {"kmer_count_m_k_group", kmer_count_m_k_group, METH_VARARGS, ""},
+    {"kmer_count_batch", kmer_count_batch, METH_VARARGS, ""},
+    {"kmer_count_m_k_batch", kmer_count_m_k_batch, METH_VARARGS, ""},
+    {"kmer_count_hash_batch", kmer_count_hash_batch, METH_VARARGS, ""},
+    {"kmer_count_sizes_files", kmer_count_sizes_files, METH_VARARGS, ""},
+    {"kmer_count_sizes_batch", kmer_count_sizes_batch, METH_VARARGS, ""},
+    {"neighbor_joining_steps", neighbor_joining_steps, METH_VARARGS, ""},
     {NULL, NULL, 0, NULL}
 };
 
@@ -0,0 +1,242 @@
+#include <cstdint>
+#include <algorithm>
+
+// Kmers up to K=31 encoded in 64 bits and counted in a concurrent open addressing
+// hash table, so memory grows with the number of distinct kmers instead of 4^K.
+// Include after kmer_count_multithreads.h.
+
+const uint64_t EMPTY_KMER = ~uint64_t(0);
+
+// Appends the 64 bit codes of all kmers of one record to codes, false if the record is not a sequence
+bool record_kmers(int K, const char *one_read, size_t length, bool Reverse, std::vector<uint64_t> &codes) {
+    const uint64_t mask = (uint64_t(1) << (2*K)) - 1;
+    const int shift = 2 * (K-1);
+    uint64_t num = 0;
+    uint64_t rev = 0;
+    int j = 0;
+    std::unordered_map<char, int>::iterator search;
+    for (size_t i=0;i<length;i++){
+        search = nuc2num.find(one_read[i]);
+        if (search == nuc2num.end()) return false;
+        int nuc_num = search -> second;
+        if (nuc_num == -1){
+            j = 0;
+            continue;
+        }
+        num = ((num << 2) | nuc_num) & mask;
+        rev = (rev >> 2) | (uint64_t(3-nuc_num) << shift);
+        if (j < (K-1)) {
+            j += 1;
+            continue;
+        }
+        codes.push_back(num);
+        if (Reverse) codes.push_back(rev);
+    }
+    return true;
+}
+
+// The table starts small and doubles before the codes of a read could push its load over one half.
+// Reads are added concurrently, a read reserves room for all its codes first and the table only grows
+// while no read is being added.
+struct kmer_table {
+    static const uint64_t MIN_SIZE = 1024;
+    std::vector<std::atomic<uint64_t>> keys;
+    std::vector<std::atomic<int>> counts;
+    uint64_t mask;
+    std::atomic<uint64_t> filled;
+    uint64_t reserved;
+    int adding;
+    std::mutex mutex;
+    std::condition_variable cv;
+
+    kmer_table() : keys(MIN_SIZE), counts(MIN_SIZE), mask(MIN_SIZE - 1), filled(0), reserved(0), adding(0) {
+        for (auto &key : keys) key = EMPTY_KMER;
+    }
+
+    static uint64_t hash(uint64_t code) {
+        code ^= code >> 33;
+        code *= 0xff51afd7ed558ccdULL;
+        code ^= code >> 33;
+        code *= 0xc4ceb9fe1a85ec53ULL;
+        code ^= code >> 33;
+        return code;
+    }
+
+    // The load stays under one half, so a free slot is always found
+    void add(uint64_t code, int count) {
+        uint64_t slot = hash(code) & mask;
+        while (true) {
+            uint64_t key = keys[slot].load(std::memory_order_relaxed);
+            if (key == EMPTY_KMER) {
+                if (keys[slot].compare_exchange_strong(key, code)) {
+                    filled++;
+                    counts[slot] += count;
+                    return;
+                }
+            }
+            if (key == code) {
+                counts[slot] += count;
+                return;
+            }
+            slot = (slot + 1) & mask;
+        }
+    }
+
+    // Rehashes into a table of at least twice needed slots, only called with no read being added
+    void grow(uint64_t needed) {
+        uint64_t size = keys.size();
+        while (size < 2 * needed) size <<= 1;
+        std::vector<std::atomic<uint64_t>> old_keys(size);
+        std::vector<std::atomic<int>> old_counts(size);
+        old_keys.swap(keys);
+        old_counts.swap(counts);
+        for (auto &key : keys) key = EMPTY_KMER;
+        mask = size - 1;
+        filled = 0;
+        for (size_t slot = 0; slot < old_keys.size(); slot++)
+            if (old_keys[slot] != EMPTY_KMER) add(old_keys[slot], old_counts[slot]);
+    }
+
+    void add_read(const std::vector<uint64_t> &codes) {
+        const uint64_t n = codes.size();
+        {
+            std::unique_lock<std::mutex> lock(mutex);
+            while (2 * (filled + reserved + n) > keys.size()) {
+                if (adding == 0) grow(filled + n);
+                else cv.wait(lock);
+            }
+            reserved += n;
+            adding++;
+        }
+        for (uint64_t code : codes) add(code, 1);
+        std::unique_lock<std::mutex> lock(mutex);
+        reserved -= n;
+        adding--;
+        cv.notify_all();
+    }
+};
+
+void count_one_read_hash(int id, int K, const char *one_read, int length, kmer_table &table, bool Reverse, std::atomic<bool> &valid) {
+    std::vector<uint64_t> codes;
+    if (!record_kmers(K, one_read, length, Reverse, codes)) {
+        valid = false;
+        return;
+    }
+    table.add_read(codes);
+}
+
+// Sorts the filled slots by kmer code, an invalid sequence gives the single pair (0, -1)
+void collect_hash(kmer_table &table, bool valid, std::vector<uint64_t> &kmers, std::vector<int> &counts) {
+    std::vector<std::pair<uint64_t, int>> filled;
+    if (valid) {
+        for (uint64_t slot = 0; slot <= table.mask; slot++) {
+            uint64_t key = table.keys[slot];
+            if (key != EMPTY_KMER) filled.push_back(std::make_pair(key, int(table.counts[slot])));
+        }
+    }
+    else filled.push_back(std::make_pair(uint64_t(0), -1));
+    std::sort(filled.begin(), filled.end());
+    kmers.resize(filled.size());
+    counts.resize(filled.size());
+    for (size_t i = 0; i < filled.size(); i++) {
+        kmers[i] = filled[i].first;
+        counts[i] = filled[i].second;
+    }
+}
+
+void count_hash(std::string filename, int K, int Num_Threads, bool Reverse, std::vector<uint64_t> &kmers, std::vector<int> &counts) {
+    std::atomic<bool> valid(true);
+    kmer_table table;
+    auto count_read = [K, Reverse, &table, &valid](const char *read, int length, bool overlap) {
+        if (valid) count_one_read_hash(0, K, read, length, table, Reverse, valid);
+    };
+    if (!count_ranges(filename, K, Num_Threads, count_read)) valid = false;
+    collect_hash(table, valid, kmers, counts);
+}
+
+void count_hash_seq(const char *sequence, size_t length, int K, int Num_Threads, bool Reverse, std::vector<uint64_t> &kmers, std::vector<int> &counts) {
+    std::atomic<bool> valid(true);
+    std::atomic<bool> failed(false);
+    const unsigned int READ_LENGTH = 5000;
+    kmer_table table;
+    ctpl::thread_pool p(std::max(1, Num_Threads));
+    for (size_t i = 0;i < length; i += (READ_LENGTH-K+1)) {
+        if (valid && !failed) {
+            const char *read = sequence + i;
+            int read_length = std::min<size_t>(READ_LENGTH, length-i);
+            p.push([read, read_length, K, Reverse, &table, &valid, &failed](int id){
+                try {
+                    count_one_read_hash(id, K, read, read_length, table, Reverse, valid);
+                }
+                catch (std::bad_alloc&) {
+                    failed = true;
+                }
+            });
+        }
+        else break;
+    }
+    p.stop(true);
+    if (failed) throw std::bad_alloc();
+    collect_hash(table, valid, kmers, counts);
+}
+
+// Counts N records of one buffer, record i spans [offsets[i], offsets[i+1]), by sorting the codes of
+// each record, so short records cost no table at all. The result is in CSR form: the sorted kmers and
+// counts of record i are [indptr[i], indptr[i+1]), an invalid record gives the single pair (0, -1).
+void count_hash_batch(const char *sequence, const std::vector<size_t> &offsets, int K, int Num_Threads, bool Reverse,
+                      std::vector<int64_t> &indptr, std::vector<uint64_t> &kmers, std::vector<int> &counts) {
+    const size_t JOB_SIZE = 1 << 16;
+    const size_t N = offsets.size() - 1;
+    std::vector<std::vector<uint64_t>> record_codes(N);
+    std::vector<std::vector<int>> record_counts(N);
+    ctpl::thread_pool p(std::max(1, Num_Threads));
+    size_t first = 0;
+    std::atomic<bool> failed(false);
+    auto push = [&](size_t begin, size_t end) {
+        p.push([begin, end, K, Reverse, sequence, &offsets, &record_codes, &record_counts, &failed](int id) {
+            try {
+                std::vector<uint64_t> codes;
+                for (size_t r = begin; r < end; r++) {
+                    codes.clear();
+                    std::vector<uint64_t> &unique = record_codes[r];
+                    std::vector<int> &count = record_counts[r];
+                    if (!record_kmers(K, sequence + offsets[r], offsets[r+1] - offsets[r], Reverse, codes)) {
+                        unique.assign(1, 0);
+                        count.assign(1, -1);
+                        continue;
+                    }
+                    std::sort(codes.begin(), codes.end());
+                    for (size_t i = 0; i < codes.size(); i++) {
+                        if (i == 0 || codes[i] != codes[i-1]) {
+                            unique.push_back(codes[i]);
+                            count.push_back(0);
+                        }
+                        count.back()++;
+                    }
+                }
+            }
+            catch (std::bad_alloc&) {
+                failed = true;
+            }
+        });
+    };
+    for (size_t r = 0; r < N; r++) {
+        if (offsets[r+1] - offsets[first] >= JOB_SIZE) {
+            push(first, r + 1);
+            first = r + 1;
+        }
+    }
+    if (first < N) push(first, N);
+    p.stop(true);
+    if (failed) throw std::bad_alloc();
+    indptr.assign(1, 0);
+    for (size_t r = 0; r < N; r++) indptr.push_back(indptr.back() + record_codes[r].size());
+    kmers.reserve(indptr.back());
+    counts.reserve(indptr.back());
+    for (size_t r = 0; r < N; r++) {
+        kmers.insert(kmers.end(), record_codes[r].begin(), record_codes[r].end());
+        counts.insert(counts.end(), record_counts[r].begin(), record_counts[r].end());
+        std::vector<uint64_t>().swap(record_codes[r]);
+        std::vector<int>().swap(record_counts[r]);
+    }
+}
@@ -7,13 +7,22 @@
 #include <thread>
 #include <unistd.h>
 #include <atomic>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <cstring>
+#include <deque>
+#include <mutex>
+#include <condition_variable>
+#include <functional>
+#include <future>
+#include <memory>
 
 
 std::atomic<int> X;
-bool VALID = true;
 std::unordered_map<char, int> nuc2num = {
         {'\r', -1}, {'B', -1}, {'H', -1}, {'D', -1}, {'V', -1}, {'K', -1}, {'W', -1}, {'S', -1}, {'M', -1}, {'Y' , -1}, {'R', -1}, {'N', -1}, {'A', 0}, {'C', 1 }, {'G', 2}, {'T', 3},
-	{'b', -1}, {'h', -1}, {'d', -1}, {'v', -1}, {'k', -1}, {'w', -1}, {'s', -1}, {'m', -1}, {'y', -1}, {'r', -1}, {'n', -1}, {'a', 0}, {'c', 1}, {'g', 2}, {'t', 3}, {'$', -2}
+	{'b', -1}, {'h', -1}, {'d', -1}, {'v', -1}, {'k', -1}, {'w', -1}, {'s', -1}, {'m', -1}, {'y', -1}, {'r', -1}, {'n', -1}, {'a', 0}, {'c', 1}, {'g', 2}, {'t', 3}
 };
 
 int revcomp(int num, int K){
@@ -27,8 +36,7 @@ int revcomp(int num, int K){
 }
 
 
-void count_one_read(int id, int K, std::string one_read, std::vector<std::atomic<int>> &count_array, bool Reverse) {
-    int length = one_read.length();
+void count_one_read(int id, int K, const char *one_read, int length, std::atomic<int> *count_array, bool Reverse, std::atomic<bool> &valid) {
     int mask = pow(2, (2*(K-1)))-1;
     int num = 0;
     int nuc_num = 0;
@@ -40,7 +48,7 @@ void count_one_read(int id, int K, std::string one_read, std::vector<std::atomic
         nuc = one_read[i];
         search = nuc2num.find(nuc);
         if (search == nuc2num.end()){
-            ::VALID = false;
+            valid = false;
             return;
         }
         else {
@@ -74,8 +82,8 @@ void count_one_read(int id, int K, std::string one_read, std::vector<std::atomic
     }
 }
 
-void count_one_read_M_K(int id, int M, int K, std::string one_read, std::vector<std::atomic<int>> &count_array, bool Reverse) {
-    int length = one_read.length();
+// overlap: the read repeats the last K-1 bases of the previous read, whose M-mers are already counted
+void count_one_read_M_K(int id, int M, int K, const char *one_read, int length, bool overlap, std::atomic<int> *count_array, bool Reverse, std::atomic<bool> &valid) {
     int mask_K = pow(2, (2*(K-1)))-1;
     int mask_M = pow(2, 2*M)-1;
     int num_K = 0;
@@ -84,24 +92,13 @@ void count_one_read_M_K(int id, int M, int K, std::string one_read, std::vector<
     std::unordered_map<char, int>::iterator search;
     int j = 0;
     int i = 0;
-    int M_start = 0;
     int rev_K = 0;
     char nuc;
-    nuc = one_read[0];
-    search = nuc2num.find(nuc);
-    if (search == nuc2num.end()){
-        ::VALID = false;
-        return;
-    }
-    if (search -> second == -2){
-        i = 1;
-	M_start = K-M;
-    }
     for (;i<length;i++){
         nuc = one_read[i];
         search = nuc2num.find(nuc);
         if (search == nuc2num.end()){
-            ::VALID = false;
+            valid = false;
             return;
         }
         else {
@@ -111,7 +108,6 @@ void count_one_read_M_K(int id, int M, int K, std::string one_read, std::vector<
             num_K = 0;
 	    rev_K = 0;
             j = 0;
-	    M_start = 0;
         }
         else{
 	    if (j < (M-1)){
@@ -134,120 +130,522 @@ void count_one_read_M_K(int id, int M, int K, std::string one_read, std::vector<
 			count_array[rev_K+mask_M+1]++;
                     }
                }
-	       if (M_start == 0) {
+	       if (!overlap || i >= K-1) {
 	           num_M = num_K&mask_M;
 	           count_array[num_M] ++;
 	           if (Reverse) count_array[(rev_K)>>(2*(K-M))]++;
 	       }
-	       else M_start--;
 	    }
         }
     }
 }
 
-std::vector<std::atomic<int>> count(std::string filename, int K, int Num_Threads, bool Reverse) {
-    ::VALID = true;
-    const int SIZE = pow(4, K);
-    std::vector<std::atomic<int>> count_array(SIZE);
-    std::ifstream fs(filename);
-    char temp_char[5000];
-    std::string temp;
-    std::string one_read;
-    //int Num_Threads =  std::thread::hardware_concurrency();
-    ctpl::thread_pool p(std::max(1, Num_Threads));
-    while (::VALID) {
-	fs.getline(temp_char, 5000, '\n');
-	std::string temp(temp_char);
-	if(temp[0] == '>'){
-	    one_read = one_read + "N";
-	}
-	else{
-	    one_read = one_read + temp;
-	}
-	if (one_read.length() >= 5000){
-	    p.push([one_read, K, Reverse, &count_array](int id){count_one_read(id, K, one_read, count_array, Reverse);});
-	    one_read = one_read.substr(one_read.length()-K+1);
+// Counts the k-mers of every k in sizes, which is ascending, into tables of 4^k laid out one after
+// another, e.g. the tables of a sweep over K from one scan. overlap: the read repeats the last K-1
+// bases of the previous read, K the largest size, so the k-mers that end in them are already counted.
+void count_one_read_sizes(int id, const std::vector<int> &sizes, const char *one_read, int length, bool overlap, std::atomic<int> *count_array, bool Reverse, std::atomic<bool> &valid) {
+    const int K = sizes.back();
+    const uint64_t mask = (uint64_t(1) << (2*K)) - 1;
+    std::vector<size_t> start(sizes.size(), 0);
+    for (size_t s = 1; s < sizes.size(); s++) start[s] = start[s-1] + (size_t(1) << (2*sizes[s-1]));
+    uint64_t num = 0;
+    uint64_t rev = 0;
+    int j = 0;
+    std::unordered_map<char, int>::iterator search;
+    for (int i = 0; i < length; i++) {
+        search = nuc2num.find(one_read[i]);
+        if (search == nuc2num.end()) {
+            valid = false;
+            return;
         }
-	if (fs.eof()) break;
-	fs.clear();
+        int nuc_num = search -> second;
+        if (nuc_num == -1) {
+            num = 0;
+            rev = 0;
+            j = 0;
+            continue;
+        }
+        num = ((num << 2) | nuc_num) & mask;
+        rev = (rev >> 2) | (uint64_t(3-nuc_num) << (2*(K-1)));
+        if (j < K) j++;
+        if (overlap && i < K-1) continue;
+        // j bases in a row end here, the k-mers of every k up to j
+        for (size_t s = 0; s < sizes.size() && sizes[s] <= j; s++) {
+            int k = sizes[s];
+            count_array[start[s] + (num & ((uint64_t(1) << (2*k)) - 1))]++;
+            if (Reverse) count_array[start[s] + (rev >> (2*(K-k)))]++;
+        }
+    }
+}
+
+size_t sizes_length(const std::vector<int> &sizes) {
+    size_t length = 0;
+    for (int k : sizes) length += size_t(1) << (2*k);
+    return length;
+}
+
+// {K} and {M, K} count like count() and count_M_K(), longer lists like count_one_read_sizes()
+void count_one_read_any(int id, const std::vector<int> &sizes, const char *one_read, int length, bool overlap, std::atomic<int> *count_array, bool Reverse, std::atomic<bool> &valid) {
+    if (sizes.size() == 1)
+        count_one_read(id, sizes[0], one_read, length, count_array, Reverse, valid);
+    else if (sizes.size() == 2)
+        count_one_read_M_K(id, sizes[0], sizes[1], one_read, length, overlap, count_array, Reverse, valid);
+    else
+        count_one_read_sizes(id, sizes, one_read, length, overlap, count_array, Reverse, valid);
+}
+
+// The last length characters of the flattened file before pos, which is a line start or inside a
+// sequence line, padded with 'N' at the start of the file. Every line walked back is a header, which
+// gives one 'N', or is shorter than what is still missing, except the last one.
+std::string flat_prefix(const char *data, size_t pos, size_t length) {
+    std::string prefix;
+    // the part of the line of pos before it
+    size_t line = pos;
+    while (line > 0 && data[line-1] != '\n' && pos - line < length) line--;
+    prefix.assign(data + line, pos - line);
+    if (line > 0 && data[line-1] != '\n') return prefix;
+    pos = line;
+    while (prefix.length() < length && pos > 0) {
+        size_t stop = pos - 1;
+        line = stop;
+        while (line > 0 && data[line-1] != '\n') line--;
+        if (stop > line && data[line] == '>') prefix.insert(0, 1, 'N');
+        else {
+            size_t take = std::min(length - prefix.length(), stop - line);
+            prefix.insert(0, data + stop - take, take);
+        }
+        pos = line;
+    }
+    if (prefix.length() < length) prefix.insert(0, length - prefix.length(), 'N');
+    return prefix;
+}
+
+// Splits [0, size) into ranges of about range_size bytes. A range starts at a line start or inside a
+// sequence line, never inside a header, so a sequence on a single line is split too. Returns the
+// starts, with size at the end, and whether each start is inside a line.
+void range_starts(const char *data, size_t size, size_t range_size, std::vector<size_t> &starts, std::vector<bool> &inside) {
+    starts.assign(1, 0);
+    inside.assign(1, false);
+    for (size_t pos = range_size; pos < size; pos += range_size) {
+        size_t last = starts.back();
+        if (pos <= last) continue;
+        if (data[pos-1] == '\n') {
+            starts.push_back(pos);
+            inside.push_back(false);
+            continue;
+        }
+        // the line of pos starts after the last newline since the previous start, or with it
+        const char *newline = static_cast<const char*>(memrchr(data + last, '\n', pos - last));
+        bool header = newline ? newline[1] == '>' : (!inside.back() && data[last] == '>');
+        if (!header) {
+            starts.push_back(pos);
+            inside.push_back(true);
+            continue;
+        }
+        newline = static_cast<const char*>(memchr(data + pos, '\n', size - pos));
+        if (newline == NULL) break;
+        starts.push_back(newline - data + 1);
+        inside.push_back(false);
+    }
+    if (starts.back() >= size) {
+        starts.pop_back();
+        inside.pop_back();
+    }
+    starts.push_back(size);
+}
+
+// Flattens the lines of [start, end) the way count() always did, a header line becomes a single 'N',
+// after the K-1 characters of prefix and counts it in pieces of about CHUNK_SIZE, each a sequence of
+// reads that start with the last K-1 characters of the previous one. inside: start is inside a line.
+void count_range(const char *data, size_t start, size_t end, bool inside, const std::string &prefix, int K, std::function<void(const char*, int, bool)> count_read) {
+    const size_t CHUNK_SIZE = 1 << 20;
+    const unsigned int READ_LENGTH = 5000;
+    std::string chunk = prefix;
+    auto flush = [&]() {
+        for (size_t i = 0; i + K - 1 < chunk.length(); i += (READ_LENGTH-K+1))
+            count_read(chunk.data() + i, std::min<size_t>(READ_LENGTH, chunk.length()-i), true);
+        chunk.erase(0, chunk.length() - (K-1));
+    };
+    bool at_line_start = !inside;
+    size_t pos = start;
+    while (pos < end) {
+        const char *newline;
+        if (at_line_start && data[pos] == '>') {
+            chunk.push_back('N');
+            newline = static_cast<const char*>(memchr(data + pos, '\n', end - pos));
+            pos = newline ? newline - data + 1 : end;
+            continue;
+        }
+        size_t stop = std::min(end, pos + CHUNK_SIZE);
+        newline = static_cast<const char*>(memchr(data + pos, '\n', stop - pos));
+        if (newline) stop = newline - data;
+        chunk.append(data + pos, stop - pos);
+        at_line_start = (newline != NULL);
+        pos = newline ? stop + 1 : stop;
+        if (chunk.length() >= CHUNK_SIZE) flush();
+    }
+    flush();
+}
+
+// Counts one fasta file with its memory map split into byte ranges, see range_starts, every
+// range is parsed and counted by a worker of the pool, so reading scales with Num_Threads. A range
+// gets the last K-1 flattened characters before it in front, whose kmers are counted by the range
+// before it, so a kmer that spans a range border is counted once. count_read(read, length, overlap)
+// counts one read, see count_one_read_any. Returns false if the file cannot be read.
+bool count_ranges(const std::string &filename, int K, int Num_Threads, std::function<void(const char*, int, bool)> count_read) {
+    int fd = open(filename.c_str(), O_RDONLY);
+    if (fd < 0) return false;
+    struct stat file_stat;
+    if (fstat(fd, &file_stat) != 0) {
+        close(fd);
+        return false;
+    }
+    size_t size = 0;
+    void *mapped = MAP_FAILED;
+    if (S_ISREG(file_stat.st_mode) && file_stat.st_size > 0) {
+        size = file_stat.st_size;
+        mapped = mmap(NULL, size, PROT_READ, MAP_PRIVATE, fd, 0);
+    }
+    std::string buffer;
+    const char *data;
+    if (mapped != MAP_FAILED) {
+#ifdef MADV_SEQUENTIAL
+        madvise(mapped, size, MADV_SEQUENTIAL);
+#endif
+        data = static_cast<const char*>(mapped);
+    }
+    else {
+        // a pipe or a file that cannot be mapped is read into memory instead
+        std::vector<char> block(1 << 22);
+        ssize_t n;
+        while ((n = read(fd, block.data(), block.size())) > 0) buffer.append(block.data(), n);
+        if (n < 0) {
+            close(fd);
+            return false;
+        }
+        data = buffer.data();
+        size = buffer.length();
+    }
+    close(fd);
+    const size_t RANGE_SIZE = std::max<size_t>(1 << 16, std::min<size_t>(1 << 24, size / (4 * std::max(1, Num_Threads)) + 1));
+    std::vector<size_t> starts;
+    std::vector<bool> inside;
+    range_starts(data, size, RANGE_SIZE, starts, inside);
+    std::atomic<bool> failed(false);
+    ctpl::thread_pool p(std::max(1, Num_Threads));
+    for (size_t r = 0; r + 1 < starts.size(); r++) {
+        size_t start = starts[r];
+        size_t end = starts[r+1];
+        bool start_inside = inside[r];
+        p.push([data, start, end, start_inside, K, count_read, &failed](int id) {
+            try {
+                count_range(data, start, end, start_inside, flat_prefix(data, start, K-1), K, count_read);
+            }
+            catch (std::bad_alloc&) {
+                failed = true;
+            }
+        });
     }
-    p.push([one_read, K, Reverse, &count_array](int id){count_one_read(id, K, one_read, count_array, Reverse);});
-    fs.close();
     p.stop(true);
-    if (!::VALID)  count_array[0] = -1;
+    if (mapped != MAP_FAILED) munmap(mapped, size);
+    if (failed) throw std::bad_alloc();
+    return true;
+}
+
+std::vector<std::atomic<int>> count_mapped(const std::string &filename, const std::vector<int> &sizes, int Num_Threads, bool Reverse) {
+    std::atomic<bool> valid(true);
+    std::vector<std::atomic<int>> count_array(sizes_length(sizes));
+    auto count_read = [&sizes, Reverse, &count_array, &valid](const char *read, int length, bool overlap) {
+        if (valid) count_one_read_any(0, sizes, read, length, overlap, count_array.data(), Reverse, valid);
+    };
+    if (!count_ranges(filename, sizes.back(), Num_Threads, count_read)) valid = false;
+    if (!valid) count_array[0] = -1;
     return count_array;
 }
 
-std::vector<std::atomic<int>> count_seq(std::string sequence, int K, int Num_Threads, bool Reverse) {
-    ::VALID = true;
+std::vector<std::atomic<int>> count(std::string filename, int K, int Num_Threads, bool Reverse) {
+    return count_mapped(filename, {K}, Num_Threads, Reverse);
+}
+
+// sequence is only read, workers count views of it in place
+std::vector<std::atomic<int>> count_seq(const char *sequence, size_t length, int K, int Num_Threads, bool Reverse) {
+    std::atomic<bool> valid(true);
     const int SIZE = pow(4, K);
     const unsigned int READ_LENGTH = 5000;
     std::vector<std::atomic<int>> count_array(SIZE);
     ctpl::thread_pool p(std::max(1, Num_Threads));
-    std::string temp;
-    for (unsigned i = 0;i < sequence.length(); i += (READ_LENGTH-K+1)) {
-        if (::VALID) {
-            temp = sequence.substr(i, READ_LENGTH);
-            p.push([temp, K, Reverse, &count_array](int id){count_one_read(id, K, temp, count_array, Reverse);});
+    for (size_t i = 0;i < length; i += (READ_LENGTH-K+1)) {
+        if (valid) {
+            const char *read = sequence + i;
+            int read_length = std::min<size_t>(READ_LENGTH, length-i);
+            p.push([read, read_length, K, Reverse, &count_array, &valid](int id){count_one_read(id, K, read, read_length, count_array.data(), Reverse, valid);});
         }
         else break;
     }
     p.stop(true);
-    if (!::VALID) count_array[0] = -1;
+    if (!valid) count_array[0] = -1;
     return count_array;
 }
 
 std::vector<std::atomic<int>> count_M_K(std::string filename, int M, int K, int Num_Threads, bool Reverse) {
-    ::VALID = true;
+    return count_mapped(filename, {M, K}, Num_Threads, Reverse);
+}
+
+std::vector<std::atomic<int>> count_M_K_seq(const char *sequence, size_t length, int M, int K, int Num_Threads, bool Reverse) {
+    std::atomic<bool> valid(true);
     const int SIZE = pow(4, M) + pow(4, K);
     const unsigned int READ_LENGTH = 5000;
     std::vector<std::atomic<int>> count_array(SIZE);
-    std::ifstream fs(filename);
-    char temp_char[READ_LENGTH];
-    std::string temp;
-    std::string one_read;
-    //int Num_Threads =  std::thread::hardware_concurrency();
     ctpl::thread_pool p(std::max(1, Num_Threads));
-    while (::VALID) {
-        fs.getline(temp_char, READ_LENGTH, '\n');
-        std::string temp(temp_char);
-        if(temp[0] == '>'){
-            one_read = one_read + "N";
+    for (size_t i = 0;i < length; i += (READ_LENGTH-K+1)) {
+        if (valid) { 
+            const char *read = sequence + i;
+            int read_length = std::min<size_t>(READ_LENGTH, length-i);
+            bool overlap = (i != 0);
+            p.push([read, read_length, overlap, M, K, Reverse, &count_array, &valid](int id){count_one_read_M_K(id, M, K, read, read_length, overlap, count_array.data(), Reverse, valid);}); 
         }
-        else{
-            one_read = one_read + temp;
+        else break;
+    }
+    p.stop(true);
+    if (!valid) count_array[0] = -1;
+    return count_array;
+}
+  
+
+// Reads a whole fasta file with large sequential reads and flattens it the way count() does:
+// every header line becomes a single 'N' and the sequence lines are joined.
+bool read_fasta(const std::string &filename, std::string &sequence) {
+    const size_t BLOCK_SIZE = 1 << 22;
+    int fd = open(filename.c_str(), O_RDONLY);
+    if (fd < 0) return false;
+#ifdef POSIX_FADV_SEQUENTIAL
+    posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL);
+#endif
+    std::vector<char> block(BLOCK_SIZE);
+    bool line_start = true;
+    bool header = false;
+    ssize_t n;
+    sequence.clear();
+    while ((n = read(fd, block.data(), BLOCK_SIZE)) > 0) {
+        const char *start = block.data();
+        const char *end = start + n;
+        while (start < end) {
+            if (line_start) {
+                header = (*start == '>');
+                if (header) sequence.push_back('N');
+                line_start = false;
+            }
+            const char *newline = static_cast<const char*>(memchr(start, '\n', end - start));
+            const char *stop = newline ? newline : end;
+            if (!header) sequence.append(start, stop);
+            if (newline) line_start = true;
+            start = stop + (newline ? 1 : 0);
+        }
+    }
+    close(fd);
+    return n == 0;
+}
+
+// Pushes chunk views of sequence onto a shared pool, the caller waits on jobs.
+void push_seq(ctpl::thread_pool &p, std::vector<std::future<void>> &jobs, const char *sequence, size_t length, const std::vector<int> &sizes, std::vector<std::atomic<int>> &count_array, bool Reverse, std::atomic<bool> &valid) {
+    const unsigned int READ_LENGTH = 5000;
+    const int K = sizes.back();
+    for (size_t i = 0;i < length; i += (READ_LENGTH-K+1)) {
+        const char *read = sequence + i;
+        int read_length = std::min<size_t>(READ_LENGTH, length-i);
+        bool overlap = (i != 0);
+        jobs.push_back(p.push([read, read_length, overlap, &sizes, Reverse, &count_array, &valid](int id){count_one_read_any(id, sizes, read, read_length, overlap, count_array.data(), Reverse, valid);}));
+    }
+}
+
+// Counts a list of files with one persistent pool while a reader thread loads up to
+// Prefetch files ahead, so disk reads overlap counting. The counts of every file hold the
+// tables of sizes, like count_one_read_any. done(i, counts) takes ownership of the counts
+// of the i-th file (NULL if they could not be allocated), files are reported in order,
+// and returning false stops the run.
+void count_files(const std::vector<std::string> &filenames, const std::vector<int> &sizes, int Num_Threads, bool Reverse, int Prefetch,
+                 std::function<bool(size_t, std::vector<std::atomic<int>>*)> done) {
+    const size_t SIZE = sizes_length(sizes);
+    std::deque<std::pair<bool, std::string>> loaded;
+    std::mutex mutex;
+    std::condition_variable cv;
+    bool stop = false;
+    std::thread reader([&]() {
+        for (size_t i = 0; i < filenames.size(); i++) {
+            std::pair<bool, std::string> item;
+            try {
+                item.first = read_fasta(filenames[i], item.second);
+            }
+            catch (std::bad_alloc&) {
+                item.first = false;
+                item.second.clear();
+            }
+            std::unique_lock<std::mutex> lock(mutex);
+            cv.wait(lock, [&]() { return stop || (int)loaded.size() < std::max(1, Prefetch); });
+            if (stop) return;
+            loaded.push_back(std::move(item));
+            cv.notify_all();
+        }
+    });
+    ctpl::thread_pool p(std::max(1, Num_Threads));
+    for (size_t i = 0; i < filenames.size(); i++) {
+        std::pair<bool, std::string> item;
+        {
+            std::unique_lock<std::mutex> lock(mutex);
+            cv.wait(lock, [&]() { return !loaded.empty(); });
+            item = std::move(loaded.front());
+            loaded.pop_front();
+            cv.notify_all();
+        }
+        std::vector<std::atomic<int>> *count_array = NULL;
+        try {
+            count_array = new std::vector<std::atomic<int>>(SIZE);
+        }
+        catch (std::bad_alloc&) {
+        }
+        if (count_array != NULL) {
+            std::atomic<bool> valid(item.first);
+            std::vector<std::future<void>> jobs;
+            if (valid) push_seq(p, jobs, item.second.data(), item.second.length(), sizes, *count_array, Reverse, valid);
+            for (auto &job : jobs) job.wait();
+            if (!valid) (*count_array)[0] = -1;
+        }
+        if (!done(i, count_array)) {
+            std::unique_lock<std::mutex> lock(mutex);
+            stop = true;
+            cv.notify_all();
+            break;
+        }
+    }
+    reader.join();
+    p.stop(true);
+}
+
+// Streams one fasta file onto a shared pool in chunks of flattened sequence, like count() but with
+// large sequential reads. Each chunk starts with the last K-1 bases of the previous one, and at most
+// Max_Jobs chunks are queued at a time so memory stays bounded.
+void push_fasta(ctpl::thread_pool &p, const std::string &filename, int M, int K, std::vector<std::atomic<int>> &count_array, bool Reverse, std::atomic<bool> &valid, size_t Max_Jobs) {
+    const size_t BLOCK_SIZE = 1 << 22;
+    const size_t CHUNK_SIZE = 1 << 20;
+    int fd = open(filename.c_str(), O_RDONLY);
+    if (fd < 0) {
+        valid = false;
+        return;
+    }
+#ifdef POSIX_FADV_SEQUENTIAL
+    posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL);
+#endif
+    std::deque<std::future<void>> jobs;
+    std::shared_ptr<std::string> chunk = std::make_shared<std::string>();
+    bool overlap = false;
+    auto flush = [&]() {
+        std::shared_ptr<std::string> read = chunk;
+        if (M > 0)
+            jobs.push_back(p.push([read, overlap, M, K, Reverse, &count_array, &valid](int id){count_one_read_M_K(id, M, K, read->data(), read->length(), overlap, count_array.data(), Reverse, valid);}));
+        else
+            jobs.push_back(p.push([read, K, Reverse, &count_array, &valid](int id){count_one_read(id, K, read->data(), read->length(), count_array.data(), Reverse, valid);}));
+        // a file shorter than K-1 bases is carried whole, only the final flush can be that short
+        chunk = std::make_shared<std::string>(read->length() >= size_t(K-1) ? read->substr(read->length() - (K-1)) : *read);
+        overlap = true;
+        while (jobs.size() > Max_Jobs) {
+            jobs.front().wait();
+            jobs.pop_front();
         }
-        if (one_read.length() >= READ_LENGTH){
-            p.push([one_read, M, K, Reverse, &count_array](int id){count_one_read_M_K(id, M, K, one_read, count_array, Reverse);});
-            one_read = "$" + one_read.substr(one_read.length()-K+1);
+    };
+    std::vector<char> block(BLOCK_SIZE);
+    bool line_start = true;
+    bool header = false;
+    ssize_t n;
+    while (valid && (n = read(fd, block.data(), BLOCK_SIZE)) > 0) {
+        const char *start = block.data();
+        const char *end = start + n;
+        while (start < end) {
+            if (line_start) {
+                header = (*start == '>');
+                if (header) chunk->push_back('N');
+                line_start = false;
+            }
+            const char *newline = static_cast<const char*>(memchr(start, '\n', end - start));
+            const char *stop = newline ? newline : end;
+            if (!header) chunk->append(start, stop);
+            if (newline) line_start = true;
+            start = stop + (newline ? 1 : 0);
         }
-        if (fs.eof()) break;
-        fs.clear();
+        if (chunk->length() >= CHUNK_SIZE) flush();
     }
-    p.push([one_read, M, K, Reverse, &count_array](int id){count_one_read_M_K(id, M, K, one_read, count_array, Reverse);});
-    fs.close();
+    if (n < 0) valid = false;
+    close(fd);
+    if (valid) flush();
+    for (auto &job : jobs) job.wait();
+}
+
+// Counts several files of one sample into a single count array, every file is read by its own
+// thread and all of them share one pool. M == 0 counts K-mers only, otherwise the layout matches count_M_K.
+std::vector<std::atomic<int>> count_group(const std::vector<std::string> &filenames, int M, int K, int Num_Threads, bool Reverse) {
+    std::atomic<bool> valid(true);
+    const int SIZE = (M > 0) ? pow(4, M) + pow(4, K) : pow(4, K);
+    std::vector<std::atomic<int>> count_array(SIZE);
+    ctpl::thread_pool p(std::max(1, Num_Threads));
+    const size_t Max_Jobs = 2 * std::max(1, Num_Threads);
+    std::vector<std::thread> readers;
+    for (const auto &filename : filenames)
+        readers.push_back(std::thread([&, filename]() {
+            try {
+                push_fasta(p, filename, M, K, count_array, Reverse, valid, Max_Jobs);
+            }
+            catch (std::exception&) {
+                valid = false;
+            }
+        }));
+    for (auto &reader : readers) reader.join();
     p.stop(true);
-    if (!::VALID) count_array[0] = -1;
+    if (!valid) count_array[0] = -1;
     return count_array;
 }
 
-std::vector<std::atomic<int>> count_M_K_seq(std::string sequence, int M, int K, int Num_Threads, bool Reverse) {
-    ::VALID = true;
-    const int SIZE = pow(4, M) + pow(4, K);
+// Counts N records of one buffer, record i spans [offsets[i], offsets[i+1]), into one N x SIZE array
+// with one pool. Short records are grouped so each job counts about JOB_SIZE bases. Every row holds
+// the tables of sizes, like count_one_read_any. Rows of invalid records start with -1.
+std::vector<std::atomic<int>> count_batch(const char *sequence, const std::vector<size_t> &offsets, const std::vector<int> &sizes, int Num_Threads, bool Reverse) {
+    const size_t SIZE = sizes_length(sizes);
+    const int K = sizes.back();
     const unsigned int READ_LENGTH = 5000;
-    std::vector<std::atomic<int>> count_array(SIZE);
+    const size_t JOB_SIZE = 1 << 16;
+    const size_t N = offsets.size() - 1;
+    std::vector<std::atomic<int>> count_array(N * SIZE);
+    std::vector<std::atomic<bool>> valid(N);
+    for (auto &v : valid) v = true;
+    struct read_view {
+        const char *read;
+        int length;
+        bool overlap;
+        size_t row;
+    };
     ctpl::thread_pool p(std::max(1, Num_Threads));
-    std::string temp;
-    for (unsigned i = 0;i < sequence.length(); i += (READ_LENGTH-K+1)) {
-        if (::VALID) { 
-            if (i==0) temp = sequence.substr(i, READ_LENGTH);
-            else temp = "$" + sequence.substr(i, READ_LENGTH);
-            p.push([temp, M, K, Reverse, &count_array](int id){count_one_read_M_K(id, M, K, temp, count_array, Reverse);}); 
+    std::vector<read_view> job;
+    size_t job_size = 0;
+    auto push = [&]() {
+        p.push([job, &sizes, SIZE, Reverse, &count_array, &valid](int id) {
+            for (const auto &view : job) {
+                if (!valid[view.row]) continue;
+                std::atomic<int> *row = count_array.data() + view.row * SIZE;
+                count_one_read_any(id, sizes, view.read, view.length, view.overlap, row, Reverse, valid[view.row]);
+            }
+        });
+        job.clear();
+        job_size = 0;
+    };
+    for (size_t r = 0; r < N; r++) {
+        for (size_t i = offsets[r]; i < offsets[r+1]; i += (READ_LENGTH-K+1)) {
+            int read_length = std::min<size_t>(READ_LENGTH, offsets[r+1]-i);
+            job.push_back({sequence + i, read_length, i != offsets[r], r});
+            job_size += read_length;
+            if (job_size >= JOB_SIZE) push();
         }
-        else break;
     }
+    if (!job.empty()) push();
     p.stop(true);
-    if (!::VALID) count_array[0] = -1;
+    for (size_t r = 0; r < N; r++)
+        if (!valid[r]) count_array[r * SIZE] = -1;
     return count_array;
 }
-  
@@ -0,0 +1,148 @@
+#include <vector>
+#include <cstdint>
+#include <algorithm>
+#include <limits>
+
+// Neighbour joining with the bounds of rapidNJ (Simonsen et al. 2008). Each step joins the pair with the
+// smallest Q(i, j) = (n-2)*D(i, j) - r(i) - r(j). Every node keeps the ids of the nodes that existed when
+// it was created sorted by distance, so every pair is in the sorted row of its younger node and the
+// distances of a row never change while both nodes are active. A row is scanned in that order until
+// (n-2)*D(i, j) - r(i) - max(r) reaches the best Q found, a lower bound of the rest of the row, so the
+// joins are those of the canonical O(N^3) algorithm after a few entries of each row.
+//
+// condensed: the upper triangle of the N x N distances row by row. The joined node of step s gets the
+// id N+s. ids and lengths get the two nodes of each step with their branch lengths, then the last 2 or
+// 3 nodes with theirs. The n active nodes are kept in the first n slots, the last one fills a hole.
+void neighbor_joining(const double *condensed, int64_t N, std::vector<int64_t> &ids, std::vector<double> &lengths) {
+    const double INF = std::numeric_limits<double>::infinity();
+    const int32_t PADDING = 2 * N - 1;
+    std::vector<double> D(N * N);
+    std::vector<double> r(N, 0);
+    size_t k = 0;
+    for (int64_t i = 0; i < N; i++) {
+        D[i*N + i] = INF;
+        for (int64_t j = i + 1; j < N; j++) {
+            D[i*N + j] = D[j*N + i] = condensed[k++];
+            r[i] += D[i*N + j];
+            r[j] += D[i*N + j];
+        }
+    }
+    std::vector<int32_t> order(N * N, PADDING);
+    std::vector<std::pair<double, int32_t>> row;
+    for (int64_t i = 0; i < N; i++) {
+        row.clear();
+        for (int64_t j = 0; j < N; j++)
+            if (j != i) row.push_back(std::make_pair(D[i*N + j], int32_t(j)));
+        std::sort(row.begin(), row.end());
+        for (size_t p = 0; p < row.size(); p++) order[i*N + p] = row[p].second;
+    }
+    std::vector<char> alive(2 * N, 0);
+    std::vector<int64_t> slot_of(2 * N);
+    std::vector<int32_t> slot_id(N);
+    std::vector<int64_t> position(N, 0);
+    for (int64_t i = 0; i < N; i++) {
+        alive[i] = 1;
+        slot_of[i] = i;
+        slot_id[i] = i;
+    }
+    int32_t next_id = N;
+    int64_t n = N;
+    while (n > 3) {
+        double r_max = *std::max_element(r.begin(), r.begin() + n);
+        double best = INF;
+        int64_t a = -1, b = -1;
+        // the first active entry of every row gives a first best Q
+        for (int64_t s = 0; s < n; s++) {
+            const int32_t *row_s = &order[s*N];
+            int64_t p = position[s];
+            while (row_s[p] != PADDING && !alive[row_s[p]]) p++;
+            position[s] = p;
+            if (row_s[p] == PADDING) continue;
+            int64_t j = slot_of[row_s[p]];
+            double q = (n-2) * D[s*N + j] - r[s] - r[j];
+            if (q < best) {
+                best = q;
+                a = s;
+                b = j;
+            }
+        }
+        for (int64_t s = 0; s < n; s++) {
+            const int32_t *row_s = &order[s*N];
+            const double *D_s = &D[s*N];
+            for (int64_t p = position[s]; row_s[p] != PADDING; p++) {
+                if (!alive[row_s[p]]) continue;
+                int64_t j = slot_of[row_s[p]];
+                double value = (n-2) * D_s[j] - r[s];
+                if (value - r_max >= best) break;
+                if (value - r[j] < best) {
+                    best = value - r[j];
+                    a = s;
+                    b = j;
+                }
+            }
+        }
+        if (a > b) std::swap(a, b);
+        double d = D[a*N + b];
+        double length_a = 0.5 * d + (r[a] - r[b]) / (2 * (n-2));
+        double length_b = d - length_a;
+        // a negative length is set to 0 and the other side takes all of d, whichever side it is. The
+        // distances of joined nodes can fall below 0 on distances far from a tree, d is kept at 0 then.
+        if (length_a < 0) {
+            length_a = 0;
+            length_b = std::max(d, 0.0);
+        }
+        else if (length_b < 0) {
+            length_b = 0;
+            length_a = std::max(d, 0.0);
+        }
+        ids.push_back(slot_id[a]);
+        ids.push_back(slot_id[b]);
+        lengths.push_back(length_a);
+        lengths.push_back(length_b);
+        // the joined node takes the slot of a
+        row.clear();
+        double r_new = 0;
+        for (int64_t s = 0; s < n; s++) {
+            if (s == a || s == b) continue;
+            double value = 0.5 * (D[a*N + s] + D[b*N + s] - d);
+            r[s] += value - D[a*N + s] - D[b*N + s];
+            D[a*N + s] = D[s*N + a] = value;
+            r_new += value;
+            row.push_back(std::make_pair(value, slot_id[s]));
+        }
+        r[a] = r_new;
+        alive[slot_id[a]] = 0;
+        alive[slot_id[b]] = 0;
+        alive[next_id] = 1;
+        slot_of[next_id] = a;
+        slot_id[a] = next_id++;
+        std::sort(row.begin(), row.end());
+        std::fill(order.begin() + a*N, order.begin() + (a+1)*N, PADDING);
+        for (size_t p = 0; p < row.size(); p++) order[a*N + p] = row[p].second;
+        position[a] = 0;
+        // the last active node fills the slot of b
+        int64_t last = n - 1;
+        if (b != last) {
+            for (int64_t s = 0; s < n; s++) D[b*N + s] = D[last*N + s];
+            for (int64_t s = 0; s < n; s++) D[s*N + b] = D[s*N + last];
+            D[b*N + b] = INF;
+            r[b] = r[last];
+            slot_id[b] = slot_id[last];
+            slot_of[slot_id[b]] = b;
+            std::copy(order.begin() + last*N, order.begin() + (last+1)*N, order.begin() + b*N);
+            position[b] = position[last];
+        }
+        n--;
+    }
+    for (int64_t s = 0; s < n; s++) ids.push_back(slot_id[s]);
+    if (n == 2) {
+        lengths.push_back(D[1] / 2);
+        lengths.push_back(D[1] / 2);
+    }
+    else {
+        double ab = D[1], ac = D[2], bc = D[N + 2];
+        lengths.push_back(std::max(0.5 * (ab + ac - bc), 0.0));
+        lengths.push_back(std::max(0.5 * (ab + bc - ac), 0.0));
+        lengths.push_back(std::max(0.5 * (ac + bc - ab), 0.0));
+    }
+}
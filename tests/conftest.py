@@ -0,0 +1,79 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+
+Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, Root)
+Samples = os.path.join(Root, 'test_samples', 'crm.fa')
+
+import method
+
+def run_tool(script, *args):
+    # Runs a command line tool of the repository in a fresh interpreter
+    subprocess.run([sys.executable, os.path.join(Root, script)] + [str(arg) for arg in args], cwd=Root, check=True, stdout=subprocess.DEVNULL)
+
+def read_tsv(filename):
+    # The distances of a .tsv output by pair of names
+    result = {}
+    with open(filename) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            result[(fields[0], fields[1])] = float(fields[2])
+    return result
+
+def flatten(records):
+    # The sequence count() sees for a fasta file of records, a header becomes one 'N'
+    return ''.join('N' + sequence for sequence in records)
+
+def naive_counts(sequence, K, Reverse=False):
+    # Kmer counts of a sequence without the counter, kmers with other letters than ACGT are skipped
+    codes = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+    count = np.zeros(4**K, dtype=np.int64)
+    sequence = sequence.upper()
+    for i in range(len(sequence) - K + 1):
+        kmer = sequence[i:i+K]
+        if all(nuc in codes for nuc in kmer):
+            code = 0
+            rev = 0
+            for j, nuc in enumerate(kmer):
+                code = code * 4 + codes[nuc]
+                rev += (3 - codes[nuc]) * 4**j
+            count[code] += 1
+            if Reverse:
+                count[rev] += 1
+    return count
+
+def write_fasta(filename, names, sequences, width=60):
+    with open(filename, 'wt') as f:
+        for name, sequence in zip(names, sequences):
+            f.write('>%s\n'%name)
+            for i in range(0, len(sequence), width):
+                f.write(sequence[i:i+width] + '\n')
+    return str(filename)
+
+@pytest.fixture
+def records():
+    seqname_old_list, seqname_list, sequence_list = method.get_sequences(Samples)
+    return seqname_list, sequence_list
+
+@pytest.fixture
+def sample_files(tmp_path, records):
+    # Every record of test_samples/crm.fa as a file of its own
+    return [write_fasta(tmp_path / (name + '.fa'), [name], [sequence]) for name, sequence in zip(*records)]
+
+@pytest.fixture
+def list_file(tmp_path, sample_files):
+    filename = tmp_path / 'list.txt'
+    filename.write_text(''.join(seqfile + '\n' for seqfile in sample_files))
+    return str(filename)
+
+@pytest.fixture(autouse=True)
+def reset_method():
+    # Module state set by the command line, tests that change it get the defaults back
+    yield
+    method.Sampling = None
+    method.Approximate = None
+    method.Sequence_counts.clear()
+    method.Projectors.clear()
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from conftest import run_tool, read_tsv
+import method
+
+Methods = ['d2star', 'CVtree', 'd2']
+
+@pytest.mark.parametrize('tolerance', [0.2, 0.3])
+def test_approximate_distances_stay_within_the_tolerance(tmp_path, list_file, tolerance):
+    run_tool('afann.py', '-a', ','.join(Methods), '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'exact')
+    run_tool('afann.py', '-a', ','.join(Methods), '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'approx', '--approximate', tolerance, '-d', tmp_path / 'counts')
+    for a_method in Methods:
+        exact = read_tsv(tmp_path / ('exact.%s.tsv'%a_method.lower()))
+        approx = read_tsv(tmp_path / ('approx.%s.tsv'%a_method.lower()))
+        assert approx.keys() == exact.keys()
+        assert max(abs(approx[pair] - exact[pair]) / exact[pair] for pair in exact) <= tolerance
+
+def test_projected_matrix_is_the_cosine_distance_without_projection():
+    # 0.25*|u-v|**2 of unit vectors is 0.5*(1-<u,v>)
+    f_matrix = np.random.RandomState(0).randn(6, 256)
+    f_matrix = np.array([method.unit_vector(f) for f in f_matrix])
+    assert np.allclose(method.projected_matrix(f_matrix), 0.5 * (1 - f_matrix @ f_matrix.T) * (1 - np.eye(6)))
+    assert np.allclose(method.projected_matrix(f_matrix[:2], f_matrix), 0.5 * (1 - f_matrix[:2] @ f_matrix.T))
+
+def test_saved_projections_give_the_same_distances(tmp_path, list_file):
+    for output in ['first', 'second']:
+        run_tool('afann.py', '-a', ','.join(Methods), '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / output, '--approximate', 0.3, '-d', tmp_path / 'counts')
+    for a_method in Methods:
+        assert read_tsv(tmp_path / ('second.%s.tsv'%a_method.lower())) == read_tsv(tmp_path / ('first.%s.tsv'%a_method.lower()))
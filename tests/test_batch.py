@@ -0,0 +1,34 @@
+import numpy as np
+from conftest import run_tool, read_tsv, write_fasta
+from src._count import kmer_count_seq, kmer_count_m_k_seq, kmer_count_batch, kmer_count_m_k_batch, kmer_count_sizes_batch
+
+def batch_input(sequence_list):
+    return ''.join(sequence_list).encode(), np.cumsum([0] + [len(sequence) for sequence in sequence_list])
+
+def test_batch_rows_match_single_records(records):
+    sequence_list = records[1] + ['ACG', 'ACGTNNACGTACGTAC']
+    sequence, offsets = batch_input(sequence_list)
+    for Reverse in [False, True]:
+        batch = kmer_count_batch(sequence, offsets, 5, 3, Reverse)
+        m_k_batch = kmer_count_m_k_batch(sequence, offsets, 2, 5, 3, Reverse)
+        sizes_batch = kmer_count_sizes_batch(sequence, offsets, [1, 2, 5], 3, Reverse)
+        assert batch.shape == (len(sequence_list), 4**5)
+        for i, record in enumerate(sequence_list):
+            assert np.array_equal(batch[i], kmer_count_seq(record, 5, 1, Reverse))
+            assert np.array_equal(m_k_batch[i], kmer_count_m_k_seq(record, 2, 5, 1, Reverse))
+            assert np.array_equal(sizes_batch[i], np.concatenate([kmer_count_seq(record, k, 1, Reverse) for k in [1, 2, 5]]))
+
+def test_invalid_record_is_flagged_in_its_row_only(records):
+    sequence, offsets = batch_input([records[1][0], 'ACGT?ACGT', records[1][1]])
+    batch = kmer_count_batch(sequence, offsets, 4, 2, False)
+    assert batch[1][0] == -1
+    assert np.array_equal(batch[0], kmer_count_seq(records[1][0], 4, 1, False))
+    assert np.array_equal(batch[2], kmer_count_seq(records[1][1], 4, 1, False))
+
+def test_sequence_mode_d2shepp_does_not_depend_on_other_methods(tmp_path):
+    # the bias of d2star must not change the stored counts d2shepp reads afterwards
+    seqfile = 'test_samples/crm.fa'
+    for option in [[], ['--adjust']]:
+        run_tool('afann.py', '-a', 'd2shepp', '-k', 5, '-m', 1, '-s', seqfile, '-o', tmp_path / 'alone', *option)
+        run_tool('afann.py', '-a', 'd2star,d2shepp', '-k', 5, '-m', 1, '-s', seqfile, '-o', tmp_path / 'both', *option)
+        assert read_tsv(tmp_path / 'alone.d2shepp.tsv') == read_tsv(tmp_path / 'both.d2shepp.tsv')
@@ -0,0 +1,17 @@
+import numpy as np
+from conftest import flatten, naive_counts
+from src._count import kmer_count_seq, kmer_count_m_k_seq
+
+def test_buffer_types_give_the_same_counts(records):
+    sequence = flatten(records[1])
+    expected = naive_counts(sequence, 5, True)
+    data = sequence.encode()
+    for buffer in [sequence, data, bytearray(data), memoryview(data), np.frombuffer(data, dtype=np.uint8)]:
+        assert np.array_equal(kmer_count_seq(buffer, 5, 2, True), expected)
+        count = kmer_count_m_k_seq(buffer, 1, 5, 2, True)
+        assert np.array_equal(count[4:], expected)
+
+def test_buffer_slices_are_counted_in_place(records):
+    data = flatten(records[1]).encode()
+    view = memoryview(data)[100:900]
+    assert np.array_equal(kmer_count_seq(view, 4, 1, False), naive_counts(data[100:900].decode(), 4))
@@ -0,0 +1,33 @@
+import os
+import numpy as np
+from conftest import run_tool, read_tsv
+import method
+
+def test_resume_finishes_a_partial_slow_matrix(tmp_path, sample_files):
+    N = len(sample_files)
+    exact = method.d2star_matrix_pairwise(sample_files, 2, 5, 1, False, 'None', slow=True)
+    checkpoint = method.Checkpoint(str(tmp_path / 'd2star.ckpt.npz'), 0, True)
+    assert np.allclose(method.d2star_matrix_pairwise(sample_files, 2, 5, 1, False, 'None', slow=True, checkpoint=checkpoint), exact)
+    # keep the first two rows, marking the first one, as if the run had stopped there
+    with np.load(checkpoint.filename) as state:
+        key, result = state['key'], state['result'].copy()
+    first_row = slice(method.condensed_start(N, 0), method.condensed_start(N, 1))
+    result[first_row] = -1
+    result[method.condensed_start(N, 2):] = 0
+    np.savez(checkpoint.filename, key=key, result=result, done=2)
+    resumed = method.d2star_matrix_pairwise(sample_files, 2, 5, 1, False, 'None', slow=True, checkpoint=checkpoint)
+    assert np.all(resumed[first_row] == -1)
+    assert np.allclose(resumed[first_row.stop:], exact[first_row.stop:])
+
+def test_checkpoint_of_other_settings_is_ignored(tmp_path, sample_files):
+    checkpoint = method.Checkpoint(str(tmp_path / 'ma.ckpt.npz'), 0, True)
+    method.Ma_matrix_pairwise(sample_files, 2, 4, 1, False, 'None', slow=True, checkpoint=checkpoint)
+    exact = method.Ma_matrix_pairwise(sample_files, 2, 5, 1, False, 'None', slow=True)
+    assert np.allclose(method.Ma_matrix_pairwise(sample_files, 2, 5, 1, False, 'None', slow=True, checkpoint=checkpoint), exact)
+
+def test_command_line_checkpoints_match_and_are_removed(tmp_path, list_file):
+    run_tool('afann.py', '--slow', '-a', 'd2star,d2shepp', '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'exact')
+    run_tool('afann.py', '--slow', '-a', 'd2star,d2shepp', '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'ckpt', '--checkpoint', 1, '--resume')
+    for a_method in ['d2star', 'd2shepp']:
+        assert read_tsv(tmp_path / ('ckpt.%s.tsv'%a_method)) == read_tsv(tmp_path / ('exact.%s.tsv'%a_method))
+    assert not [filename for filename in os.listdir(tmp_path) if 'ckpt' in filename and filename.endswith('.npz')]
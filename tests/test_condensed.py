@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from conftest import run_tool, read_tsv
+import method
+
+Metrics = [method.Ma_matrix, method.Eu_matrix, method.cosine_matrix, method.dot_matrix]
+
+@pytest.mark.parametrize('metric', Metrics)
+def test_condensed_matrix_is_the_upper_triangle(monkeypatch, metric):
+    f_matrix = np.random.RandomState(0).rand(23, 64)
+    f_matrix /= f_matrix.sum(1)[:, np.newaxis]
+    square = metric(f_matrix, f_matrix)
+    i, j = np.triu_indices(23, 1)
+    # a small chunk computes a few rows at a time
+    monkeypatch.setattr(method, 'Chunk_Size', 64)
+    condensed = method.condensed_matrix(f_matrix, metric)
+    assert np.allclose(condensed, square[i, j])
+    for k in range(23):
+        row = method.condensed_row(condensed, 23, k)
+        assert row[k] == 0
+        assert np.allclose(np.delete(row, k), np.delete(square[k], k))
+    assert np.array_equal(np.concatenate(method.condensed_pairs(23, 0, len(condensed))), np.concatenate([i, j]))
+    assert np.array_equal(np.concatenate(method.condensed_pairs(23, 40, 100)), np.concatenate([i[40:100], j[40:100]]))
+
+@pytest.mark.parametrize('a_method', ['d2star', 'd2shepp', 'CVTree', 'd2', 'Ma', 'Eu'])
+def test_pairwise_results_match_the_groupwise_square(sample_files, a_method):
+    N = len(sample_files)
+    pairwise = getattr(method, a_method + '_matrix_pairwise')
+    groupwise = getattr(method, a_method + '_matrix_groupwise')
+    square = groupwise(sample_files, sample_files, 1, 5, 1, False, 'None')
+    i, j = np.triu_indices(N, 1)
+    assert np.allclose(pairwise(sample_files, 1, 5, 1, False, 'None'), square[i, j])
+    assert np.allclose(pairwise(sample_files, 1, 5, 1, False, 'None', slow=True), square[i, j])
+
+def test_phy_output_is_the_symmetric_square(tmp_path, list_file):
+    run_tool('afann.py', '-a', 'd2star', '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'out', '--adjust')
+    for a_method in ['d2star', 'd2star_adjusted']:
+        distances = read_tsv(tmp_path / ('out.%s.tsv'%a_method))
+        with open(tmp_path / ('out.%s.phy'%a_method)) as f:
+            N = int(f.readline())
+            rows = [line.rstrip('\n').split('\t') for line in f]
+        names = [row[0] for row in rows]
+        square = np.array([[float(value) for value in row[1:]] for row in rows])
+        assert square.shape == (N, N) and np.array_equal(square, square.T)
+        assert np.all(np.diag(square) == 0)
+        for a in range(N):
+            for b in range(N):
+                if a != b:
+                    assert square[a, b] == distances[(names[a], names[b])]
@@ -0,0 +1,35 @@
+import threading
+import numpy as np
+from conftest import flatten, naive_counts
+from src._count import kmer_count, kmer_count_seq, kmer_count_m_k
+
+def test_counts_match_naive_counter(sample_files, records):
+    for seqfile, sequence in zip(sample_files, records[1]):
+        for Reverse in [False, True]:
+            assert np.array_equal(kmer_count(seqfile, 5, 2, Reverse), naive_counts(sequence, 5, Reverse))
+            count = kmer_count_m_k(seqfile, 2, 5, 2, Reverse)
+            assert np.array_equal(count[:16], naive_counts(sequence, 2, Reverse))
+            assert np.array_equal(count[16:], naive_counts(sequence, 5, Reverse))
+
+def test_results_are_owned_arrays(records):
+    sequence = flatten(records[1])
+    first = kmer_count_seq(sequence, 4, 1, False)
+    second = kmer_count_seq(sequence, 4, 1, False)
+    first[:] = 0
+    assert np.array_equal(second, naive_counts(sequence, 4))
+
+def test_concurrent_calls_match_serial_ones(sample_files):
+    expected = [kmer_count(seqfile, 6, 2, True) for seqfile in sample_files]
+    results = {}
+    def count(i):
+        results[i] = kmer_count(sample_files[i % len(sample_files)], 6, 2, True)
+    threads = [threading.Thread(target=count, args=(i,)) for i in range(4 * len(sample_files))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i, count in results.items():
+        assert np.array_equal(count, expected[i % len(sample_files)])
+
+def test_invalid_sequence_is_flagged():
+    assert kmer_count_seq('ACGT?ACGT', 3, 1, False)[0] == -1
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from conftest import flatten, naive_counts
+import method
+
+def naive_expect(M_count, M, K):
+    # Expected count of every K-mer: the count of its first M-mer times the transition probabilities
+    # of each following nucleotide after the M-1 before it
+    trans = M_count.reshape(-1, 4) / M_count.reshape(-1, 4).sum(1)[:, np.newaxis]
+    trans[np.isnan(trans)] = 0
+    expect = np.zeros(4**K)
+    for code in range(4**K):
+        digits = [(code >> (2 * (K - 1 - i))) & 3 for i in range(K)]
+        value = M_count[int(''.join(map(str, digits[:M])), 4)]
+        for i in range(M, K):
+            context = int(''.join(map(str, digits[i-M+1:i])) or '0', 4)
+            value *= trans[context, digits[i]]
+        expect[code] = value
+    return expect
+
+@pytest.mark.parametrize('chunk', [4, 64, 1 << 16])
+@pytest.mark.parametrize('M', [1, 2, 3])
+def test_chunked_expectation_matches_naive(monkeypatch, records, chunk, M):
+    monkeypatch.setattr(method, 'Expect_Chunk', chunk)
+    sequence = flatten(records[1])
+    M_count = naive_counts(sequence, M, True).astype(np.float64)
+    K_count = naive_counts(sequence, 6, True)
+    expect = naive_expect(M_count, M, 6)
+    out = np.empty(4**6)
+    chunks = list(method.expect_chunks(M_count, M, 6, out))
+    assert chunks[0][0] == 0 and chunks[-1][1] == 4**6
+    assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+    assert np.allclose(out, expect)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        feature = (K_count - expect) / np.sqrt(expect)
+    feature[np.isnan(feature)] = 0
+    out = np.empty(4**6)
+    norm = method.expect_feature(M_count, K_count, M, 6, '(k-e)/sqrt(e)', out)
+    assert np.allclose(out, feature)
+    assert np.isclose(norm, np.sum(feature ** 2))
+
+def test_chunk_size_does_not_change_the_distances(monkeypatch, sample_files):
+    exact = method.d2star_matrix_pairwise(sample_files, 2, 6, 1, True, 'None')
+    exact_cvtree = method.CVTree_matrix_pairwise(sample_files, 2, 6, 1, True, 'None')
+    monkeypatch.setattr(method, 'Expect_Chunk', 16)
+    assert np.allclose(method.d2star_matrix_pairwise(sample_files, 2, 6, 1, True, 'None'), exact)
+    assert np.allclose(method.CVTree_matrix_pairwise(sample_files, 2, 6, 1, True, 'None'), exact_cvtree)
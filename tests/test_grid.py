@@ -0,0 +1,39 @@
+import os
+import shutil
+import numpy as np
+import pytest
+import model
+from conftest import run_tool, read_tsv
+
+def test_grid_matches_the_network_and_recovers_a_broken_cache(tmp_path, monkeypatch):
+    # the grids are cached next to the weights, so the test builds its own in a copy
+    shutil.copy(os.path.join(model.Model_Dir, 'd2shepp_mlp.npy'), tmp_path)
+    monkeypatch.setattr(model, 'Model_Dir', str(tmp_path))
+    cache = tmp_path / 'd2shepp_grid9.npz'
+    # a cache cut short by a killed job
+    cache.write_bytes(b'PK\x03\x04broken')
+    grid = model.grid_MLPR('d2shepp', 9)
+    exact = model.padding_MLPR('d2shepp')
+    X = np.random.RandomState(0).uniform(-1, 1, (5000, 3))
+    assert np.max(np.abs(grid.predict(X) - exact.predict(X))) <= grid.max_error
+    # grid points need no interpolation
+    axis = np.linspace(-1, 1, 9)
+    X = axis[np.random.RandomState(1).randint(0, 9, (200, 3))]
+    assert np.allclose(grid.predict(X), exact.predict(X))
+    assert not [filename for filename in os.listdir(tmp_path) if filename.endswith('.tmp')]
+    cached = model.grid_MLPR('d2shepp', 9)
+    assert np.array_equal(cached.grid, grid.grid) and cached.max_error == grid.max_error
+
+def test_grid_needs_two_points():
+    with pytest.raises(ValueError):
+        model.grid_MLPR('d2shepp', 1)
+
+def test_command_line_grid_stays_within_its_max_error(tmp_path, list_file):
+    run_tool('afann.py', '-a', 'd2star', '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'exact', '--adjust')
+    run_tool('afann.py', '-a', 'd2star', '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'grid', '--adjust', '--grid', 33)
+    max_error = model.grid_MLPR('d2star', 33).max_error
+    exact = read_tsv(tmp_path / 'exact.d2star.tsv')
+    grid = read_tsv(tmp_path / 'grid.d2star.tsv')
+    assert grid.keys() == exact.keys()
+    # the distance is (1 - prediction) / 2
+    assert max(abs(grid[pair] - exact[pair]) for pair in exact) <= max_error / 2 + 1e-12
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from conftest import run_tool, read_tsv, write_fasta
+from src._count import kmer_count, kmer_count_m_k
+import method
+
+def test_group_counts_are_the_sum_of_their_files(sample_files):
+    sample = method.Sample('all', sample_files)
+    for Reverse in [False, True]:
+        assert np.array_equal(method.count_file(sample, 5, 3, Reverse), sum(kmer_count(seqfile, 5, 1, Reverse) for seqfile in sample_files))
+        assert np.array_equal(method.count_file_m_k(sample, 2, 5, 3, Reverse), sum(kmer_count_m_k(seqfile, 2, 5, 1, Reverse) for seqfile in sample_files))
+
+def test_group_with_a_file_shorter_than_k(tmp_path, sample_files):
+    tiny = write_fasta(tmp_path / 'tiny.fa', ['tiny'], ['ACG'])
+    sample = method.Sample('all', [sample_files[0], tiny])
+    assert np.array_equal(method.count_file(sample, 5, 2, True), kmer_count(sample_files[0], 5, 1, True))
+    assert np.array_equal(method.count_file_m_k(sample, 1, 5, 2, True), kmer_count_m_k(sample_files[0], 1, 5, 1, True) + kmer_count_m_k(tiny, 1, 5, 1, True))
+
+def test_group_with_an_empty_file_is_refused(tmp_path, sample_files):
+    empty = tmp_path / 'empty.fa'
+    empty.write_text('')
+    sample = method.Sample('all', [sample_files[0], str(empty)])
+    with pytest.raises(Exception, match='is empty'):
+        method.count_file(sample, 5, 1, False)
+    with pytest.raises(Exception, match='is empty'):
+        method.count_file_m_k(sample, 1, 5, 1, False)
+
+def test_command_line_group_matches_one_file_of_its_records(tmp_path, records, sample_files):
+    # a sample of the files of the first two records against one file of both records
+    both = write_fasta(tmp_path / 'both.fa', records[0][:2], records[1][:2])
+    (tmp_path / 'groups.txt').write_text('both\t%s\t%s\n%s\n%s\n'%(sample_files[0], sample_files[1], sample_files[2], sample_files[3]))
+    (tmp_path / 'files.txt').write_text('%s\n%s\n%s\n'%(both, sample_files[2], sample_files[3]))
+    run_tool('afann.py', '-a', 'd2star,d2shepp,Ma', '-k', 5, '-m', 1, '-f', tmp_path / 'groups.txt', '-o', tmp_path / 'group')
+    run_tool('afann.py', '-a', 'd2star,d2shepp,Ma', '-k', 5, '-m', 1, '-f', tmp_path / 'files.txt', '-o', tmp_path / 'file')
+    for a_method in ['d2star', 'd2shepp', 'ma']:
+        assert read_tsv(tmp_path / ('group.%s.tsv'%a_method)) == read_tsv(tmp_path / ('file.%s.tsv'%a_method))
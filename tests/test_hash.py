@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from conftest import run_tool, read_tsv, flatten, write_fasta
+from src._count import kmer_count_hash, kmer_count_hash_seq, kmer_count_hash_batch
+
+def naive_hash(sequence, K, Reverse=False):
+    # Kmer codes and counts as sorted arrays, like the hash counter, without anything of size 4**K
+    codes = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+    counts = {}
+    for i in range(len(sequence) - K + 1):
+        kmer = sequence[i:i+K]
+        if all(nuc in codes for nuc in kmer):
+            code = 0
+            rev = 0
+            for j, nuc in enumerate(kmer):
+                code = code * 4 + codes[nuc]
+                rev += (3 - codes[nuc]) * 4**j
+            counts[code] = counts.get(code, 0) + 1
+            if Reverse:
+                counts[rev] = counts.get(rev, 0) + 1
+    kmers = np.array(sorted(counts), dtype=np.uint64)
+    return kmers, np.array([counts[kmer] for kmer in sorted(counts)])
+
+def assert_same_hash(result, expected):
+    assert np.array_equal(np.asarray(result[0], dtype=np.uint64), expected[0])
+    assert np.array_equal(result[1], expected[1])
+
+def test_hash_counts_match_naive_counter(tmp_path, records):
+    # all records in one file need more than the first table size, so the table grows while counting
+    seqfile = write_fasta(tmp_path / 'all.fa', *records)
+    sequence = flatten(records[1])
+    for K in [9, 17]:
+        for Reverse in [False, True]:
+            expected = naive_hash(sequence, K, Reverse)
+            for Num_Threads in [1, 3]:
+                assert_same_hash(kmer_count_hash(seqfile, K, Num_Threads, Reverse), expected)
+                assert_same_hash(kmer_count_hash_seq(sequence, K, Num_Threads, Reverse), expected)
+
+def test_hash_batch_matches_single_records(records):
+    sequence_list = records[1]
+    offsets = np.cumsum([0] + [len(sequence) for sequence in sequence_list])
+    indptr, kmers, counts = kmer_count_hash_batch(''.join(sequence_list).encode(), offsets, 11, 2, True)
+    for i, sequence in enumerate(sequence_list):
+        assert_same_hash((kmers[indptr[i]:indptr[i+1]], counts[indptr[i]:indptr[i+1]]), naive_hash(sequence, 11, True))
+
+@pytest.mark.parametrize('option', [[], ['-r']])
+def test_sparse_distances_match_dense(tmp_path, list_file, option):
+    methods = ['d2star', 'CVtree', 'd2', 'Ma', 'Eu']
+    run_tool('afann.py', '-a', ','.join(methods), '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'dense', *option)
+    run_tool('afann.py', '-a', ','.join(methods), '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'sparse', '--sparse', *option)
+    for a_method in methods:
+        dense = read_tsv(tmp_path / ('dense.%s.tsv'%a_method.lower()))
+        result = read_tsv(tmp_path / ('sparse.%s.tsv'%a_method.lower()))
+        assert result.keys() == dense.keys()
+        assert np.allclose([result[pair] for pair in dense], list(dense.values()))
+
+def test_zero_norm_cvtree_is_nan_in_both_modes(tmp_path):
+    # with K=3 and -m 0 every kmer of the first record is as frequent as expected
+    seqfile = write_fasta(tmp_path / 'zero.fa', ['flat', 'one', 'two'], ['ACGNACGNACG', 'ACGTTGCAAGGCTTACG', 'TTGCAAGGACGTCTTAC'])
+    for option in [[], ['--sparse']]:
+        run_tool('afann.py', '-a', 'CVtree', '-k', 3, '-m', 0, '-s', seqfile, '-o', tmp_path / 'out', *option)
+        result = read_tsv(tmp_path / 'out.cvtree.tsv')
+        assert np.isnan(result[('flat', 'one')]) and np.isnan(result[('flat', 'two')])
+        assert not np.isnan(result[('one', 'two')])
@@ -0,0 +1,16 @@
+import numpy as np
+from conftest import run_tool, read_tsv
+import method
+
+def test_prefetch_gives_the_same_distances(tmp_path, list_file):
+    methods = 'd2star,d2shepp,CVtree,Ma,Eu,d2'
+    run_tool('afann.py', '-a', methods, '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'exact')
+    run_tool('afann.py', '-a', methods, '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'prefetch', '--prefetch', 2, '-d', tmp_path / 'counts')
+    for a_method in ['d2star', 'd2shepp', 'cvtree', 'ma', 'eu', 'd2']:
+        assert read_tsv(tmp_path / ('prefetch.%s.tsv'%a_method)) == read_tsv(tmp_path / ('exact.%s.tsv'%a_method))
+
+def test_count_files_saves_the_counts_of_every_file(tmp_path, sample_files):
+    P_dir = str(tmp_path)
+    method.count_files(sample_files, 1, 5, 1, True, P_dir, 2)
+    for seqfile in sample_files:
+        assert np.array_equal(np.load(method.count_pickle(seqfile, 5, True, P_dir)), method.kmer_count(seqfile, 5, 1, True))
@@ -0,0 +1,46 @@
+import os
+import threading
+import numpy as np
+import pytest
+from conftest import flatten, naive_counts, write_fasta
+from src._count import kmer_count, kmer_count_m_k, kmer_count_seq, kmer_count_m_k_seq
+
+def long_records(records, copies):
+    # The records of test_samples/crm.fa joined into long sequences, a header of 100kb among them
+    rng = np.random.RandomState(0)
+    sequences = [''.join(records[1][i] for i in rng.randint(len(records[1]), size=copies)) for _ in range(4)]
+    names = ['long%d'%i for i in range(4)]
+    names[2] = 'x' * 100000
+    return names, sequences
+
+@pytest.mark.parametrize('width', [None, 60, 65536])
+def test_ranges_count_like_the_flattened_text(tmp_path, records, width):
+    names, sequences = long_records(records, 200)
+    seqfile = write_fasta(tmp_path / 'long.fa', names, sequences, width or max(len(sequence) for sequence in sequences))
+    assert os.path.getsize(seqfile) > 1 << 19
+    text = flatten(sequences)
+    for Reverse in [False, True]:
+        expected = kmer_count_seq(text, 7, 1, Reverse)
+        expected_m_k = kmer_count_m_k_seq(text, 2, 7, 1, Reverse)
+        for Num_Threads in [1, 4]:
+            assert np.array_equal(kmer_count(seqfile, 7, Num_Threads, Reverse), expected)
+            assert np.array_equal(kmer_count_m_k(seqfile, 2, 7, Num_Threads, Reverse), expected_m_k)
+
+def test_ranges_count_like_the_naive_counter(tmp_path, records):
+    names, sequences = long_records(records, 30)
+    seqfile = write_fasta(tmp_path / 'long.fa', names, sequences, max(len(sequence) for sequence in sequences))
+    assert np.array_equal(kmer_count(seqfile, 4, 4, True), naive_counts(flatten(sequences), 4, True))
+
+def test_pipe_is_read_into_memory(tmp_path, records):
+    names, sequences = long_records(records, 100)
+    seqfile = write_fasta(tmp_path / 'long.fa', names, sequences, 80)
+    pipe = str(tmp_path / 'pipe.fa')
+    os.mkfifo(pipe)
+    def write():
+        with open(pipe, 'wb') as f, open(seqfile, 'rb') as g:
+            f.write(g.read())
+    writer = threading.Thread(target=write)
+    writer.start()
+    count = kmer_count(pipe, 6, 4, False)
+    writer.join()
+    assert np.array_equal(count, kmer_count(seqfile, 6, 1, False))
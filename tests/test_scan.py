@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from conftest import run_tool, read_tsv, write_fasta
+
+Methods = ['d2star', 'd2shepp', 'cvtree', 'ma', 'eu', 'd2']
+
+def read_scan(filename):
+    # The distances of a .scan.tsv by (record, start, end) and query
+    result = {}
+    with open(filename) as f:
+        queries = f.readline().rstrip('\n').split('\t')[3:]
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            for query, value in zip(queries, fields[3:]):
+                result[(fields[0], int(fields[1]), int(fields[2]), query)] = float(value)
+    return result
+
+@pytest.mark.parametrize('option', [[], ['-r']])
+def test_windows_match_afann_on_the_cut_windows(tmp_path, records, option):
+    names, sequences = records
+    # two genome records from test_samples, one with a run of Ns
+    genome = [sequences[0] + sequences[1], sequences[2][:300] + 'N' * 50 + sequences[2][300:]]
+    genome_file = write_fasta(tmp_path / 'genome.fa', ['g1', 'g2'], genome)
+    query_file = write_fasta(tmp_path / 'query.fa', names[1:], sequences[1:])
+    window, step = 300, 70
+    windows = []
+    for name, sequence in zip(['g1', 'g2'], genome):
+        for start in range(0, len(sequence) - window + 1, step):
+            windows.append(('%s_%d_%d'%(name, start, start + window), sequence[start:start+window]))
+    windows_file = write_fasta(tmp_path / 'windows.fa', *zip(*windows))
+    run_tool('scan.py', '-a', ','.join(Methods), '-k', 5, '-m', 1, '-q', query_file, '-g', genome_file, '-w', window, '--step', step, '-o', tmp_path / 'scan', *option)
+    run_tool('afann.py', '-a', ','.join(Methods), '-k', 5, '-m', 1, '-s1', windows_file, '-s2', query_file, '-o', tmp_path / 'exact', *option)
+    for a_method in Methods:
+        scan = read_scan(tmp_path / ('scan.%s.scan.tsv'%a_method))
+        exact = read_tsv(tmp_path / ('exact.%s.tsv'%a_method))
+        assert len(scan) == len(exact) == len(windows) * (len(names) - 1)
+        for (record, start, end, query), value in scan.items():
+            assert abs(value - exact[('%s_%d_%d'%(record, start, end), query)]) <= 1.5e-4
+
+def test_short_record_is_one_window(tmp_path, records):
+    names, sequences = records
+    genome_file = write_fasta(tmp_path / 'genome.fa', ['short', 'empty'], [sequences[0][:200], 'N' * 80])
+    query_file = write_fasta(tmp_path / 'query.fa', names[1:], sequences[1:])
+    run_tool('scan.py', '-a', 'd2,ma', '-k', 4, '-m', 1, '-q', query_file, '-g', genome_file, '-w', 500, '-o', tmp_path / 'scan')
+    run_tool('afann.py', '-a', 'd2,ma', '-k', 4, '-m', 1, '-s1', write_fasta(tmp_path / 'short.fa', ['short'], [sequences[0][:200]]), '-s2', query_file, '-o', tmp_path / 'exact')
+    for a_method in ['d2', 'ma']:
+        scan = read_scan(tmp_path / ('scan.%s.scan.tsv'%a_method))
+        exact = read_tsv(tmp_path / ('exact.%s.tsv'%a_method))
+        for query in names[1:]:
+            assert abs(scan[('short', 0, 200, query)] - exact[('short', query)]) <= 1.5e-4
+            # a window of Ns only has no kmers
+            assert np.isnan(scan[('empty', 0, 80, query)])
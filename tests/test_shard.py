@@ -0,0 +1,47 @@
+import os
+import pytest
+from conftest import run_tool, read_tsv
+
+Methods = ['d2star', 'd2shepp', 'cvtree', 'ma', 'eu', 'd2']
+
+def shard_run(tmp_path, inputs, output, extra=()):
+    run_tool('shard.py', 'plan', '-a', ','.join(Methods), '-k', 5, '-m', 1, *inputs, '-d', tmp_path / 'counts', '-o', output, '--tile-size', 2, *extra)
+    manifest = str(output) + '.manifest.json'
+    for worker in range(2):
+        run_tool('shard.py', 'run', manifest, '--worker', worker, '--workers', 2)
+    run_tool('shard.py', 'merge', manifest)
+
+def test_pairwise_shards_match_afann(tmp_path, list_file):
+    shard_run(tmp_path, ['-f', list_file], tmp_path / 'shard')
+    run_tool('afann.py', '-a', ','.join(Methods), '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'exact')
+    for a_method in Methods:
+        assert read_tsv(tmp_path / ('shard.%s.tsv'%a_method)) == read_tsv(tmp_path / ('exact.%s.tsv'%a_method))
+
+def test_groupwise_shards_match_afann(tmp_path, sample_files):
+    (tmp_path / 'list1.txt').write_text('\n'.join(sample_files[:3]) + '\n')
+    (tmp_path / 'list2.txt').write_text('\n'.join(sample_files[1:]) + '\n')
+    inputs = ['-f1', tmp_path / 'list1.txt', '-f2', tmp_path / 'list2.txt']
+    shard_run(tmp_path, inputs, tmp_path / 'shard')
+    run_tool('afann.py', '-a', ','.join(Methods), '-k', 5, '-m', 1, *inputs, '-o', tmp_path / 'exact')
+    for a_method in Methods:
+        assert read_tsv(tmp_path / ('shard.%s.tsv'%a_method)) == read_tsv(tmp_path / ('exact.%s.tsv'%a_method))
+
+def test_workers_rebuild_missing_counts_of_grouped_samples(tmp_path, sample_files):
+    list_file = tmp_path / 'groups.txt'
+    list_file.write_text('pair\t%s\t%s\n%s\n%s\n'%(sample_files[0], sample_files[1], sample_files[2], sample_files[3]))
+    output = tmp_path / 'shard'
+    run_tool('shard.py', 'plan', '-a', 'd2star,Ma', '-k', 5, '-m', 1, '-f', list_file, '-d', tmp_path / 'counts', '-o', output, '--tile-size', 1)
+    for filename in os.listdir(tmp_path / 'counts'):
+        os.remove(tmp_path / 'counts' / filename)
+    run_tool('shard.py', 'run', str(output) + '.manifest.json')
+    run_tool('shard.py', 'merge', str(output) + '.manifest.json')
+    run_tool('afann.py', '-a', 'd2star,Ma', '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'exact')
+    for a_method in ['d2star', 'ma']:
+        assert read_tsv(tmp_path / ('shard.%s.tsv'%a_method)) == read_tsv(tmp_path / ('exact.%s.tsv'%a_method))
+
+def test_merge_refuses_missing_tiles(tmp_path, list_file):
+    output = tmp_path / 'shard'
+    run_tool('shard.py', 'plan', '-a', 'd2', '-k', 4, '-f', list_file, '-d', tmp_path / 'counts', '-o', output, '--tile-size', 2)
+    run_tool('shard.py', 'run', str(output) + '.manifest.json', 0)
+    with pytest.raises(Exception):
+        run_tool('shard.py', 'merge', str(output) + '.manifest.json')
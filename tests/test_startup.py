@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from conftest import Root
+import benchmark_startup
+import model
+
+@pytest.mark.parametrize('script', benchmark_startup.Scripts)
+def test_import_loads_no_heavy_module(script):
+    assert benchmark_startup.heavy_modules(script, Root) == []
+
+@pytest.mark.filterwarnings('ignore::sklearn.exceptions.ConvergenceWarning')
+def test_packed_network_predicts_like_mlpregressor():
+    from sklearn.neural_network import MLPRegressor
+    rng = np.random.RandomState(0)
+    X = rng.uniform(-1, 1, (200, 3))
+    regressor = MLPRegressor(hidden_layer_sizes=16, max_iter=50, random_state=0).fit(X, X.sum(1))
+    packed = model.pack(regressor.coefs_, regressor.intercepts_)
+    coefs, intercepts = model.unpack(packed)
+    for a, b in zip(coefs + intercepts, regressor.coefs_ + regressor.intercepts_):
+        assert np.array_equal(a, b)
+    network = model.padding_MLPR('d2star')
+    network.packed = packed
+    X = rng.uniform(-1, 1, (20000, 3))
+    assert np.allclose(network.forward(X), regressor.predict(X))
+    assert np.allclose(network.predict(X), (regressor.predict(X) + regressor.predict(X[:, [0, 2, 1]])) / 2)
+
+@pytest.mark.parametrize('a_method', ['d2star', 'd2shepp'])
+def test_shipped_weights_are_one_hidden_layer(a_method):
+    network = model.padding_MLPR(a_method)
+    assert isinstance(network.packed, np.memmap)
+    coefs, intercepts = model.unpack(network.packed)
+    assert coefs[0].shape[0] == 3 and coefs[1].shape == (coefs[0].shape[1], 1) and intercepts[1].shape == (1,)
+    X = np.random.RandomState(1).uniform(-1, 1, (100, 3))
+    hidden = np.maximum(X @ coefs[0] + intercepts[0], 0)
+    assert np.allclose(network.forward(X), (hidden @ coefs[1] + intercepts[1])[:, 0])
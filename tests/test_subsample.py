@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from conftest import run_tool, read_tsv, naive_counts, flatten, write_fasta
+from src._count import kmer_count, kmer_count_m_k
+import method
+
+@pytest.fixture
+def reads_file(tmp_path, records):
+    # Reads of 100bp drawn from the records of test_samples/crm.fa
+    rng = np.random.RandomState(0)
+    reads = []
+    for _ in range(2000):
+        sequence = records[1][rng.randint(len(records[1]))]
+        start = rng.randint(len(sequence) - 100)
+        reads.append(sequence[start:start+100])
+    return write_fasta(tmp_path / 'reads.fa', ['read%d'%i for i in range(len(reads))], reads), reads
+
+def test_subsample_of_all_reads_is_the_full_count(reads_file):
+    seqfile, reads = reads_file
+    method.Sampling = method.Subsample(0, 0, 1)
+    for Reverse in [False, True]:
+        count, n = method.count_subsample(seqfile, None, 5, 2, Reverse)
+        assert n == len(reads)
+        assert np.array_equal(count, kmer_count(seqfile, 5, 2, Reverse))
+        assert np.array_equal(count, naive_counts(flatten(reads), 5, Reverse))
+        count, n = method.count_subsample(seqfile, 2, 5, 2, Reverse)
+        assert np.array_equal(count, kmer_count_m_k(seqfile, 2, 5, 2, Reverse))
+
+@pytest.mark.parametrize('sampling', [method.Subsample(0, 300, 3), method.Subsample(0.05, 0, 3)])
+def test_both_strands_come_from_the_same_reads(reads_file, sampling):
+    seqfile, reads = reads_file
+    method.Sampling = sampling
+    forward, n = method.count_subsample(seqfile, 2, 5, 2, False)
+    both, n_both = method.count_subsample(seqfile, 2, 5, 2, True)
+    assert n == n_both and n < len(reads)
+    assert np.array_equal(both[:16], method.rev_count(forward[:16], 2))
+    assert np.array_equal(both[16:], method.rev_count(forward[16:], 5))
+    # so the bias functions never see a negative reverse strand count
+    assert np.all(both[16:] - forward[16:] >= 0)
+
+def test_command_line_max_reads_above_the_file_is_exact(tmp_path, list_file):
+    run_tool('afann.py', '-a', 'd2star,d2shepp', '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'exact')
+    run_tool('afann.py', '-a', 'd2star,d2shepp', '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'sampled', '--max-reads', 1000)
+    for a_method in ['d2star', 'd2shepp']:
+        assert read_tsv(tmp_path / ('sampled.%s.tsv'%a_method)) == read_tsv(tmp_path / ('exact.%s.tsv'%a_method))
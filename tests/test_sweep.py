@@ -0,0 +1,43 @@
+import argparse
+import subprocess
+import sys
+import numpy as np
+import pytest
+from conftest import Root, run_tool, read_tsv
+from src._count import kmer_count, kmer_count_sizes_files
+import afann
+import method
+
+Methods = ['d2star', 'd2shepp', 'cvtree', 'ma', 'eu', 'd2']
+
+def test_parse_k():
+    assert afann.parse_K('5') == [5]
+    assert afann.parse_K('6-8,4,7') == [4, 6, 7, 8]
+    for value in ['0', '3-a', '', '5-3']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            afann.parse_K(value)
+
+def test_sizes_of_one_scan_match_single_counts(sample_files):
+    sizes = [1, 3, 4, 5]
+    counts = {}
+    def save(i, count):
+        counts[i] = count.copy()
+    for Reverse in [False, True]:
+        kmer_count_sizes_files(sample_files, sizes, 2, Reverse, 2, save)
+        for i, seqfile in enumerate(sample_files):
+            for k, k_count in zip(sizes, method.split_sizes(counts[i], sizes)):
+                assert np.array_equal(k_count, kmer_count(seqfile, k, 1, Reverse))
+
+@pytest.mark.parametrize('inputs', [['-f', 'list_file'], ['-s', 'test_samples/crm.fa']])
+def test_sweep_matches_single_k_runs(tmp_path, list_file, inputs):
+    inputs = [list_file if value == 'list_file' else value for value in inputs]
+    run_tool('afann.py', '-a', ','.join(Methods), '-k', '4-5', '-m', 1, *inputs, '-d', tmp_path / 'sweep_counts', '-o', tmp_path / 'sweep')
+    for K in [4, 5]:
+        run_tool('afann.py', '-a', ','.join(Methods), '-k', K, '-m', 1, *inputs, '-o', tmp_path / ('single%d'%K))
+        for a_method in Methods:
+            assert read_tsv(tmp_path / ('sweep.K%d.%s.tsv'%(K, a_method))) == read_tsv(tmp_path / ('single%d.%s.tsv'%(K, a_method)))
+
+def test_markovian_order_is_checked_against_every_k(tmp_path):
+    result = subprocess.run([sys.executable, 'afann.py', '-a', 'd2star', '-k', '3,8', '-m', '4', '-s', 'test_samples/crm.fa', '-o', str(tmp_path / 'out')], cwd=Root, capture_output=True, text=True)
+    assert result.returncode != 0
+    assert 'K=3 is too short' in result.stderr
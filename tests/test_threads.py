@@ -0,0 +1,39 @@
+import subprocess
+import sys
+import numexpr
+from threadpoolctl import threadpool_info
+from conftest import Root, run_tool, read_tsv
+import method
+
+Methods = ['d2star', 'd2shepp', 'cvtree', 'ma', 'eu', 'd2']
+
+def test_results_do_not_depend_on_threads(tmp_path, list_file):
+    for threads in [1, 3]:
+        run_tool('afann.py', '-a', ','.join(Methods), '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / ('t%d'%threads), '-t', threads, '--adjust')
+    for a_method in Methods + ['d2star_adjusted', 'd2shepp_adjusted']:
+        assert read_tsv(tmp_path / ('t3.%s.tsv'%a_method)) == read_tsv(tmp_path / ('t1.%s.tsv'%a_method))
+
+def test_stages_hand_the_budget_to_their_pools(monkeypatch):
+    # the limits are also written to the environment, which is given back afterwards
+    for variable in ['NUMEXPR_NUM_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        monkeypatch.setenv(variable, '1')
+    method.ne.evaluate('1 + 1')
+    try:
+        method.set_thread_budget(3)
+        with method.stage('distances'):
+            assert numexpr.get_num_threads() == min(3, numexpr.MAX_THREADS)
+            assert all(pool['num_threads'] == 3 for pool in threadpool_info())
+            with method.stage('counting'):
+                assert numexpr.get_num_threads() == 1
+                assert all(pool['num_threads'] == 1 for pool in threadpool_info())
+            assert numexpr.get_num_threads() == min(3, numexpr.MAX_THREADS)
+        assert set(method.Stage_Times) >= set(['distances', 'counting'])
+    finally:
+        method.set_thread_budget(1)
+        method.Stage_Times.clear()
+
+def test_command_line_reports_every_stage(tmp_path, list_file):
+    result = subprocess.run([sys.executable, 'afann.py', '-a', 'd2star', '-k', '5', '-m', '1', '-f', list_file, '-o', str(tmp_path / 'out'), '-t', '2', '--adjust'], cwd=Root, check=True, capture_output=True, text=True)
+    for name in ['counting', 'distances', 'bias', 'adjusting']:
+        assert 'Stage %s: '%name in result.stdout
+    assert 'on 2 threads' in result.stdout
@@ -0,0 +1,93 @@
+import re
+import numpy as np
+from conftest import run_tool
+from src._count import neighbor_joining_steps
+import tree
+
+def naive_neighbor_joining(square):
+    # The canonical O(N^3) algorithm, in the (ids, lengths) layout of neighbor_joining_steps
+    N = len(square)
+    D = {(i, j): square[i][j] for i in range(N) for j in range(N) if i != j}
+    active = list(range(N))
+    ids, lengths = [], []
+    while len(active) > 3:
+        n = len(active)
+        r = {i: sum(D[(i, j)] for j in active if j != i) for i in active}
+        q, a, b = min(((n-2) * D[(i, j)] - r[i] - r[j], i, j) for i in active for j in active if i < j)
+        d = D[(a, b)]
+        length_a = 0.5 * d + (r[a] - r[b]) / (2 * (n-2))
+        length_b = d - length_a
+        if length_a < 0:
+            length_a, length_b = 0, max(d, 0)
+        elif length_b < 0:
+            length_a, length_b = max(d, 0), 0
+        new = N + len(ids) // 2
+        ids += [a, b]
+        lengths += [length_a, length_b]
+        active.remove(a)
+        active.remove(b)
+        for s in active:
+            D[(new, s)] = D[(s, new)] = 0.5 * (D[(a, s)] + D[(b, s)] - d)
+        active.append(new)
+    a, b, c = active
+    ids += active
+    lengths += [max(0.5 * (D[(a, b)] + D[(a, c)] - D[(b, c)]), 0), max(0.5 * (D[(a, b)] + D[(b, c)] - D[(a, c)]), 0), max(0.5 * (D[(a, c)] + D[(b, c)] - D[(a, b)]), 0)]
+    return ids, lengths
+
+def leaf_distances(ids, lengths, N):
+    # Path lengths between the leaves of the tree given by the joins
+    below = {i: {i: 0.0} for i in range(N)}
+    distances = np.zeros((N, N))
+    def join(nodes, node_lengths):
+        groups = [{leaf: depth + length for leaf, depth in below.pop(node).items()} for node, length in zip(nodes, node_lengths)]
+        for g, group in enumerate(groups):
+            for other in groups[g+1:]:
+                for i, di in group.items():
+                    for j, dj in other.items():
+                        distances[i, j] = distances[j, i] = di + dj
+        return {leaf: depth for group in groups for leaf, depth in group.items()}
+    rest = 3 if N > 2 else 2
+    for step in range(N - rest):
+        below[N + step] = join(ids[2*step:2*step+2], lengths[2*step:2*step+2])
+    join(ids[-rest:], lengths[-rest:])
+    return distances
+
+def random_distances(rng, N, metric):
+    if metric:
+        points = rng.rand(N, 4)
+        return np.sqrt(((points[:, np.newaxis] - points[np.newaxis]) ** 2).sum(-1))
+    # distances far from a tree, whose joins give negative lengths
+    square = rng.rand(N, N)
+    return np.triu(square, 1) + np.triu(square, 1).T
+
+def test_joins_match_the_naive_algorithm():
+    rng = np.random.RandomState(0)
+    for N, metric in [(5, True), (9, True), (30, True), (7, False), (12, False), (25, False)]:
+        square = random_distances(rng, N, metric)
+        i, j = np.triu_indices(N, 1)
+        ids, lengths = neighbor_joining_steps(square[i, j], N)
+        expected_ids, expected_lengths = naive_neighbor_joining(square)
+        # at 4 nodes both pairings are equally good, so the steps are compared until then
+        for step in range(N - 4):
+            joined = sorted(zip(ids[2*step:2*step+2], lengths[2*step:2*step+2]))
+            expected = sorted(zip(expected_ids[2*step:2*step+2], expected_lengths[2*step:2*step+2]))
+            assert [a for a, length in joined] == [a for a, length in expected]
+            assert np.allclose([length for a, length in joined], [length for a, length in expected])
+        assert np.all(np.asarray(lengths) >= 0)
+        # either pairing gives the same tree when no length is clamped
+        if metric:
+            assert np.allclose(leaf_distances(list(ids), list(lengths), N), leaf_distances(expected_ids, expected_lengths, N))
+
+def test_newick_of_small_matrices():
+    assert tree.neighbor_joining(np.zeros(0), ['a']) == 'a;'
+    assert tree.neighbor_joining(np.array([0.5]), ['a', 'b c']) == "(a:0.250000,'b c':0.250000);"
+    assert tree.neighbor_joining(np.array([0.3, 0.5, 0.6]), ['a', 'b', 'c']) == '(a:0.100000,b:0.200000,c:0.400000);'
+
+def test_command_line_trees_hold_every_sample(tmp_path, list_file, records):
+    run_tool('afann.py', '-a', 'd2star,Ma', '-k', 5, '-m', 1, '-f', list_file, '-o', tmp_path / 'out', '--adjust', '--tree')
+    for a_method in ['d2star', 'd2star_adjusted', 'ma']:
+        newick = (tmp_path / ('out.%s.nwk'%a_method)).read_text().strip()
+        assert newick.endswith(';') and newick.count('(') == newick.count(')')
+        leaves = re.findall(r'[(,]([^(),:]+):', newick)
+        assert sorted(leaves) == sorted(records[0])
+        assert all(float(length) >= 0 for length in re.findall(r':([-0-9.e]+)', newick))
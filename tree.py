@@ -0,0 +1,24 @@
+from src._count import neighbor_joining_steps
+import re
+
+# Neighbour joining trees of condensed pairwise results, written in Newick format. The joins are found
+# by the extension with the bounds of rapidNJ, see src/neighbor_joining.h.
+
+def newick_name(name):
+    if re.search(r"[\s(),:;\[\]']", name):
+        return "'" + name.replace("'", "''") + "'"
+    return name
+
+def neighbor_joining(condensed, names):
+    N = len(names)
+    nodes = [newick_name(name) for name in names]
+    if N == 1:
+        return nodes[0] + ';'
+    ids, lengths = neighbor_joining_steps(condensed, N)
+    rest = 3 if N > 2 else 2
+    # the node joined at step s gets the id N+s
+    for step in range(N - rest):
+        a, b = ids[2*step], ids[2*step+1]
+        nodes.append('(%s:%.6f,%s:%.6f)'%(nodes[a], lengths[2*step], nodes[b], lengths[2*step+1]))
+        nodes[a] = nodes[b] = None
+    return '(%s);'%','.join('%s:%.6f'%(nodes[i], length) for i, length in zip(ids[-rest:], lengths[-rest:]))